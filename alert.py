@@ -9,6 +9,7 @@ within Python.
 
 import argparse
 import logging
+import os
 import sys
 
 import alertlib
@@ -16,6 +17,9 @@ import alertlib
 
 DEFAULT_SEVERITY = logging.INFO
 
+# How long we wait for our hipchat posts to go out before moving on.
+HIPCHAT_FLUSH_TIMEOUT_SECS = 30
+
 
 class _MakeList(argparse.Action):
     """Parse the argument as a comma-separated list."""
@@ -31,6 +35,22 @@ class _ParseSeverity(argparse.Action):
         setattr(namespace, self.dest, getattr(logging, value.upper()))
 
 
+class _ParseGraphiteStatistics(argparse.Action):
+    """Parse the argument as a comma-separated list of stat[=value]."""
+    def __call__(self, parser, namespace, value, option_string=None):
+        statistics = []
+        for statistic in value.split(','):
+            (statistic, _, stat_value) = statistic.partition('=')
+            try:
+                stat_value = float(stat_value) if stat_value else None
+            except ValueError:
+                parser.error('Bad value for graphite statistic %s: %s'
+                             % (statistic, stat_value))
+            if statistic.strip():
+                statistics.append((statistic.strip(), stat_value))
+        setattr(namespace, self.dest, statistics)
+
+
 def setup_parser():
     """Create an ArgumentParser for alerting."""
     parser = argparse.ArgumentParser(
@@ -56,10 +76,13 @@ def setup_parser():
                               'if missing we figure it out automatically. '))
     parser.add_argument('--logs', action='store_true',
                         help=('Send to syslog.  May specify --severity.'))
-    parser.add_argument('--graphite', default=[], action=_MakeList,
+    parser.add_argument('--graphite', default=[],
+                        action=_ParseGraphiteStatistics,
                         help=('Send to graphite.  Argument is a comma-'
-                              'separted list of statistics to update. '
-                              'May specify --graphite_val and '
+                              'separted list of statistics to update, '
+                              'each optionally followed by =<value> '
+                              '(e.g. "jobs.num_run=4,jobs.num_failed"). '
+                              'May specify --graphite_value and '
                               '--graphite_host.'))
 
     parser.add_argument('--summary', default=None,
@@ -95,42 +118,78 @@ def setup_parser():
                               'used with --mail'))
     parser.add_argument('--graphite_value', default=1, type=float,
                         help=('Value to send to graphite for each of the '
-                              'graphite statistics specified '
-                              '(default %(default)s)'))
+                              'graphite statistics specified without a '
+                              'value (default %(default)s)'))
     parser.add_argument('--graphite_host',
                         default=alertlib.Alert.DEFAULT_GRAPHITE_HOST,
                         help=('host:port to send graphite data to '
                               '(default %(default)s)'))
 
+    parser.add_argument('--rate-limit', default=None, type=float,
+                        metavar='SECONDS',
+                        help=('Only send this alert (to each place) once '
+                              'every SECONDS seconds, even across separate '
+                              'runs of this script.  Alerts are the same '
+                              'if they have the same message and severity.'))
+    parser.add_argument('--rate-limit-db',
+                        default=os.path.expanduser(
+                            '~/.alertlib_rate_limits.sqlite'),
+                        help=('Where to keep track of --rate-limit across '
+                              'runs (default %(default)s)'))
+
     parser.add_argument('-n', '--dry-run', action='store_true',
                          help=("Just log what we would do, but don't do it"))
 
     return parser
 
 
+def setup_rate_limiting(parser, args):
+    """Set up --rate-limit, or exit with a usage error if we can't.
+
+    A dry run leaves --rate-limit-db alone, so it can't keep a later
+    real run from sending.  (It's still rate limited within itself.)
+    """
+    if args.rate_limit and not args.dry_run:
+        try:
+            alertlib.configure_rate_limiting(path=args.rate_limit_db)
+        except ImportError, why:
+            parser.error('cannot use --rate-limit-db: %s' % why)
+
+
 def alert(message, args):
-    a = alertlib.Alert(message, args.summary, args.severity, html=args.html)
+    """Send message as args say.  Call setup_rate_limiting() first."""
+    a = alertlib.Alert(message, args.summary, args.severity, html=args.html,
+                       rate_limit=args.rate_limit)
 
-    for room in args.hipchat:
-        a.send_to_hipchat(room, args.color, args.notify, args.hipchat_sender)
+    # Post to all the hipchat rooms in parallel, while we do the rest.
+    alertlib.enable_async_hipchat()
+    try:
+        for room in args.hipchat:
+            a.send_to_hipchat(room, args.color, args.notify,
+                              args.hipchat_sender)
 
-    if args.mail:
-        a.send_to_email(args.mail, args.cc, args.bcc, args.sender_suffix)
+        if args.mail:
+            a.send_to_email(args.mail, args.cc, args.bcc, args.sender_suffix)
 
-    if args.pagerduty:
-        a.send_to_pagerduty(args.pagerduty)
+        if args.pagerduty:
+            a.send_to_pagerduty(args.pagerduty)
 
-    if args.logs:
-        a.send_to_logs()
+        if args.logs:
+            a.send_to_logs()
 
-    for statistic in args.graphite:
-        a.send_to_graphite(statistic, args.graphite_value,
-                           args.graphite_host)
+        if args.graphite:
+            a.send_many_to_graphite(
+                [(statistic, args.graphite_value if value is None else value)
+                 for (statistic, value) in args.graphite],
+                graphite_host=args.graphite_host)
+    finally:
+        alertlib.disable_async_hipchat(HIPCHAT_FLUSH_TIMEOUT_SECS)
 
 
 def main(argv):
     parser = setup_parser()
     args = parser.parse_args(argv)
+    setup_rate_limiting(parser, args)
 
     if sys.stdin.isatty():
         print >>sys.stderr, '>> Enter the message to alert, then hit control-D'
@@ -46,15 +46,30 @@ Some advice on how to choose:
   to HipChat.
 
 When sending to email, we try using both google appengine (for when
-you're using this within an appengine app) and sendmail.
+you're using this within an appengine app) and sendmail, and then
+stick with whichever one worked.
 """
 
+import array
+import atexit
+import bisect
+import collections
+import cPickle
+import errno
+import hashlib
+import httplib
+import json
 import logging
+import os
+import random
 import re
 import socket
+import struct
+import sys
+import threading
 import time
 import urllib
-import urllib2
+import urlparse
 
 try:
     # We use the simpler name here just to make it easier to mock for tests
@@ -67,6 +82,7 @@ except ImportError:
 
 try:
     import email
+    import email.mime.multipart
     import email.mime.text
     import email.utils
     import smtplib
@@ -78,6 +94,11 @@ try:
 except ImportError:
     pass
 
+try:
+    import sqlite3
+except ImportError:
+    pass
+
 try:
     # KA-specific hack: ka_secrets is a superset of secrets.
     try:
@@ -98,10 +119,6 @@ except ImportError:
 _PAGERDUTY_ILLEGAL_CHARS = re.compile(r'[^A-Za-z0-9._-]')
 
 
-_GRAPHITE_SOCKET = None
-_LAST_GRAPHITE_TIME = None
-
-
 _TEST_MODE = False
 
 
@@ -117,33 +134,2372 @@ def exit_test_mode():
     _TEST_MODE = False
 
 
+class DeliveryError(Exception):
+    """We failed to deliver an alert; see BackendOutcome.error."""
+    pass
+
+
+class _ForkAware(object):
+    """A mixin for objects whose threads and buffers a fork can't share.
+
+    Subclasses set self._pid = os.getpid() when they're made, and call
+    _check_for_fork() before using their state.  The first time that
+    runs in a forked child, we give the object a new _lock -- some
+    other thread may have held the old one when we forked -- and call
+    _reset_after_fork().  That should drop whatever the parent still
+    owns (pending data, which the parent will send; sockets, which
+    we mustn't write to) and restart our threads, since the parent's
+    didn't come with us.
+    """
+    def _check_for_fork(self):
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+            self._reset_after_fork()
+
+    def _reset_after_fork(self):
+        raise NotImplementedError()
+
+
+class _HipchatDispatcher(_ForkAware):
+    """Deliver hipchat posts in the background, in order, per room.
+
+    Each room gets its own FIFO of pending posts, drained by its own
+    worker thread.  A worker only sends the next post for a room once
+    hipchat has acknowledged the previous one (that is, once
+    _post_to_hipchat() has returned), so a summary always shows up
+    before its body.  Different rooms are posted to in parallel.
+    Workers exit as soon as their room's queue is empty.
+
+    A post that hipchat throttles is retried by the room's worker, so
+    it holds up the posts behind it until it's gone through.
+
+    A forked child starts out with no pending posts: the parent's
+    workers will send those.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._queues = {}      # room name -> deque of (post_fn, args)
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def _reset_after_fork(self):
+        self._cond = threading.Condition(self._lock)
+        self._queues = {}
+
+    def enqueue(self, room_name, post_fn, *args):
+        """Have a worker call post_fn(*args) after the room's other posts."""
+        self._check_for_fork()
+        with self._cond:
+            start_worker = room_name not in self._queues
+            if start_worker:
+                self._queues[room_name] = collections.deque()
+            self._queues[room_name].append((post_fn, args))
+
+        if start_worker:
+            worker = threading.Thread(target=self._drain, args=(room_name,),
+                                      name='alertlib-hipchat')
+            worker.daemon = True
+            worker.start()
+
+    def _drain(self, room_name):
+        self._local.in_worker = True
+        while True:
+            with self._cond:
+                queue = self._queues[room_name]
+                if not queue:
+                    del self._queues[room_name]
+                    self._cond.notify_all()
+                    return
+                (post_fn, args) = queue[0]
+
+            try:
+                post_fn(*args)
+            except Exception, why:
+                logging.error('Failed sending to hipchat room %s: %s'
+                              % (room_name, why))
+
+            # We only pop once the post is done, so flush() waits for it.
+            with self._cond:
+                queue.popleft()
+
+    def in_worker(self):
+        """True if we're being called from one of our workers."""
+        return getattr(self._local, 'in_worker', False)
+
+    def has_pending(self, room_name):
+        """True if there are posts to room_name we haven't finished."""
+        self._check_for_fork()
+        with self._cond:
+            return room_name in self._queues
+
+    def num_pending(self):
+        self._check_for_fork()
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.itervalues())
+
+    def flush(self, timeout=None):
+        """Wait for all pending posts to be sent.  False if we timed out."""
+        self._check_for_fork()
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._queues:
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+        return True
+
+
+_HIPCHAT_DISPATCHER = _HipchatDispatcher()
+_HIPCHAT_ASYNC = False
+
+
+def enable_async_hipchat():
+    """Have send_to_hipchat() return right away, posting in the background.
+
+    Posts to a given room are still delivered in the order they were
+    sent; use flush_hipchat() to wait for them to finish.
+    """
+    global _HIPCHAT_ASYNC
+    _HIPCHAT_ASYNC = True
+
+
+def disable_async_hipchat(timeout=None):
+    """Wait for pending hipchat posts, then go back to posting inline.
+
+    Returns False if we gave up waiting after timeout seconds.
+    """
+    global _HIPCHAT_ASYNC
+    _HIPCHAT_ASYNC = False
+    return flush_hipchat(timeout)
+
+
+def flush_hipchat(timeout=None):
+    """Wait for all pending hipchat posts; return False if we timed out.
+
+    This also sends any messages that are being held for coalescing.
+    """
+    _HIPCHAT_COALESCER.flush()
+    return _HIPCHAT_DISPATCHER.flush(timeout)
+
+
+# hipchat has a 10,000 char limit on messages, we leave some leeway
+_HIPCHAT_MAX_MESSAGE_LEN = 9000
+
+
+class _WindowedBatcher(object):
+    """Collect items per key, and hand them off together after a window.
+
+    The window for a key starts when the first item for that key shows
+    up.  window_secs later we call flush_fn(context, items), where
+    context is whatever was passed in along with that first item.  If
+    window_secs is None, batching is turned off.
+    """
+    def __init__(self, flush_fn):
+        self.window_secs = None
+        self._flush_fn = flush_fn
+        self._lock = threading.Lock()
+        # key -> (context, list of items, timer), oldest first
+        self._pending = collections.OrderedDict()
+
+    def add(self, key, item, context):
+        with self._lock:
+            if key in self._pending:
+                self._pending[key][1].append(item)
+                return
+            timer = threading.Timer(self.window_secs, self._flush_key,
+                                    (key,))
+            timer.daemon = True
+            self._pending[key] = (context, [item], timer)
+        timer.start()
+
+    def _flush_key(self, key):
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        if pending is None:      # someone called flush() already
+            return
+        (context, items, timer) = pending
+        timer.cancel()
+        self._flush_fn(context, items)
+
+    def flush(self):
+        with self._lock:
+            keys = self._pending.keys()
+        for key in keys:
+            self._flush_key(key)
+
+
+def _pack_hipchat_messages(messages, separator):
+    """Split messages into as few lists as we can, each short enough to
+    send as one post once joined with separator.
+
+    Each message is already at most _HIPCHAT_MAX_MESSAGE_LEN long.
+    """
+    chunk = []
+    chunk_len = 0
+    for message in messages:
+        if chunk and (chunk_len + len(separator) + len(message)
+                      > _HIPCHAT_MAX_MESSAGE_LEN):
+            yield chunk
+            chunk = []
+            chunk_len = 0
+        chunk_len += (len(separator) if chunk else 0) + len(message)
+        chunk.append(message)
+    if chunk:
+        yield chunk
+
+
+def _send_coalesced_hipchat_posts(context, items):
+    """Send items as few posts as we can, otherwise just like post_dict.
+
+    Items are (summary post_dict or None, message) pairs, buffered per
+    (room, color, notify) -- and sender and format, which also have
+    to match to share a post.  Before each post, we send the summaries
+    of the messages in it, so a summary never shows up after its body.
+    """
+    (post_fn, post_dict) = context
+    separator = '<br>' if post_dict['message_format'] == 'html' else '\n'
+
+    def post(message, base_post_dict):
+        combined_post_dict = base_post_dict.copy()
+        combined_post_dict['message'] = message
+        try:
+            post_fn(combined_post_dict)
+        except Exception, why:
+            logging.error('Failed sending to hipchat room %s: %s'
+                          % (post_dict['room_id'], why))
+
+    num_done = 0
+    for messages in _pack_hipchat_messages([m for (_, m) in items],
+                                           separator):
+        summary_post_dicts = [
+            summary_post_dict for (summary_post_dict, _)
+            in items[num_done:num_done + len(messages)]
+            if summary_post_dict is not None]
+        num_done += len(messages)
+        if summary_post_dicts:
+            for summaries in _pack_hipchat_messages(
+                    [d['message'] for d in summary_post_dicts], '\n'):
+                post('\n'.join(summaries), summary_post_dicts[0])
+        post(separator.join(messages), post_dict)
+
+
+_HIPCHAT_COALESCER = _WindowedBatcher(_send_coalesced_hipchat_posts)
+
+
+def enable_hipchat_coalescing(window_secs=10):
+    """Combine hipchat messages to the same room sent within window_secs.
+
+    This is useful when you may send a flood of alerts: rather than
+    making an API call for each one (and getting throttled by hipchat),
+    we make one call per room (and color and notify setting) every
+    window_secs.
+    """
+    _HIPCHAT_COALESCER.window_secs = window_secs
+
+
+def disable_hipchat_coalescing():
+    """Send any messages being held for coalescing, then stop coalescing."""
+    _HIPCHAT_COALESCER.window_secs = None
+    _HIPCHAT_COALESCER.flush()
+
+
+def _flush_hipchat_at_exit(timeout=30):
+    """Send what we can before we exit; count the rest as dropped."""
+    if not flush_hipchat(timeout):
+        num_dropped = _HIPCHAT_DISPATCHER.num_pending()
+        _HIPCHAT_THROTTLE.note_dropped(num_dropped)
+        logging.warning('Gave up sending %s posts to hipchat at exit',
+                        num_dropped)
+
+
+# Don't lose alerts that are still in flight when the process exits.
+atexit.register(_flush_hipchat_at_exit)
+
+
+class _DNSCache(object):
+    """A process-wide cache of hostname -> ip address lookups.
+
+    Looking up a hostname can take seconds when DNS is having a bad
+    day, which is often exactly when we're trying to send alerts.  So
+    we remember all of a hostname's addresses (IPv4 and IPv6, as
+    getaddrinfo() gives them) for ttl_secs.  Only the first lookup of
+    a hostname makes the caller wait: once a hostname is within
+    refresh_secs of expiring, or past it, we look it up again in a
+    background thread, and keep handing out the addresses we have
+    until that's done.  If a lookup fails, we keep using the last
+    addresses that worked (and retry the lookup the next time they're
+    used).
+    """
+    def __init__(self, ttl_secs=300, refresh_secs=60):
+        self.ttl_secs = ttl_secs
+        self.refresh_secs = refresh_secs
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_stale = 0     # times we used expired addresses
+        self._lock = threading.Lock()
+        # hostname -> (list of (family, sockaddr), expiry time)
+        self._addresses = {}
+        self._refreshing = set()
+
+    def _lookup(self, hostname):
+        """Look up hostname for real, and cache the result."""
+        addresses = []
+        for (family, _, _, _, sockaddr) in socket.getaddrinfo(
+                hostname, None, socket.AF_UNSPEC, socket.SOCK_STREAM):
+            if (family, sockaddr) not in addresses:
+                addresses.append((family, sockaddr))
+        with self._lock:
+            self._addresses[hostname] = (addresses,
+                                         time.time() + self.ttl_secs)
+        return addresses
+
+    def _refresh(self, hostname):
+        try:
+            self._lookup(hostname)
+        except socket.error, why:
+            logging.warning('Could not look up %s, still using the '
+                            'addresses from before: %s', hostname, why)
+        finally:
+            with self._lock:
+                self._refreshing.discard(hostname)
+
+    def resolve_all(self, hostname):
+        """Return the addresses for hostname, as (family, sockaddr) pairs.
+
+        The port in each sockaddr is 0; see _with_port().
+        """
+        now = time.time()
+        with self._lock:
+            (addresses, expiry) = self._addresses.get(hostname, (None, None))
+            if addresses is None:
+                self.num_misses += 1
+                refresh = False
+            else:
+                if now < expiry:
+                    self.num_hits += 1
+                else:
+                    self.num_stale += 1
+                refresh = (expiry - now < self.refresh_secs and
+                           hostname not in self._refreshing)
+                if refresh:
+                    self._refreshing.add(hostname)
+
+        if refresh:
+            thread = threading.Thread(target=self._refresh, args=(hostname,),
+                                      name='alertlib-dns-refresh')
+            thread.daemon = True
+            thread.start()
+        if addresses is None:
+            return self._lookup(hostname)
+        return addresses
+
+    def resolve(self, hostname, family=socket.AF_INET):
+        """Return an ip address for hostname of the given family."""
+        for (address_family, sockaddr) in self.resolve_all(hostname):
+            if address_family == family:
+                return sockaddr[0]
+        raise socket.gaierror('No address of the right family for %s'
+                              % hostname)
+
+
+def _with_port(sockaddr, port):
+    """Return sockaddr, an IPv4 or IPv6 socket address, with a new port."""
+    return (sockaddr[0], port) + tuple(sockaddr[2:])
+
+
+_DNS_CACHE = _DNSCache()
+
+
+def configure_dns_cache(**kwargs):
+    """Change how long we cache DNS lookups; see _DNSCache for options."""
+    global _DNS_CACHE
+    _DNS_CACHE = _DNSCache(**kwargs)
+
+
+def dns_stats():
+    """Return counts of DNS cache hits and misses (and stale answers)."""
+    return {'hits': _DNS_CACHE.num_hits,
+            'misses': _DNS_CACHE.num_misses,
+            'stale': _DNS_CACHE.num_stale}
+
+
+def _create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                       source_address=None):
+    """Like socket.create_connection(), but using our DNS cache.
+
+    As with that, we try each of the host's addresses in turn, until
+    we can connect to one.
+    """
+    (hostname, port) = address
+    why = socket.error('No addresses for %s' % hostname)
+    for (family, sockaddr) in _DNS_CACHE.resolve_all(hostname):
+        sock = None
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(_with_port(sockaddr, port))
+            return sock
+        except socket.error, why:
+            if sock is not None:
+                sock.close()
+    raise why
+
+
+def _is_connection_reset(why):
+    """True if why says the server hung up on us before it answered.
+
+    That's what we see when we reuse a keep-alive connection that the
+    server has since closed: it can't have acted on our request.  A
+    timeout, on the other hand, could mean it's still working on it.
+    """
+    if isinstance(why, httplib.BadStatusLine):
+        return True
+    return (isinstance(why, socket.error) and
+            not isinstance(why, socket.timeout) and
+            why.errno in (errno.ECONNRESET, errno.EPIPE))
+
+
+class _HTTPSConnectionPool(_ForkAware):
+    """A process-wide pool of keep-alive https connections, keyed by host.
+
+    This saves us a TCP + TLS handshake for every request after the
+    first.  We keep at most max_size idle connections per host, and
+    close any that have been idle for more than max_idle_secs (most
+    servers will have hung up on them by then anyway).  If the server
+    closed a connection we were about to reuse, we reconnect and try
+    again -- but only if we know it never saw the request, so we never
+    send the same request twice.
+
+    Like urllib2, we honor the https_proxy (and no_proxy) environment
+    variables: if there's a proxy, we tunnel through it with CONNECT.
+
+    A forked child starts out with no idle connections.  It leaves
+    its parent's alone, without closing them: two processes talking
+    on one TLS stream would garble it.
+    """
+    def __init__(self, max_size=4, max_idle_secs=60, timeout=30):
+        self.max_size = max_size
+        self.max_idle_secs = max_idle_secs
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}     # host -> list of (connection, last-used time)
+        self._pid = os.getpid()
+
+    def _reset_after_fork(self):
+        self._idle = {}
+
+    def _checkout(self, host):
+        """Return (connection, whether it is a reused connection)."""
+        self._check_for_fork()
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(host, [])
+            stale = [c for (c, t) in idle if now - t > self.max_idle_secs]
+            idle[:] = [(c, t) for (c, t) in idle
+                       if now - t <= self.max_idle_secs]
+            conn = idle.pop()[0] if idle else None
+        for c in stale:
+            c.close()
+        if conn is not None:
+            return (conn, True)
+        proxy = urllib.getproxies().get('https')
+        if proxy and not urllib.proxy_bypass(host):
+            proxy_url = urlparse.urlsplit(proxy)
+            conn = httplib.HTTPSConnection(proxy_url.hostname,
+                                           proxy_url.port or 8080,
+                                           timeout=self.timeout)
+            tunnel_headers = {}
+            if proxy_url.username:
+                tunnel_headers['Proxy-Authorization'] = (
+                    'Basic ' + ('%s:%s' % (
+                        urllib.unquote(proxy_url.username),
+                        urllib.unquote(proxy_url.password or ''))
+                    ).encode('base64').replace('\n', ''))
+            conn.set_tunnel(host, headers=tunnel_headers)
+        else:
+            conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+        # We still verify the certificate against host, of course.
+        conn._create_connection = _create_connection
+        return (conn, False)
+
+    def _checkin(self, host, conn):
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            if len(idle) < self.max_size:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def clear(self):
+        """Close all idle connections."""
+        self._check_for_fork()
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.itervalues():
+            for (c, _) in conns:
+                c.close()
+
+    def request(self, method, url, body=None, headers=None):
+        """Make an https request; return (status, headers, response body).
+
+        headers is a dict from lower-cased header name to value.
+        """
+        parsed_url = urlparse.urlsplit(url)
+        host = parsed_url.netloc
+        path = parsed_url.path + ('?' + parsed_url.query
+                                  if parsed_url.query else '')
+        while True:
+            (conn, reused) = self._checkout(host)
+            try:
+                conn.request(method, path, body, headers or {})
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    # The server hung up on this idle connection before
+                    # we could send it anything.
+                    continue
+                raise
+
+            try:
+                response = conn.getresponse()
+                # We have to read the whole response to reuse the connection.
+                response_body = response.read()
+            except (httplib.HTTPException, socket.error), why:
+                conn.close()
+                if reused and _is_connection_reset(why):
+                    continue
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._checkin(host, conn)
+            return (response.status, dict(response.getheaders()),
+                    response_body)
+
+
+_HTTPS_POOL = _HTTPSConnectionPool()
+
+
+class _TokenBucket(object):
+    """Allow `burst` events at once, refilling at `rate` events a second."""
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+
+    def wait_time(self):
+        """How many seconds until there is a token available."""
+        now = time.time()
+        elapsed = max(0.0, now - self.last_refill)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.last_refill = now
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        """Take a token.  Callers must wait_time() before using it.
+
+        We may go into debt here, which makes later callers wait longer.
+        """
+        self.tokens -= 1
+
+
+class _HipchatRateLimitedError(Exception):
+    """hipchat said we were over our rate limit (HTTP 429)."""
+    def __init__(self, retry_after):
+        super(_HipchatRateLimitedError, self).__init__(
+            'rate limited, retry after %s seconds' % retry_after)
+        self.retry_after = retry_after
+
+
+def _parse_retry_after(value, default=30):
+    """Convert a Retry-After header (seconds or an http-date) to seconds."""
+    if not value:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    parsed_date = email.utils.parsedate_tz(value)
+    if parsed_date is None:
+        return default
+    return max(0, email.utils.mktime_tz(parsed_date) - time.time())
+
+
+class _HipchatThrottle(object):
+    """Pace our hipchat posts so we stay under hipchat's rate limits.
+
+    hipchat limits how many API calls we can make per auth token
+    (100 every 5 minutes, for the v1 API); we also limit how fast we
+    post to any one room.  Each of these has its own token bucket.
+    If a post would have to wait at most max_wait_secs for its turn,
+    we just sleep; otherwise -- or if hipchat tells us to back off
+    with a 429 anyway -- we retry the post from the room's queue in
+    _HIPCHAT_DISPATCHER once we're allowed to (later posts to that
+    room wait behind it, so they stay in order).  At most
+    max_queued_retries posts can be waiting to retry, and each post
+    is retried at most max_retries times; after that we drop it.  We
+    also drop a post rather than wait more than max_retry_after_secs
+    to retry it, so a huge Retry-After can't hold up a room (or a
+    flush) for hours.
+    """
+    def __init__(self, token_rate=100 / 300.0, token_burst=100,
+                 room_rate=1.0, room_burst=10, max_wait_secs=5,
+                 max_queued_retries=100, max_retries=5,
+                 max_retry_after_secs=60):
+        self.token_rate = token_rate
+        self.token_burst = token_burst
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.max_wait_secs = max_wait_secs
+        self.max_queued_retries = max_queued_retries
+        self.max_retries = max_retries
+        self.max_retry_after_secs = max_retry_after_secs
+
+        self._lock = threading.Lock()
+        self._buckets = {}     # auth token or room name -> _TokenBucket
+        self._num_queued_retries = 0
+        self.stats = {'throttled': 0, 'retried': 0, 'dropped': 0}
+
+    def _bucket(self, key, rate, burst):
+        if key not in self._buckets:
+            self._buckets[key] = _TokenBucket(rate, burst)
+        return self._buckets[key]
+
+    def reserve(self, auth_token, room_name):
+        """Return how long to wait before posting, or None to retry later."""
+        with self._lock:
+            token_bucket = self._bucket(('token', auth_token),
+                                        self.token_rate, self.token_burst)
+            room_bucket = self._bucket(('room', room_name),
+                                       self.room_rate, self.room_burst)
+            # We need a token from both buckets, so make sure we can get
+            # both before we take either.
+            wait = max(token_bucket.wait_time(), room_bucket.wait_time())
+            if wait:
+                self.stats['throttled'] += 1
+            if wait > self.max_wait_secs:
+                return None
+            token_bucket.take()
+            room_bucket.take()
+            return wait
+
+    def retry_after(self, auth_token, room_name):
+        """How long until both buckets for this post have a token again."""
+        with self._lock:
+            return max(
+                self._bucket(('token', auth_token), self.token_rate,
+                             self.token_burst).wait_time(),
+                self._bucket(('room', room_name), self.room_rate,
+                             self.room_burst).wait_time())
+
+    def note_throttled(self):
+        with self._lock:
+            self.stats['throttled'] += 1
+
+    def note_dropped(self, num_dropped=1):
+        with self._lock:
+            self.stats['dropped'] += num_dropped
+
+    def start_retry(self, num_retries, retry_after):
+        """Note we're going to retry a post; False if we should drop it.
+
+        Call finish_retry() when the retry is about to be made.
+        """
+        with self._lock:
+            if (num_retries >= self.max_retries or
+                    retry_after > self.max_retry_after_secs or
+                    self._num_queued_retries >= self.max_queued_retries):
+                self.stats['dropped'] += 1
+                return False
+            self._num_queued_retries += 1
+            self.stats['retried'] += 1
+            return True
+
+    def finish_retry(self):
+        with self._lock:
+            self._num_queued_retries = max(0, self._num_queued_retries - 1)
+
+
+_HIPCHAT_THROTTLE = _HipchatThrottle()
+
+
+def configure_hipchat_throttling(**kwargs):
+    """Change how we pace hipchat posts; see _HipchatThrottle for args."""
+    global _HIPCHAT_THROTTLE
+    _HIPCHAT_THROTTLE = _HipchatThrottle(**kwargs)
+
+
+def hipchat_stats():
+    """Return counts of throttled, retried, and dropped hipchat posts.
+
+    'throttled' counts posts we had to delay, either because we were
+    pacing ourselves or because hipchat told us to back off.
+    'retried' counts posts we queued to retry later, and 'dropped'
+    those we gave up on.
+    """
+    return _HIPCHAT_THROTTLE.stats.copy()
+
+
+class _SMTPConnectionPool(_ForkAware):
+    """A process-wide pool of smtp connections, keyed by host.
+
+    This saves us a connect + EHLO + QUIT for every email after the
+    first.  Before reusing a connection we make sure it's still alive
+    with a NOOP.  We keep at most max_size idle connections per host,
+    close any that have been idle for more than max_idle_secs, and
+    recycle a connection once it has sent max_messages emails.
+
+    A forked child starts out with no idle connections, and leaves its
+    parent's alone: two processes can't share one smtp session.
+    """
+    def __init__(self, max_size=2, max_idle_secs=60, max_messages=100):
+        self.max_size = max_size
+        self.max_idle_secs = max_idle_secs
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        # host -> list of (connection, #messages sent, last-used time)
+        self._idle = {}
+        self._pid = os.getpid()
+
+    def _reset_after_fork(self):
+        self._idle = {}
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, socket.error):
+            conn.close()
+
+    def _checkout(self, host):
+        """Return (connection, #messages sent, whether it's reused)."""
+        self._check_for_fork()
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(host, [])
+            stale = [c for (c, _, t) in idle if now - t > self.max_idle_secs]
+            idle[:] = [(c, n, t) for (c, n, t) in idle
+                       if now - t <= self.max_idle_secs]
+        for conn in stale:
+            self._close(conn)
+
+        while True:
+            with self._lock:
+                if not idle:
+                    break
+                (conn, num_sent, _) = idle.pop()
+            try:
+                if conn.noop()[0] == 250:
+                    return (conn, num_sent, True)
+            except (smtplib.SMTPException, socket.error):
+                pass
+            conn.close()
+
+        return (self._connect(host), 0, False)
+
+    @staticmethod
+    def _connect(host):
+        """Like smtplib.SMTP(host), but connecting via our DNS cache."""
+        conn = smtplib.SMTP()
+        conn._get_socket = lambda hostname, port, timeout: (
+            _create_connection((hostname, port), timeout))
+        (code, message) = conn.connect(host)
+        if code != 220:
+            conn.close()
+            raise smtplib.SMTPConnectError(code, message)
+        return conn
+
+    def _checkin(self, host, conn, num_sent):
+        if num_sent < self.max_messages:
+            with self._lock:
+                idle = self._idle.setdefault(host, [])
+                if len(idle) < self.max_size:
+                    idle.append((conn, num_sent, time.time()))
+                    return
+        self._close(conn)
+
+    def clear(self):
+        """Close all idle connections."""
+        self._check_for_fork()
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.itervalues():
+            for (c, _, _) in conns:
+                self._close(c)
+
+    def sendmail(self, host, from_addr, to_addrs, msg):
+        while True:
+            (conn, num_sent, reused) = self._checkout(host)
+            try:
+                conn.sendmail(from_addr, to_addrs, msg)
+            except smtplib.SMTPServerDisconnected:
+                conn.close()
+                if reused:
+                    # The server hung up on us since the NOOP; try again.
+                    continue
+                raise
+            except Exception:
+                self._close(conn)
+                raise
+            self._checkin(host, conn, num_sent + 1)
+            return
+
+
+_SMTP_POOL = _SMTPConnectionPool()
+
+
+# The email transport that worked last time: 'gae' or 'smtp'.  We try
+# that one first, so we only pay for trying (and failing) to use the
+# appengine mail api once per process when we're not on appengine.
+_EMAIL_TRANSPORT = None
+
+# If set, a 'host' or 'host:port' to send smtp email to, instead of
+# the local mail server.
+_SMTP_RELAY = None
+
+
+def email_transport():
+    """Return how we are sending email: 'gae', 'smtp:<host>', or None.
+
+    None means we haven't sent any email yet, so haven't figured it out.
+    """
+    if _EMAIL_TRANSPORT == 'smtp':
+        return 'smtp:%s' % (_SMTP_RELAY or 'localhost')
+    return _EMAIL_TRANSPORT
+
+
+def redetect_email_transport():
+    """Figure out how to send email anew the next time we send one."""
+    global _EMAIL_TRANSPORT
+    _EMAIL_TRANSPORT = None
+
+
+def set_smtp_relay(smtp_hostport):
+    """Send email via the given smtp 'host[:port]' rather than localhost.
+
+    Pass None to go back to using the local mail server.
+    """
+    global _SMTP_RELAY
+    _SMTP_RELAY = smtp_hostport
+    redetect_email_transport()
+
+
+def _send_email_digest(context, alerts_and_times):
+    (email_addresses, cc, bcc, sender) = context
+    try:
+        _EmailDigest(alerts_and_times)._send_to_email(
+            list(email_addresses), cc and list(cc), bcc and list(bcc), sender)
+    except Exception, why:
+        logging.error('Failed sending digest of %s alerts to %s: %s'
+                      % (len(alerts_and_times), email_addresses, why))
+
+
+_EMAIL_DIGESTER = _WindowedBatcher(_send_email_digest)
+
+# Alerts at least this severe are emailed right away, even in digest mode.
+_EMAIL_DIGEST_BYPASS_SEVERITY = logging.CRITICAL
+
+
+def enable_email_digests(window_secs=60, bypass_severity=logging.CRITICAL):
+    """Have send_to_email() collect alerts into one email per window_secs.
+
+    We send one digest email per set of recipients, sender, and
+    severity (warnings and worse are kept separate from the rest);
+    it lists all the alerts we collected.  Alerts with a severity of
+    at least bypass_severity are still sent right away.  Pass None
+    to digest everything.
+    """
+    global _EMAIL_DIGEST_BYPASS_SEVERITY
+    _EMAIL_DIGEST_BYPASS_SEVERITY = bypass_severity
+    _EMAIL_DIGESTER.window_secs = window_secs
+
+
+def disable_email_digests():
+    """Send any digests we're collecting, then go back to emailing alerts."""
+    _EMAIL_DIGESTER.window_secs = None
+    flush_email_digests()
+
+
+def flush_email_digests():
+    """Send all the digests we're collecting now, rather than waiting."""
+    _EMAIL_DIGESTER.flush()
+
+
+atexit.register(flush_email_digests)
+
+
+class _PagerDutyDeduper(object):
+    """Suppress pages that repeat an incident we paged about recently.
+
+    A page's fingerprint is the services it goes to, plus its summary
+    (ignoring case and whitespace differences) -- or, if it has no
+    summary (as with html alerts), a hash of its message.  We suppress
+    a page if we sent one with the same fingerprint within the last
+    ttl_secs, and count it; the next page with that fingerprint that
+    does go out says how many were suppressed.  A page counts as
+    sent as soon as it's let through, so duplicates sent while it's
+    still on its way are suppressed too; if sending fails, call
+    failed() and the next one gets through.  We remember at most
+    max_size fingerprints, forgetting the least recently used ones
+    first.
+    """
+    def __init__(self, ttl_secs=None, max_size=1000):
+        self.ttl_secs = ttl_secs
+        self.max_size = max_size
+        self.num_suppressed = 0
+        self._lock = threading.Lock()
+        # fingerprint -> [time we last paged, #pages suppressed since then]
+        self._recent = collections.OrderedDict()
+
+    @staticmethod
+    def fingerprint(email_addresses, alert):
+        summary = alert._get_summary()
+        if summary:
+            incident = ' '.join(summary.lower().split())
+        else:
+            incident = hashlib.sha1(alert._get_utf8_message()).hexdigest()
+        return (tuple(sorted(email_addresses)), incident)
+
+    def check(self, key):
+        """Return None to suppress a page, else #pages suppressed before it.
+
+        key is the page's fingerprint().  If we don't suppress it, we
+        note the page as sent right away; call failed() if it isn't.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._recent.pop(key, None)
+            if entry is not None and now - entry[0] < self.ttl_secs:
+                self._recent[key] = entry     # now most recently used
+                entry[1] += 1
+                self.num_suppressed += 1
+                return None
+            self._recent[key] = [now, 0]
+            if len(self._recent) > self.max_size:
+                self._recent.popitem(last=False)
+            return entry[1] if entry is not None else 0
+
+    def failed(self, key, num_suppressed):
+        """Note the page check() let through for key didn't get sent.
+
+        num_suppressed is what check() returned for it; the next page
+        for key will say those weren't sent either.
+        """
+        with self._lock:
+            entry = self._recent.get(key)
+            if entry is not None:
+                entry[0] = 0              # so the next page gets through
+                entry[1] += num_suppressed
+
+
+_PAGERDUTY_DEDUPER = _PagerDutyDeduper()
+
+
+def enable_pagerduty_dedup(ttl_secs=300, max_size=1000):
+    """Suppress repeat pages for the same incident within ttl_secs.
+
+    See _PagerDutyDeduper for what counts as the same incident.
+    """
+    global _PAGERDUTY_DEDUPER
+    _PAGERDUTY_DEDUPER = _PagerDutyDeduper(ttl_secs, max_size)
+
+
+def disable_pagerduty_dedup():
+    """Stop suppressing repeat pages, and forget the pages we've sent."""
+    global _PAGERDUTY_DEDUPER
+    _PAGERDUTY_DEDUPER = _PagerDutyDeduper()
+
+
+def pagerduty_stats():
+    """Return a dict with how many pages we have suppressed as duplicates."""
+    return {'suppressed': _PAGERDUTY_DEDUPER.num_suppressed}
+
+
+class _GraphiteConnection(object):
+    """A TCP connection to graphite that survives graphite going away.
+
+    send() never raises: whatever we're given goes on the end of a
+    backlog, and we write out as much of the backlog as we can.  If a
+    write fails, we drop the connection and keep the unsent data
+    around, to replay once we reconnect.  We wait before reconnecting
+    (1 second, then 2, then 4, ..., up to max_backoff_secs) so a
+    graphite outage doesn't turn every send into a slow connect().
+
+    The backlog holds at most max_backlog_bytes; past that, we drop
+    the oldest data and count it in num_dropped_bytes.  Data is only
+    ever dropped whole, so a half-written line never reaches graphite.
+
+    send() can be told where the lines (or pickle frames) in its data
+    end.  If a write fails part-way through, we only resend the lines
+    that didn't make it out whole, so graphite never sees a line
+    twice: the line we were in the middle of is resent in full on the
+    new connection (carbon discards the partial copy it got on the
+    old one), followed by the rest.
+
+    We also reconnect every reconnect_secs, in case the DNS entry has
+    changed; that way we lose at most that much time's worth of data.
+
+    send() is thread-safe: only one thread writes to the socket at a
+    time, so lines from different threads never interleave.
+    """
+    def __init__(self, graphite_hostport, max_backlog_bytes=1024 * 1024,
+                 max_backoff_secs=60, reconnect_secs=600, timeout=5):
+        self.graphite_hostport = graphite_hostport
+        self.max_backlog_bytes = max_backlog_bytes
+        self.max_backoff_secs = max_backoff_secs
+        self.reconnect_secs = reconnect_secs
+        self.timeout = timeout
+        self.num_dropped_bytes = 0
+        self.num_connects = 0
+        self._socket = None
+        self._connect_time = None
+        self._backlog = collections.deque()    # of strings to write
+        self._backlog_bytes = 0
+        self._backoff_secs = 1
+        self._next_connect_time = 0
+        self._lock = threading.Lock()
+
+    def send(self, data, unit_ends=None):
+        """Send data; unit_ends are where each line (or frame) in it ends.
+
+        If unit_ends is None, data is a single line.  Returns True if
+        we wrote out the whole backlog, or False if some of it (maybe
+        including data) is still waiting for graphite to come back.
+        """
+        if unit_ends is None:
+            unit_ends = [len(data)]
+        with self._lock:
+            self._backlog.append((data, unit_ends))
+            self._backlog_bytes += len(data)
+            while self._backlog_bytes > self.max_backlog_bytes:
+                (dropped, _) = self._backlog.popleft()
+                self._backlog_bytes -= len(dropped)
+                self.num_dropped_bytes += len(dropped)
+            self._write_backlog()
+            return not self._backlog
+
+    def _connect(self):
+        (hostname, port_string) = self.graphite_hostport.split(':')
+        self._socket = _create_connection((hostname, int(port_string)),
+                                          self.timeout)
+        self._connect_time = time.time()
+
+    def _disconnect(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except socket.error:
+                pass
+            self._socket = None
+
+    def _write_backlog(self):
+        now = time.time()
+        if self._socket is None and now < self._next_connect_time:
+            return        # we're backing off; keep it in the backlog
+        try:
+            if (self._socket is not None and
+                    now - self._connect_time > self.reconnect_secs):
+                self._disconnect()
+            if self._socket is None:
+                self._connect()
+                self.num_connects += 1
+            while self._backlog:
+                self._write_chunk()
+            self._backoff_secs = 1
+        except (socket.error, EnvironmentError), why:
+            self._disconnect()
+            self._next_connect_time = now + self._backoff_secs
+            logging.warning('Failed sending to graphite at %s (retrying in '
+                            '%ss, %s bytes waiting): %s',
+                            self.graphite_hostport, self._backoff_secs,
+                            self._backlog_bytes, why)
+            self._backoff_secs = min(self._backoff_secs * 2,
+                                     self.max_backoff_secs)
+
+    def _write_chunk(self):
+        """Write out the oldest chunk in the backlog, and drop it.
+
+        If we fail part-way through, we drop just the lines we wrote in
+        full, and re-raise.
+        """
+        (data, unit_ends) = self._backlog[0]
+        num_written = 0
+        try:
+            while num_written < len(data):
+                num_written += self._socket.send(buffer(data, num_written))
+        except (socket.error, EnvironmentError):
+            num_done = bisect.bisect_right(unit_ends, num_written)
+            if num_done:
+                num_bytes_done = unit_ends[num_done - 1]
+                self._backlog[0] = (data[num_bytes_done:],
+                                    [end - num_bytes_done
+                                     for end in unit_ends[num_done:]])
+                self._backlog_bytes -= num_bytes_done
+            raise
+        self._backlog.popleft()
+        self._backlog_bytes -= len(data)
+
+    def flush(self):
+        """Try to write out the backlog, unless we're backing off.
+
+        Returns True if the backlog is now empty.
+        """
+        with self._lock:
+            if self._backlog:
+                self._write_backlog()
+            return not self._backlog
+
+    def drop_backlog(self):
+        """Give up on the backlog, counting it in num_dropped_bytes."""
+        with self._lock:
+            num_bytes = self._backlog_bytes
+            self.num_dropped_bytes += num_bytes
+            self._backlog.clear()
+            self._backlog_bytes = 0
+            return num_bytes
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+
+def _join_units(units):
+    """Return (''.join(units), the offset in that where each unit ends)."""
+    unit_ends = []
+    end = 0
+    for unit in units:
+        end += len(unit)
+        unit_ends.append(end)
+    return (''.join(units), unit_ends)
+
+
+_GRAPHITE_CONNECTIONS_LOCK = threading.Lock()
+_GRAPHITE_CONNECTIONS = {}     # host:port -> _GraphiteConnection
+_GRAPHITE_CONNECTIONS_PID = os.getpid()    # the process that made them
+
+
 def _graphite_socket(graphite_hostport):
-    """Return a socket to graphite, creating a new one every 10 minutes.
+    """Return the connection to graphite at graphite_hostport.
+
+    graphite_hostport is, for instance 'carbon.hostedgraphite.com:2003'.
+    This is for talking the TCP protocol (to mark failures, we want to
+    be more reliable than UDP!)  The connection has a send() method
+    that takes care of reconnecting: see _GraphiteConnection.
+
+    If we've forked since the connections were made, we start over
+    with new ones: the child shouldn't write to its parent's sockets,
+    or resend its parent's backlog.
+    """
+    global _GRAPHITE_CONNECTIONS, _GRAPHITE_CONNECTIONS_LOCK
+    global _GRAPHITE_CONNECTIONS_PID
+    if _GRAPHITE_CONNECTIONS_PID != os.getpid():
+        # Some other thread may have held the lock when we forked.
+        _GRAPHITE_CONNECTIONS_LOCK = threading.Lock()
+        for connection in _GRAPHITE_CONNECTIONS.itervalues():
+            # This only closes our copy of the parent's socket.
+            connection._disconnect()
+        _GRAPHITE_CONNECTIONS = {}
+        _GRAPHITE_CONNECTIONS_PID = os.getpid()
+
+    with _GRAPHITE_CONNECTIONS_LOCK:
+        if graphite_hostport not in _GRAPHITE_CONNECTIONS:
+            _GRAPHITE_CONNECTIONS[graphite_hostport] = _GraphiteConnection(
+                graphite_hostport)
+        return _GRAPHITE_CONNECTIONS[graphite_hostport]
+
+
+def _graphite_connections():
+    """Return this process's connections to graphite.
+
+    A forked child has none until it makes its own.
+    """
+    if _GRAPHITE_CONNECTIONS_PID != os.getpid():
+        return []
+    with _GRAPHITE_CONNECTIONS_LOCK:
+        return _GRAPHITE_CONNECTIONS.values()
+
 
-    We re-create every 10 minutes in case the DNS entry has changed; that
-    way we lose at most 10 minutes' worth of data.  graphite_hostport
-    is, for instance 'carbon.hostedgraphite.com:2003'.  This should be
-    for talking the TCP protocol (to mark failures, we want to be more
-    reliable than UDP!)
+def _drop_graphite_backlogs_at_exit():
+    """Make one last try at graphite, then count what's left as dropped.
+
+    This runs after flush_graphite(), so the backlogs include
+    everything our senders were holding on to.
     """
-    global _GRAPHITE_SOCKET, _LAST_GRAPHITE_TIME
-    if _GRAPHITE_SOCKET is None or time.time() - _LAST_GRAPHITE_TIME > 600:
-        if _GRAPHITE_SOCKET:
-            _GRAPHITE_SOCKET.close()
-        (hostname, port_string) = graphite_hostport.split(':')
-        host_ip = socket.gethostbyname(hostname)
-        port = int(port_string)
-        _GRAPHITE_SOCKET = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        _GRAPHITE_SOCKET.connect((host_ip, port))
-        _LAST_GRAPHITE_TIME = time.time()
+    for connection in _graphite_connections():
+        if not connection.flush():
+            logging.warning('Dropping %s bytes for graphite at %s at exit',
+                            connection.drop_backlog(),
+                            connection.graphite_hostport)
+
+
+# atexit functions run last-registered-first, so this comes after
+# flush_graphite(), below.
+atexit.register(_drop_graphite_backlogs_at_exit)
+
+
+def graphite_stats():
+    """Return counts of graphite data we dropped, or are holding on to."""
+    with _GRAPHITE_CONNECTIONS_LOCK:
+        connections = _GRAPHITE_CONNECTIONS.values()
+    statsd_sender = _GRAPHITE_SENDERS.get('statsd')
+    return {
+        'connects': sum(c.num_connects for c in connections),
+        'backlog_bytes': sum(c._backlog_bytes for c in connections),
+        'dropped_bytes': sum(c.num_dropped_bytes for c in connections),
+        'dropped_statsd_packets': (statsd_sender.num_dropped
+                                   if statsd_sender else 0),
+    }
+
+
+def _format_graphite_value(value):
+    # If the value is 12.0, send it as 12, not 12.0
+    if int(value) == value:
+        return int(value)
+    return value
+
+
+def _graphite_path(statistic):
+    if isinstance(statistic, unicode):
+        statistic = statistic.encode('utf-8')
+    return '%s.%s' % (hostedgraphite_api_key, statistic)
+
+
+def _unsampled_value(value, metric_type, sample_rate):
+    """Scale up a sampled counter, for protocols that don't do it for us."""
+    if metric_type == 'counter' and sample_rate < 1:
+        return _format_graphite_value(value / float(sample_rate))
+    return value
+
+
+def _send_graphite_metrics(graphite_host, metrics, metric_type='counter',
+                           sample_rate=1, protocol=None):
+    """Send a list of (statistic, value, timestamp) tuples to graphite.
+
+    timestamp may be None, meaning 'now'.  If protocol is None, we use
+    whatever protocol was set via set_graphite_protocol().  Returns
+    'sent', or 'queued' if the protocol batches updates or graphite is
+    unreachable for now; raises DeliveryError if we couldn't send them.
+    """
+    return _graphite_sender(protocol).send(graphite_host, metrics,
+                                           metric_type, sample_rate)
+
+
+class _GraphitePlaintextSender(object):
+    """Send to graphite using carbon's plaintext protocol, one line each.
+
+    We write all the lines we're given at once, but don't batch beyond
+    that.  Lines that graphite wasn't around for wait in the
+    connection's backlog; flush() retries them, unless we're backing
+    off.
+    """
+    def send(self, graphite_host, metrics, metric_type, sample_rate):
+        """Return 'sent', or 'queued' if graphite is unreachable for now.
+
+        In that case the lines wait in the connection's backlog, to be
+        sent once we can reconnect.
+        """
+        (lines, line_ends) = _join_units([
+            '%s %s%s\n' % (_graphite_path(statistic),
+                           _format_graphite_value(
+                               _unsampled_value(value, metric_type,
+                                                sample_rate)),
+                           '' if timestamp is None else ' %d' % timestamp)
+            for (statistic, value, timestamp) in metrics])
+        if _graphite_socket(graphite_host).send(lines, line_ends):
+            return 'sent'
+        return 'queued'
+
+    def flush(self):
+        for connection in _graphite_connections():
+            connection.flush()
+
+    def stop(self):
+        pass
+
+
+class _GraphitePickleSender(_ForkAware):
+    """Send to graphite using carbon's pickle protocol, in batches.
+
+    We hold on to metrics until we have max_batch_size of them for
+    some host, or until flush_interval_secs has passed, then send
+    them as a pickled list of (path, (timestamp, value)) tuples,
+    prefixed with its length.  That is a lot cheaper for carbon to
+    ingest than the same metrics one line at a time.
+
+    If we're asked to send to the default (plaintext) graphite host,
+    we send to its pickle port instead.
+
+    A forked child starts out with no pending metrics.
+    """
+    DEFAULT_HOST = 'carbon.hostedgraphite.com:2004'
+
+    def __init__(self, max_batch_size=500, flush_interval_secs=1):
+        self.max_batch_size = max_batch_size
+        self.flush_interval_secs = flush_interval_secs
+        self._lock = threading.Lock()
+        self._pending = {}     # host -> list of (path, (timestamp, value))
+        self._pid = os.getpid()
+        self._start_flushing()
+
+    def _start_flushing(self):
+        self._stop_flushing = _start_flush_thread(
+            self.flush_interval_secs, self.flush, 'alertlib-graphite-pickle')
+
+    def _reset_after_fork(self):
+        self._pending = {}
+        self._start_flushing()
+
+    def send(self, graphite_host, metrics, metric_type, sample_rate):
+        self._check_for_fork()
+        if graphite_host == Alert.DEFAULT_GRAPHITE_HOST:
+            graphite_host = self.DEFAULT_HOST
+        now = int(time.time())
+        batch = None
+        with self._lock:
+            pending = self._pending.setdefault(graphite_host, [])
+            pending.extend(
+                (_graphite_path(statistic),
+                 (now if timestamp is None else timestamp,
+                  _format_graphite_value(
+                      _unsampled_value(value, metric_type, sample_rate))))
+                for (statistic, value, timestamp) in metrics)
+            if len(pending) >= self.max_batch_size:
+                batch = self._pending.pop(graphite_host)
+        if batch:
+            self._write(graphite_host, batch)
+        return 'queued'
+
+    def _write(self, graphite_host, metrics):
+        frames = []
+        for i in xrange(0, len(metrics), self.max_batch_size):
+            payload = cPickle.dumps(metrics[i:i + self.max_batch_size],
+                                    protocol=2)
+            frames.append(struct.pack('!L', len(payload)) + payload)
+        try:
+            _graphite_socket(graphite_host).send(*_join_units(frames))
+        except Exception, why:
+            # Most of these metrics are from earlier sends, so we just
+            # log it.
+            logging.error('Failed sending to graphite: %s' % why)
+
+    def flush(self):
+        self._check_for_fork()
+        with self._lock:
+            (pending, self._pending) = (self._pending, {})
+        for (graphite_host, metrics) in pending.iteritems():
+            self._write(graphite_host, metrics)
+
+    def stop(self):
+        self._stop_flushing.set()
+        self.flush()
+
+
+class _GraphiteStatsdSender(_ForkAware):
+    """Send to a statsd server over UDP, fire-and-forget.
+
+    We never block on the network: the socket is non-blocking, and if
+    the kernel won't take a packet right away, we drop it (and count
+    it in num_dropped).  We pack as many metrics into each packet as
+    fit in max_packet_size bytes -- 512 is safe on the internet, you
+    can go up to about 1432 on a LAN -- and send a packet once it's
+    full, or flush_interval_secs after the first metric went into it.
+
+    If we're asked to send to the default (plaintext) graphite host,
+    we send to hostedgraphite's statsd server instead.
+
+    A forked child starts out with its own socket, and no pending
+    packets.
+    """
+    DEFAULT_HOST = 'statsd.hostedgraphite.com:8125'
+
+    _METRIC_TYPE_TO_STATSD_TYPE = {
+        'counter': 'c',
+        'gauge': 'g',
+        'timer': 'ms',
+        }
+
+    def __init__(self, max_packet_size=512, flush_interval_secs=1):
+        self.max_packet_size = max_packet_size
+        self.flush_interval_secs = flush_interval_secs
+        self.num_dropped = 0
+        self._lock = threading.Lock()
+        self._socket = None
+        self._pending = {}     # host -> list of lines for the next packet
+        self._pending_sizes = {}      # host -> #bytes in the next packet
+        self._pid = os.getpid()
+        self._start_flushing()
+
+    def _start_flushing(self):
+        self._stop_flushing = _start_flush_thread(
+            self.flush_interval_secs, self.flush, 'alertlib-graphite-statsd')
+
+    def _reset_after_fork(self):
+        if self._socket is not None:
+            # This only closes our copy of the parent's socket.
+            self._socket.close()
+            self._socket = None
+        self._pending = {}
+        self._pending_sizes = {}
+        self._start_flushing()
+
+    def send(self, graphite_host, metrics, metric_type, sample_rate):
+        self._check_for_fork()
+        if graphite_host == Alert.DEFAULT_GRAPHITE_HOST:
+            graphite_host = self.DEFAULT_HOST
+        suffix = '|' + self._METRIC_TYPE_TO_STATSD_TYPE[metric_type]
+        if sample_rate < 1:
+            suffix += '|@%s' % sample_rate
+
+        full_packets = []
+        with self._lock:
+            lines = self._pending.setdefault(graphite_host, [])
+            size = self._pending_sizes.get(graphite_host, 0)
+            for (statistic, value, _) in metrics:
+                line = '%s:%s%s' % (_graphite_path(statistic),
+                                    _format_graphite_value(value), suffix)
+                if lines and size + 1 + len(line) > self.max_packet_size:
+                    full_packets.append('\n'.join(lines))
+                    lines = self._pending[graphite_host] = []
+                    size = 0
+                size += len(line) + (1 if lines else 0)
+                lines.append(line)
+            self._pending_sizes[graphite_host] = size
+
+        for packet in full_packets:
+            self._write(graphite_host, packet)
+        return 'queued'
+
+    def _address(self, graphite_host):
+        (hostname, port_string) = graphite_host.split(':')
+        return (_DNS_CACHE.resolve(hostname), int(port_string))
+
+    def _write(self, graphite_host, packet):
+        try:
+            # We look up the address before taking the lock, so other
+            # threads don't wait on DNS.
+            address = self._address(graphite_host)
+            with self._lock:
+                if self._socket is None:
+                    self._socket = socket.socket(socket.AF_INET,
+                                                 socket.SOCK_DGRAM)
+                    self._socket.setblocking(False)
+                self._socket.sendto(packet, address)
+        except socket.error:
+            with self._lock:
+                self.num_dropped += 1
+
+    def flush(self):
+        self._check_for_fork()
+        with self._lock:
+            (pending, self._pending) = (self._pending, {})
+            self._pending_sizes = {}
+        for (graphite_host, lines) in pending.iteritems():
+            if lines:
+                self._write(graphite_host, '\n'.join(lines))
+
+    def stop(self):
+        self._stop_flushing.set()
+        self.flush()
+        with self._lock:
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+
+
+_GRAPHITE_SENDER_CLASSES = {
+    'plaintext': _GraphitePlaintextSender,
+    'pickle': _GraphitePickleSender,
+    'statsd': _GraphiteStatsdSender,
+}
+
+# The protocol send_to_graphite() uses unless told otherwise.
+_GRAPHITE_PROTOCOL = 'plaintext'
+
+_GRAPHITE_SENDERS_LOCK = threading.Lock()
+_GRAPHITE_SENDERS = {}     # protocol -> sender for that protocol
+
+
+def _graphite_sender(protocol=None):
+    """Return the sender for the given protocol, creating it if need be."""
+    protocol = protocol or _GRAPHITE_PROTOCOL
+    with _GRAPHITE_SENDERS_LOCK:
+        if protocol not in _GRAPHITE_SENDERS:
+            if protocol not in _GRAPHITE_SENDER_CLASSES:
+                raise ValueError('Unknown graphite protocol %s' % protocol)
+            _GRAPHITE_SENDERS[protocol] = _GRAPHITE_SENDER_CLASSES[protocol]()
+        return _GRAPHITE_SENDERS[protocol]
+
+
+def set_graphite_protocol(protocol, **options):
+    """Choose how send_to_graphite() talks to graphite by default.
+
+    protocol is one of:
+       'plaintext': the default; a TCP connection and one line per update.
+       'pickle': batched, over TCP; see _GraphitePickleSender for options.
+       'statsd': batched, over UDP; see _GraphiteStatsdSender for options.
+    You can also choose the protocol for each send_to_graphite() call.
+    """
+    global _GRAPHITE_PROTOCOL
+    if protocol not in _GRAPHITE_SENDER_CLASSES:
+        raise ValueError('Unknown graphite protocol %s' % protocol)
+    with _GRAPHITE_SENDERS_LOCK:
+        old_sender = _GRAPHITE_SENDERS.get(protocol)
+        _GRAPHITE_SENDERS[protocol] = _GRAPHITE_SENDER_CLASSES[protocol](
+            **options)
+        _GRAPHITE_PROTOCOL = protocol
+    if old_sender:
+        old_sender.stop()
+
+
+_FLUSH_THREADS = []     # (stop event, thread) for _start_flush_thread()
 
-    return _GRAPHITE_SOCKET
+
+def _start_flush_thread(interval_secs, flush_fn, name):
+    """Call flush_fn() every interval_secs, from a daemon thread.
+
+    Returns a threading.Event; set it to stop the thread.
+    """
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval_secs):
+            try:
+                flush_fn()
+            except Exception, why:
+                logging.error('%s failed: %s' % (name, why))
+
+    thread = threading.Thread(target=run, name=name)
+    thread.daemon = True
+    thread.start()
+    _FLUSH_THREADS[:] = [(e, t) for (e, t) in _FLUSH_THREADS if t.is_alive()]
+    _FLUSH_THREADS.append((stop, thread))
+    return stop
+
+
+def _stop_flush_threads():
+    """Stop all our flush threads, so they're gone before python is.
+
+    Otherwise a flush thread can wake up while the interpreter is
+    being torn down, and die noisily.  Whoever owns a thread is
+    responsible for doing its final flush (at exit, say).
+    """
+    for (stop, _) in _FLUSH_THREADS:
+        stop.set()
+    for (_, thread) in _FLUSH_THREADS:
+        thread.join(1)
+
+
+atexit.register(_stop_flush_threads)
+
+
+class _GraphiteAggregator(_ForkAware):
+    """Combine graphite updates in memory, and send them periodically.
+
+    We add up all the values sent for a counter, and keep only the
+    last value sent for a gauge.  Every flush_interval_secs, we send
+    one update per statistic, with one write per graphite host (and
+    protocol).
+
+    A forked child starts out with nothing aggregated.
+    """
+    def __init__(self):
+        self.flush_interval_secs = None      # None means we're not enabled
+        self._lock = threading.Lock()
+        # (host, protocol, metric_type, statistic) -> value
+        self._metrics = {}
+        self._stop_flushing = None
+        self._pid = os.getpid()
+
+    def _reset_after_fork(self):
+        self._metrics = {}
+        if self.flush_interval_secs:
+            self._start_flushing()
+
+    def _start_flushing(self):
+        self._stop_flushing = _start_flush_thread(
+            self.flush_interval_secs, self.flush,
+            'alertlib-graphite-aggregator')
+
+    def start(self, flush_interval_secs):
+        self.stop()
+        self.flush_interval_secs = flush_interval_secs
+        self._start_flushing()
+
+    def stop(self):
+        self.flush_interval_secs = None
+        if self._stop_flushing:
+            self._stop_flushing.set()
+            self._stop_flushing = None
+        self.flush()
+
+    def add(self, graphite_host, protocol, statistic, value, metric_type):
+        self._check_for_fork()
+        key = (graphite_host, protocol, metric_type, statistic)
+        with self._lock:
+            if metric_type == 'counter':
+                self._metrics[key] = self._metrics.get(key, 0) + value
+            else:
+                self._metrics[key] = value
+
+    def flush(self):
+        self._check_for_fork()
+        with self._lock:
+            (metrics, self._metrics) = (self._metrics, {})
+        metrics_by_destination = {}
+        for ((graphite_host, protocol, metric_type, statistic), value) in (
+                metrics.iteritems()):
+            metrics_by_destination.setdefault(
+                (graphite_host, protocol, metric_type), []).append(
+                    (statistic, value, None))
+        for ((graphite_host, protocol, metric_type), destination_metrics) in (
+                sorted(metrics_by_destination.iteritems())):
+            try:
+                _send_graphite_metrics(graphite_host,
+                                       sorted(destination_metrics),
+                                       metric_type, protocol=protocol)
+            except DeliveryError, why:
+                logging.error(str(why))
+
+
+_GRAPHITE_AGGREGATOR = _GraphiteAggregator()
+
+
+def enable_graphite_aggregation(flush_interval_secs=10):
+    """Combine send_to_graphite() calls, sending every flush_interval_secs.
+
+    This way, incrementing a counter in a hot loop costs us one network
+    write per flush, rather than one per increment.  Counters are
+    summed; gauges (see send_to_graphite()) keep their last value.
+    Timers are not aggregated.
+    """
+    _GRAPHITE_AGGREGATOR.start(flush_interval_secs)
+
+
+def disable_graphite_aggregation():
+    """Send what we've aggregated, and go back to sending right away."""
+    _GRAPHITE_AGGREGATOR.stop()
+
+
+# numpy, which we use to speed up graphite histograms if it's around.
+# It's slow to import, so we don't until we need it; None means we
+# haven't tried yet, and False that we don't have it.
+_NUMPY = None
+
+
+def _percentiles(samples, percentiles):
+    """Return the given percentiles (0-100) of samples, an array('d').
+
+    We interpolate between the two nearest samples, as numpy does.
+    """
+    global _NUMPY
+    if _NUMPY is None:
+        try:
+            import numpy
+            _NUMPY = numpy
+        except ImportError:
+            _NUMPY = False
+    if _NUMPY:
+        return [float(v) for v in
+                _NUMPY.percentile(_NUMPY.frombuffer(samples), percentiles)]
+
+    samples = sorted(samples)
+    retval = []
+    for percentile in percentiles:
+        rank = (len(samples) - 1) * percentile / 100.0
+        below = int(rank)
+        above = min(below + 1, len(samples) - 1)
+        retval.append(samples[below] +
+                      (samples[above] - samples[below]) * (rank - below))
+    return retval
+
+
+class _GraphiteHistogram(object):
+    """The samples recorded for one statistic since the last flush.
+
+    We keep at most max_samples of them, in an array we allocate once
+    and reuse across flushes.  Past that, we keep a uniformly random
+    subset of the samples (reservoir sampling), so the percentiles
+    stay honest.  count, sum, min and max are exact regardless.
+    """
+    __slots__ = ('samples', 'num_stored', 'count', 'total', 'min', 'max')
+
+    def __init__(self, max_samples):
+        self.samples = array.array('d', [0.0]) * max_samples
+        self.reset()
+
+    def reset(self):
+        self.num_stored = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.num_stored < len(self.samples):
+            self.samples[self.num_stored] = value
+            self.num_stored += 1
+        else:
+            i = random.randrange(self.count)
+            if i < len(self.samples):
+                self.samples[i] = value
+
+
+class _GraphiteHistograms(_ForkAware):
+    """Summarize samples in memory, and send the summaries periodically.
+
+    Every flush_interval_secs, for each statistic that got samples, we
+    send statistic.count, .sum, .min, .max and .mean, plus .p50, .p90
+    and so forth for the given percentiles, as gauges.
+
+    A forked child starts out with no samples.
+    """
+    def __init__(self, flush_interval_secs=10, percentiles=(50, 90, 99),
+                 max_samples=1024):
+        self.flush_interval_secs = flush_interval_secs
+        self.percentiles = percentiles
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        # (host, protocol, statistic) -> _GraphiteHistogram
+        self._histograms = {}
+        self._stop_flushing = None
+        self._pid = os.getpid()
+
+    def _reset_after_fork(self):
+        self._histograms = {}
+        self._stop_flushing = None      # so add() starts a new thread
+
+    def add(self, graphite_host, protocol, statistic, value):
+        self._check_for_fork()
+        with self._lock:
+            if self._stop_flushing is None:
+                self._stop_flushing = _start_flush_thread(
+                    self.flush_interval_secs, self.flush,
+                    'alertlib-graphite-histograms')
+            key = (graphite_host, protocol, statistic)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _GraphiteHistogram(
+                    self.max_samples)
+            histogram.add(value)
+
+    def stop(self):
+        with self._lock:
+            if self._stop_flushing:
+                self._stop_flushing.set()
+                self._stop_flushing = None
+        self.flush()
+
+    def flush(self):
+        self._check_for_fork()
+        # We copy the samples out while holding the lock, but do the
+        # (slower) math and sending without it.
+        summaries = []
+        with self._lock:
+            for (key, histogram) in self._histograms.items():
+                if not histogram.count:
+                    del self._histograms[key]   # not in use anymore
+                    continue
+                summaries.append(
+                    (key, histogram.count, histogram.total, histogram.min,
+                     histogram.max,
+                     histogram.samples[:histogram.num_stored]))
+                histogram.reset()
+
+        metrics_by_destination = {}
+        for ((graphite_host, protocol, statistic), count, total, min_value,
+             max_value, samples) in summaries:
+            metrics = [('count', count),
+                       ('sum', total),
+                       ('min', min_value),
+                       ('max', max_value),
+                       ('mean', total / count)]
+            metrics.extend(
+                ('p%s' % str(percentile).replace('.', '_'), value)
+                for (percentile, value)
+                in zip(self.percentiles,
+                       _percentiles(samples, self.percentiles)))
+            metrics_by_destination.setdefault(
+                (graphite_host, protocol), []).extend(
+                    ('%s.%s' % (statistic, name),
+                     _format_graphite_value(value), None)
+                    for (name, value) in metrics)
+        for ((graphite_host, protocol), metrics) in (
+                sorted(metrics_by_destination.iteritems())):
+            try:
+                _send_graphite_metrics(graphite_host, sorted(metrics),
+                                       'gauge', protocol=protocol)
+            except DeliveryError, why:
+                logging.error(str(why))
+
+
+_GRAPHITE_HISTOGRAMS = _GraphiteHistograms()
+
+
+def configure_graphite_histograms(**kwargs):
+    """Change how send_to_graphite_histogram() summarizes samples.
+
+    See _GraphiteHistograms for the options.  Samples recorded under
+    the old configuration are sent right away.
+    """
+    global _GRAPHITE_HISTOGRAMS
+    (old_histograms, _GRAPHITE_HISTOGRAMS) = (_GRAPHITE_HISTOGRAMS,
+                                              _GraphiteHistograms(**kwargs))
+    old_histograms.stop()
+
+
+def flush_graphite():
+    """Send anything we're holding on to for graphite right now."""
+    _GRAPHITE_AGGREGATOR.flush()
+    _GRAPHITE_HISTOGRAMS.flush()
+    with _GRAPHITE_SENDERS_LOCK:
+        senders = _GRAPHITE_SENDERS.values()
+    for sender in senders:
+        sender.flush()
+
+
+atexit.register(flush_graphite)
+
+
+class _SyslogEmitter(object):
+    """Write RFC 5424 syslog messages straight to a syslog socket.
+
+    address is either the path to a unix socket (usually '/dev/log'),
+    or a 'host:port' for a remote syslog server, which we talk to over
+    'udp' or 'tcp' (as given by protocol).  We open the socket once,
+    right away if nodelay is true (as with syslog's LOG_NDELAY), else
+    when we first need it, and reopen it only if a write fails.  ident
+    and facility are as for syslog.openlog().
+
+    If buffered is true, we don't write each message as it comes in.
+    Instead we collect them, and write them out every
+    flush_interval_secs, or as soon as we have max_buffer_bytes of
+    them.  Over a stream socket (tcp, or some /dev/log's) that's a
+    single write for the whole burst; over a datagram socket each
+    message still needs its own datagram, but at least the caller
+    doesn't wait for them.
+    """
+    def __init__(self, address='/dev/log', protocol='udp', ident=None,
+                 facility=None, nodelay=True, buffered=False,
+                 flush_interval_secs=1, max_buffer_bytes=64 * 1024):
+        if protocol not in ('udp', 'tcp'):
+            raise ValueError('Unknown syslog protocol %s' % protocol)
+        self.address = address
+        self.protocol = protocol
+        self.ident = ident or os.path.basename(sys.argv[0]) or 'python'
+        self.facility = syslog.LOG_USER if facility is None else facility
+        self.max_buffer_bytes = max_buffer_bytes
+        self.num_dropped = 0
+        self._hostname = socket.gethostname() or '-'
+        self._lock = threading.Lock()
+        self._socket = None
+        self._is_stream = None
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._stop_flushing = None
+        if nodelay:
+            with self._lock:
+                try:
+                    self._connect()
+                except socket.error, why:
+                    logging.warning('Cannot connect to syslog at %s: %s',
+                                    self.address, why)
+        if buffered:
+            self._stop_flushing = _start_flush_thread(
+                flush_interval_secs, self.flush, 'alertlib-syslog')
+
+    def _connect(self):
+        if self.address.startswith('/'):
+            # /dev/log is a datagram socket on most systems, but not all.
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                sock.connect(self.address)
+                self._is_stream = False
+            except socket.error:
+                sock.close()
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.address)
+                self._is_stream = True
+        else:
+            (hostname, port_string) = self.address.rsplit(':', 1)
+            if self.protocol == 'tcp':
+                sock = _create_connection((hostname, int(port_string)))
+                self._is_stream = True
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.connect((_DNS_CACHE.resolve(hostname),
+                              int(port_string)))
+                self._is_stream = False
+        self._socket = sock
+
+    def _disconnect(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def format(self, priority, message, now=None):
+        """Return an RFC 5424 syslog message (as a utf-8 string)."""
+        if now is None:
+            now = time.time()
+        timestamp = '%s.%06dZ' % (
+            time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now)),
+            int(now % 1 * 1000000))
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        # The BOM says the message is utf-8; we don't use MSGID or
+        # STRUCTURED-DATA, hence the dashes.
+        return '<%d>1 %s %s %s %d - - \xef\xbb\xbf%s' % (
+            self.facility | priority, timestamp, self._hostname,
+            self.ident, os.getpid(), message)
+
+    def emit(self, priority, message):
+        frame = self.format(priority, message)
+        with self._lock:
+            self._buffer.append(frame)
+            self._buffer_bytes += len(frame)
+            if (self._stop_flushing is None or
+                    self._buffer_bytes >= self.max_buffer_bytes):
+                self._write_buffer()
+
+    def _write_buffer(self):
+        """Write out the buffered frames.  Call with self._lock held."""
+        (frames, self._buffer, self._buffer_bytes) = (self._buffer, [], 0)
+        for attempt in (1, 2):
+            try:
+                if self._socket is None:
+                    self._connect()
+                if self._is_stream:
+                    # RFC 6587 octet-counting: each frame is prefixed
+                    # with its length, so we can send them all at once.
+                    self._socket.sendall(''.join('%d %s' % (len(f), f)
+                                                 for f in frames))
+                else:
+                    while frames:
+                        self._socket.send(frames[0])
+                        frames.pop(0)
+                return
+            except socket.error, why:
+                self._disconnect()
+        self.num_dropped += len(frames)
+        logging.warning('Failed sending %s messages to syslog at %s: %s',
+                        len(frames), self.address, why)
+
+    def flush(self):
+        with self._lock:
+            if self._buffer:
+                self._write_buffer()
+
+    def close(self):
+        if self._stop_flushing:
+            self._stop_flushing.set()
+        self.flush()
+        with self._lock:
+            self._disconnect()
+
+
+# If set, send_to_logs() uses this rather than syslog.syslog().
+_SYSLOG_EMITTER = None
+
+
+def enable_direct_syslog(address='/dev/log', **kwargs):
+    """Have send_to_logs() write to syslog's socket itself.
+
+    By default, send_to_logs() uses syslog.syslog(), with whatever
+    ident and facility the process has (and a lazy connect).  This
+    instead writes RFC 5424 messages to the syslog socket at address
+    -- see _SyslogEmitter for that and the other options, such as
+    ident, facility, and buffered.
+    """
+    global _SYSLOG_EMITTER
+    (old_emitter, _SYSLOG_EMITTER) = (_SYSLOG_EMITTER,
+                                      _SyslogEmitter(address, **kwargs))
+    if old_emitter:
+        old_emitter.close()
+
+
+def disable_direct_syslog():
+    """Go back to sending to syslog via syslog.syslog()."""
+    global _SYSLOG_EMITTER
+    (old_emitter, _SYSLOG_EMITTER) = (_SYSLOG_EMITTER, None)
+    if old_emitter:
+        old_emitter.close()
+
+
+def flush_syslog():
+    """Write out any buffered syslog messages right now."""
+    emitter = _SYSLOG_EMITTER
+    if emitter:
+        emitter.flush()
+
+
+atexit.register(flush_syslog)
+
+
+class _RateLimitPolicy(object):
+    """How often an alert may be sent; see Alert(rate_limit=...).
+
+    This is an abstract base class: subclasses must define both
+    new_state() and check().  Each policy keeps its state for a given
+    alert in a small list of fixed size, which must be json-able (so
+    _SQLiteRateLimiter can store it).  check() decides whether the
+    alert may be sent now, and updates the state to say it was (if so).
+    """
+    def new_state(self):
+        """Return the state for an alert that's never been sent."""
+        raise NotImplementedError()
+
+    def check(self, state, now):
+        """Return True if the alert may be sent at time now."""
+        raise NotImplementedError()
+
+
+class IntervalLimit(_RateLimitPolicy):
+    """Send an alert at most once every secs seconds."""
+    def __init__(self, secs):
+        self.secs = secs
+
+    def new_state(self):
+        return [None]       # when the alert was last sent
+
+    def check(self, state, now):
+        if state[0] is not None and now - state[0] <= self.secs:
+            return False
+        state[0] = now
+        return True
+
+
+class TokenBucketLimit(_RateLimitPolicy):
+    """Send an alert once every per_secs seconds, with bursts of up to burst.
+
+    That is, an alert that hasn't been sent in a while can be sent
+    burst times in a row, after which it's limited to once per
+    per_secs seconds.
+    """
+    def __init__(self, per_secs, burst):
+        self.per_secs = per_secs
+        self.burst = burst
+
+    def new_state(self):
+        return [self.burst, None]     # #tokens, when we last added some
+
+    def check(self, state, now):
+        if state[1] is not None:
+            state[0] = min(self.burst,
+                           state[0] + (now - state[1]) / float(self.per_secs))
+        state[1] = now
+        if state[0] < 1:
+            return False
+        state[0] -= 1
+        return True
+
+
+class SlidingWindowLimit(_RateLimitPolicy):
+    """Send an alert at most max_alerts times in any window_secs seconds."""
+    def __init__(self, max_alerts, window_secs):
+        self.max_alerts = max_alerts
+        self.window_secs = window_secs
+
+    def new_state(self):
+        return []           # when the alert was last sent, oldest first
+
+    def check(self, state, now):
+        # We only need the last max_alerts times, so the state is
+        # never longer than that.
+        if (len(state) >= self.max_alerts and
+                now - state[-self.max_alerts] < self.window_secs):
+            return False
+        state.append(now)
+        del state[:-self.max_alerts]
+        return True
+
+
+class FixedWindowLimit(_RateLimitPolicy):
+    """Send an alert at most max_alerts times per window_secs seconds.
+
+    Unlike SlidingWindowLimit, the windows are fixed: for window_secs
+    of 3600, say, they're the hours on the clock.  That's cheaper, but
+    can allow up to twice max_alerts across the boundary of two windows.
+    """
+    def __init__(self, max_alerts, window_secs):
+        self.max_alerts = max_alerts
+        self.window_secs = window_secs
+
+    def new_state(self):
+        return [None, 0]    # start of the current window, #sent in it
+
+    def check(self, state, now):
+        window_start = now - now % self.window_secs
+        if state[0] != window_start:
+            state[:] = [window_start, 0]
+        if state[1] >= self.max_alerts:
+            return False
+        state[1] += 1
+        return True
+
+
+def _rate_limit_policy(rate_limit, service_name):
+    """Return the policy given by Alert(rate_limit=...), or None."""
+    if isinstance(rate_limit, dict):
+        rate_limit = rate_limit.get(service_name)
+    if not rate_limit or isinstance(rate_limit, _RateLimitPolicy):
+        return rate_limit
+    return IntervalLimit(rate_limit)
+
+
+def _default_rate_limit_fingerprint(alert, service_name, destination):
+    # We hash the message so we don't keep (possibly huge) messages
+    # around just to compare them.  Everything is a string, so
+    # _SQLiteRateLimiter can use this too.
+    if isinstance(destination, tuple):
+        destination = ','.join(destination)
+    return (hashlib.sha1(alert._get_utf8_message()).hexdigest(),
+            str(alert.severity), service_name, destination or '')
+
+
+class _RateLimiter(object):
+    """Keep track of when alerts were sent, for Alert(rate_limit=...).
+
+    This is process-wide, so two Alert objects for the same alert
+    share a rate limit.  Which alerts count as 'the same' is up to
+    fingerprint(alert, service_name, destination), which returns a
+    key for the alert: by default alerts are the same if they have
+    the same message and severity, and are being sent to the same
+    place (e.g. the same hipchat room) by the same backend.  To rate
+    limit by summary instead, say, you could use
+        lambda alert, service, dest: (alert._get_summary(), service, dest)
+
+    For each key, we keep the state of its rate-limit policy, and how
+    many times it's been suppressed since it was last sent.  We
+    remember at most max_size keys, forgetting the least recently used
+    ones first, so memory stays bounded no matter how many different
+    messages we see.
+    """
+    def __init__(self, fingerprint=_default_rate_limit_fingerprint,
+                 max_size=10000):
+        self.fingerprint = fingerprint
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # key -> [policy class name, policy state, #suppressed]
+        self._states = collections.OrderedDict()
+
+    def check(self, alert, service_name, destination, policy):
+        """Return None if alert is rate limited, else #similar suppressed."""
+        key = self.fingerprint(alert, service_name, destination)
+        policy_name = policy.__class__.__name__
+        now = time.time()
+        with self._lock:
+            # We pop and re-add it, to mark it most recently used.
+            entry = self._states.pop(key, None)
+            if entry is None or entry[0] != policy_name:
+                entry = [policy_name, policy.new_state(), 0]
+            self._states[key] = entry
+            if len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+
+            if not policy.check(entry[1], now):
+                entry[2] += 1
+                return None
+            (num_suppressed, entry[2]) = (entry[2], 0)
+            return num_suppressed
+
+
+class _SQLiteRateLimiter(object):
+    """Like _RateLimiter, but shared by all processes using the same file.
+
+    This is for when each alert comes from a new process -- e.g. a
+    cron job that runs alert.py -- where a rate limit that's kept in
+    memory does no good.  We keep the rate-limit state for each alert
+    in a sqlite database at path, keyed by (a hash of) its
+    fingerprint; see _RateLimiter.  Each check is a single indexed
+    lookup and update, inside a transaction so that of many processes
+    sending the same alert at once, only one gets to send it.  We use
+    sqlite's WAL mode so readers don't block on writers.  Since the
+    key has to be the same in every process, fingerprint must return
+    a string or a tuple of strings here.
+
+    Every prune_every sends, we delete entries that haven't been
+    touched in max_age_secs, so the file doesn't grow forever.  We
+    count sends in the database, not in memory, so this works even
+    when each process only sends an alert or two.  (An alert whose
+    rate limit is longer than max_age_secs can thus be sent again
+    after max_age_secs.)
+
+    If the database is unavailable for some reason, we err on the
+    side of sending the alert.
+    """
+    def __init__(self, path, fingerprint=_default_rate_limit_fingerprint,
+                 max_age_secs=86400, prune_every=1000, timeout=10):
+        if 'sqlite3' not in globals():
+            raise ImportError('Sharing rate limits needs the sqlite3 module')
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_age_secs = max_age_secs
+        self.prune_every = prune_every
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+
+    def _connect(self):
+        """Return a connection to the database.  Call with _lock held."""
+        if self._db is None or self._db_pid != os.getpid():
+            # (We never use our parent's connection after a fork.)
+            db = sqlite3.connect(self.path, timeout=self.timeout,
+                                 isolation_level=None,
+                                 check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS rate_limit_states '
+                       '(key TEXT PRIMARY KEY, last_checked REAL NOT NULL, '
+                       'policy TEXT NOT NULL, state TEXT NOT NULL, '
+                       'num_suppressed INTEGER NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS '
+                       'rate_limit_states_last_checked '
+                       'ON rate_limit_states (last_checked)')
+            db.execute('CREATE TABLE IF NOT EXISTS rate_limit_counters '
+                       '(name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            (self._db, self._db_pid) = (db, os.getpid())
+        return self._db
+
+    def _key(self, alert, service_name, destination):
+        fingerprint = self.fingerprint(alert, service_name, destination)
+        if isinstance(fingerprint, basestring):
+            fingerprint = (fingerprint,)
+        if not (isinstance(fingerprint, tuple) and
+                all(isinstance(s, basestring) for s in fingerprint)):
+            raise TypeError('Rate-limit fingerprints must be a string or a '
+                            'tuple of strings, not %r' % (fingerprint,))
+        return hashlib.sha1(json.dumps(fingerprint)).hexdigest()
+
+    def _count_send(self, db):
+        """Return how many sends, by any process, there have been so far.
+
+        Call inside the transaction that records the send.
+        """
+        db.execute('INSERT OR IGNORE INTO rate_limit_counters (name, value) '
+                   "VALUES ('num_sent', 0)")
+        db.execute('UPDATE rate_limit_counters SET value = value + 1 '
+                   "WHERE name = 'num_sent'")
+        (num_sent,) = db.execute('SELECT value FROM rate_limit_counters '
+                                 "WHERE name = 'num_sent'").fetchone()
+        return num_sent
+
+    def check(self, alert, service_name, destination, policy):
+        """Return None if alert is rate limited, else #similar suppressed."""
+        key = self._key(alert, service_name, destination)
+        policy_name = policy.__class__.__name__
+        now = time.time()
+        with self._lock:
+            try:
+                db = self._connect()
+                # IMMEDIATE takes the write lock now, so no other
+                # process can sneak in between our read and our write.
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    row = db.execute(
+                        'SELECT policy, state, num_suppressed '
+                        'FROM rate_limit_states WHERE key = ?',
+                        (key,)).fetchone()
+                    if row is None or row[0] != policy_name:
+                        (state, num_suppressed) = (policy.new_state(), 0)
+                    else:
+                        (state, num_suppressed) = (json.loads(row[1]), row[2])
+
+                    if policy.check(state, now):
+                        retval = num_suppressed
+                        num_suppressed = 0
+                    else:
+                        retval = None
+                        num_suppressed += 1
+
+                    db.execute('INSERT OR REPLACE INTO rate_limit_states '
+                               '(key, last_checked, policy, state, '
+                               'num_suppressed) VALUES (?, ?, ?, ?, ?)',
+                               (key, now, policy_name, json.dumps(state),
+                                num_suppressed))
+                    if (retval is not None and
+                            self._count_send(db) % self.prune_every == 0):
+                        db.execute('DELETE FROM rate_limit_states '
+                                   'WHERE last_checked < ?',
+                                   (now - self.max_age_secs,))
+                except:
+                    # Don't commit half of what we meant to do.
+                    exc_info = sys.exc_info()
+                    try:
+                        db.execute('ROLLBACK')
+                    except sqlite3.Error:
+                        pass      # sqlite already rolled it back for us
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                db.execute('COMMIT')
+                return retval
+            except sqlite3.Error, why:
+                logging.warning('Cannot check rate limit in %s, sending '
+                                'anyway: %s', self.path, why)
+                return 0
+
+
+_RATE_LIMITER = _RateLimiter()
+
+
+def configure_rate_limiting(path=None, **kwargs):
+    """Change how Alert(rate_limit=...) keeps track of what's been sent.
+
+    By default we keep track in memory, which is good for long-running
+    processes.  If path is given, we keep track in a sqlite database
+    at that path instead, so rate limits are shared by every process
+    that uses the same path (this raises ImportError if we don't have
+    sqlite3).  See _RateLimiter and _SQLiteRateLimiter
+    for the other options, such as how to tell which alerts are the
+    same.  This forgets what's been sent, at least in memory.
+    """
+    global _RATE_LIMITER
+    if path:
+        _RATE_LIMITER = _SQLiteRateLimiter(path, **kwargs)
+    else:
+        _RATE_LIMITER = _RateLimiter(**kwargs)
+
+
+def _nix_bad_emoticons(text):
+    """Remove troublesome hipchat emoticons so, e.g., '(128)' renders properly.
+
+    By default (at least in 'text' mode), '8)' is replaced by
+    a sunglasses-head emoticon.  There is no way to send
+    sunglasses-head using alertlib.  This is a feature.
+    """
+    return text.replace(u'8)', u'8\u200b)')   # zero-width space
 
 
 class Alert(object):
 
     """An alert message can be sent to multiple destinations."""
 
+    # We can create a lot of these, so we keep them small.  The
+    # _cached_* fields are views of the message we compute the first
+    # time they're needed; they're cleared whenever the message, or
+    # anything else they depend on, changes.
+    __slots__ = ('_message', '_summary', '_severity', '_html',
+                 'rate_limit',
+                 '_cached_summary', '_cached_utf8_message',
+                 '_cached_email_message', '_cached_utf8_email_message',
+                 '_cached_hipchat_message', '_cached_utf8_hipchat_message')
+
     def __init__(self, message, summary=None, severity=logging.INFO,
                  html=False, rate_limit=None):
         """Create a new Alert.
@@ -161,33 +2517,111 @@ class Alert(object):
             We do our best to encode the severity into each backend to
             the extent it's practical.
         html: True if the message should be treated as html, not text.
-        rate_limit: if not None, this Alert object will only emit
-            messages of a certain kind (hipchat, log, etc) once every
-            rate_limit seconds.
+        rate_limit: if not None, this alert will only be emitted to a
+            given place (hipchat room, log, etc) once every rate_limit
+            seconds.  This holds across Alert objects: a new Alert
+            with the same message and severity counts as the same
+            alert (see configure_rate_limiting()).  rate_limit can
+            also be a policy, such as TokenBucketLimit(60, burst=5),
+            or a dict from backend name ('hipchat', 'email',
+            'pagerduty', 'logs', 'graphite') to seconds or a policy.
+            When an alert is sent after some were rate limited, it
+            says how many.
         """
+        self._message = None
+        self._summary = None
+        self._severity = severity
+        self._html = html
         self.message = message
         self.summary = summary
-        self.severity = severity
-        self.html = html
         self.rate_limit = rate_limit
-        self.last_sent = {}
 
-        if isinstance(self.message, str):
-            self.message = self.message.decode('utf-8')
-        if isinstance(self.summary, str):
-            self.summary = self.summary.decode('utf-8')
+    def _clear_cached_views(self):
+        self._cached_summary = None
+        self._cached_utf8_message = None
+        self._cached_email_message = None
+        self._cached_utf8_email_message = None
+        self._cached_hipchat_message = None
+        self._cached_utf8_hipchat_message = None
+
+    @property
+    def message(self):
+        return self._message
+
+    @message.setter
+    def message(self, value):
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        self._message = value
+        self._clear_cached_views()
+
+    @property
+    def summary(self):
+        return self._summary
+
+    @summary.setter
+    def summary(self, value):
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        self._summary = value
+        self._clear_cached_views()
+
+    @property
+    def severity(self):
+        return self._severity
+
+    @severity.setter
+    def severity(self, value):
+        self._severity = value
+        self._clear_cached_views()
+
+    @property
+    def html(self):
+        return self._html
+
+    @html.setter
+    def html(self, value):
+        self._html = value
+        self._clear_cached_views()
+
+    def _rate_limited(self, service_name, destination=None):
+        """Return the alert to send to service_name, or None if rate limited.
+
+        That's self, unless we've suppressed some similar alerts since
+        the last one we sent, in which case it's a copy of self that
+        says so (and isn't itself rate limited).
+        """
+        policy = _rate_limit_policy(self.rate_limit, service_name)
+        if not policy:
+            return self
+        if isinstance(destination, list):
+            destination = tuple(destination)
+        num_suppressed = _RATE_LIMITER.check(self, service_name, destination,
+                                             policy)
+        if num_suppressed is None:
+            return None
+        if num_suppressed:
+            return self._with_suppressed_note(num_suppressed)
+        return self
 
-    def _passed_rate_limit(self, service_name):
-        if not self.rate_limit:
-            return True
-        now = time.time()
-        if now - self.last_sent.get(service_name, -1000000) > self.rate_limit:
-            self.last_sent[service_name] = now
-            return True
-        return False
+    def _passed_rate_limit(self, service_name, destination=None):
+        return self._rate_limited(service_name, destination) is not None
+
+    _LOG_PRIORITY_TO_SUMMARY_PREFIX = {
+        logging.DEBUG: "(debug info) ",
+        logging.INFO: "",
+        logging.WARNING: "WARNING: ",
+        logging.ERROR: "ERROR: ",
+        logging.CRITICAL: "**CRITICAL ERROR**: ",
+        }
 
     def _get_summary(self):
         """Return the summary as given, or auto-extracted if necessary."""
+        if self._cached_summary is None:
+            self._cached_summary = self._compute_summary()
+        return self._cached_summary
+
+    def _compute_summary(self):
         if self.summary is not None:
             return self.summary
 
@@ -209,17 +2643,63 @@ class Alert(object):
             summary = summary[:summary.find('.')]
 
         # Let's indicate the severity in the summary, as well
-        log_priority_to_prefix = {
-            logging.DEBUG: "(debug info) ",
-            logging.INFO: "",
-            logging.WARNING: "WARNING: ",
-            logging.ERROR: "ERROR: ",
-            logging.CRITICAL: "**CRITICAL ERROR**: ",
-            }
-        summary = log_priority_to_prefix.get(self.severity, "") + summary
+        summary = (self._LOG_PRIORITY_TO_SUMMARY_PREFIX.get(self.severity, "")
+                   + summary)
 
         return summary
 
+    def _get_utf8_message(self):
+        """Return the message encoded as utf-8."""
+        if self._cached_utf8_message is None:
+            self._cached_utf8_message = self.message.encode('utf-8')
+        return self._cached_utf8_message
+
+    def _get_email_message(self):
+        """Return the message as an email body: ending in a single newline."""
+        if self._cached_email_message is None:
+            self._cached_email_message = self.message.rstrip('\n') + '\n'
+        return self._cached_email_message
+
+    def _get_utf8_email_message(self):
+        """Return _get_email_message() encoded as utf-8."""
+        if self._cached_utf8_email_message is None:
+            self._cached_utf8_email_message = (
+                self._get_email_message().encode('utf-8'))
+        return self._cached_utf8_email_message
+
+    def _get_hipchat_message(self):
+        """Return the message as we send it to hipchat, truncated and all."""
+        if self._cached_hipchat_message is None:
+            message = self.message[:_HIPCHAT_MAX_MESSAGE_LEN]
+            if not self.html:
+                message = _nix_bad_emoticons(message)
+            self._cached_hipchat_message = message
+        return self._cached_hipchat_message
+
+    def _get_utf8_hipchat_message(self):
+        """Return _get_hipchat_message(), utf-8 encoded if it's unicode."""
+        if self._cached_utf8_hipchat_message is None:
+            message = self._get_hipchat_message()
+            if isinstance(message, unicode):
+                message = message.encode('utf-8')
+            self._cached_utf8_hipchat_message = message
+        return self._cached_utf8_hipchat_message
+
+    def _with_suppressed_note(self, num_suppressed):
+        """Return a copy of this alert saying similar ones were suppressed.
+
+        We only add the note to the summary if it was given explicitly:
+        an auto-extracted summary is the same as before, since the note
+        goes at the end of the message.
+        """
+        note = u'+%s similar suppressed' % num_suppressed
+        summary = self.summary
+        if summary is not None:
+            summary = u'%s (%s)' % (summary, note)
+        return Alert(self.message + (u'<br>' if self.html else u'\n\n')
+                     + u'(%s)' % note,
+                     summary=summary, severity=self.severity, html=self.html)
+
     def _mapped_severity(self, severity_map):
         """Given a map from log-level to stuff, return the 'stuff' for us.
 
@@ -240,31 +2720,115 @@ class Alert(object):
 
     def _make_hipchat_api_call(self, post_dict_with_secret_token):
         # This is a separate function just to make it easy to mock for tests.
-        r = urllib2.urlopen('https://api.hipchat.com/v1/rooms/message',
-                            urllib.urlencode(post_dict_with_secret_token))
-        if r.getcode() != 200:
-            raise ValueError(r.read())
-
-    def _post_to_hipchat(self, post_dict):
+        (status, headers, body) = _HTTPS_POOL.request(
+            'POST', 'https://api.hipchat.com/v1/rooms/message',
+            urllib.urlencode(post_dict_with_secret_token),
+            {'Content-Type': 'application/x-www-form-urlencoded'})
+        if status == 429:
+            raise _HipchatRateLimitedError(
+                _parse_retry_after(headers.get('retry-after')))
+        if status != 200:
+            raise ValueError(body)
+
+    def _post_to_hipchat(self, post_dict, num_retries=0, retry_after=0):
+        """Post to hipchat, retrying (up to a point) if we're throttled.
+
+        If we're posting inline, we hand the retry off to the room's
+        queue in _HIPCHAT_DISPATCHER, which holds up later posts to
+        the room until it's done; if we're a dispatcher worker, we
+        just retry here.  Either way, posts stay in order.
+
+        Returns 'sent', 'queued' (if we handed off a retry), or
+        'skipped' (if we have no hipchat token); raises DeliveryError
+        if we couldn't send it.
+        """
         if not hipchat_token:
-            logging.warning("Not sending this to hipchat (no token found): %s"
-                            % post_dict)
-            return
+            logging.warning("Not sending this to hipchat (no token found): %s",
+                            post_dict)
+            return 'skipped'
 
         # We need to send the token to the API!
         post_dict_with_secret_token = post_dict.copy()
         post_dict_with_secret_token['auth_token'] = hipchat_token
 
-        # urlencode requires that all fields be in utf-8.
+        # urlencode requires that all fields be in utf-8.  If we're
+        # posting our own message (rather than a summary, or several
+        # alerts' messages combined), we already have it encoded.
         for (k, v) in post_dict_with_secret_token.iteritems():
-            if isinstance(v, unicode):
+            if k == 'message' and v is self._get_hipchat_message():
+                post_dict_with_secret_token[k] = (
+                    self._get_utf8_hipchat_message())
+            elif isinstance(v, unicode):
                 post_dict_with_secret_token[k] = v.encode('utf-8')
 
-        try:
-            self._make_hipchat_api_call(post_dict_with_secret_token)
-        except Exception, why:
-            logging.error('Failed sending %s to hipchat: %s'
-                          % (post_dict, why))
+        throttle = _HIPCHAT_THROTTLE
+        room_name = post_dict['room_id']
+        while True:
+            if num_retries:
+                try:
+                    time.sleep(retry_after)
+                finally:
+                    throttle.finish_retry()
+
+            wait = throttle.reserve(hipchat_token, room_name)
+            try:
+                if wait is None:
+                    raise _HipchatRateLimitedError(
+                        throttle.retry_after(hipchat_token, room_name))
+                if wait:
+                    time.sleep(wait)
+                self._make_hipchat_api_call(post_dict_with_secret_token)
+                return 'sent'
+            except _HipchatRateLimitedError, why:
+                if wait is not None:       # hipchat throttled us, not us
+                    throttle.note_throttled()
+                if not throttle.start_retry(num_retries, why.retry_after):
+                    raise DeliveryError('Dropping %s to hipchat: %s'
+                                        % (post_dict, why))
+                (num_retries, retry_after) = (num_retries + 1,
+                                              why.retry_after)
+                if not _HIPCHAT_DISPATCHER.in_worker():
+                    _HIPCHAT_DISPATCHER.enqueue(room_name,
+                                                self._post_to_hipchat,
+                                                post_dict, num_retries,
+                                                retry_after)
+                    return 'queued'
+            except Exception, why:
+                raise DeliveryError('Failed sending %s to hipchat: %s'
+                                    % (post_dict, why))
+
+    def _queue_hipchat_post(self, post_dict, summary_post_dict=None):
+        """Post post_dict to hipchat now or later; see _post_to_hipchat().
+
+        If summary_post_dict is given, we post it first.  If we're
+        coalescing, we hold on to it along with post_dict's message, so
+        the two still go out in order.  If the summary doesn't make it,
+        we still send post_dict.
+        """
+        if _HIPCHAT_COALESCER.window_secs:
+            key = (post_dict['room_id'], post_dict['color'],
+                   post_dict['notify'], post_dict['from'],
+                   post_dict['message_format'])
+            _HIPCHAT_COALESCER.add(key,
+                                   (summary_post_dict, post_dict['message']),
+                                   (self._dispatch_hipchat_post, post_dict))
+            return 'queued'
+        if summary_post_dict is not None:
+            try:
+                self._dispatch_hipchat_post(summary_post_dict)
+            except DeliveryError, why:
+                logging.error(str(why))
+        return self._dispatch_hipchat_post(post_dict)
+
+    def _dispatch_hipchat_post(self, post_dict):
+        # If an earlier post to this room is waiting to be retried, we
+        # have to wait our turn behind it, even if we're not async.
+        if (_HIPCHAT_ASYNC or
+                _HIPCHAT_DISPATCHER.has_pending(post_dict['room_id'])):
+            _HIPCHAT_DISPATCHER.enqueue(post_dict['room_id'],
+                                        self._post_to_hipchat, post_dict)
+            return 'queued'
+        return self._post_to_hipchat(post_dict)
 
     def send_to_hipchat(self, room_name, color=None,
                         notify=None, sender='AlertiGator'):
@@ -279,8 +2843,25 @@ class Alert(object):
                 If None, we pick the notification automatically based
                 on self.severity
         """
-        if not self._passed_rate_limit('hipchat'):
-            return self
+        try:
+            self._deliver_to_hipchat(room_name, color, notify, sender)
+        except DeliveryError, why:
+            logging.error(str(why))
+        return self      # so we can chain the method calls
+
+    def _deliver_to_hipchat(self, room_name, color=None, notify=None,
+                            sender='AlertiGator'):
+        """Like send_to_hipchat(), but return a status; see Backend.send()."""
+        if (_BACKGROUND_DELIVERY and
+                _BACKGROUND_DELIVERY.defer(self, '_deliver_to_hipchat',
+                                           room_name, color, notify, sender)):
+            return 'queued'
+
+        alert = self._rate_limited('hipchat', room_name)
+        if alert is None:
+            return 'suppressed'
+        if alert is not self:
+            return alert._deliver_to_hipchat(room_name, color, notify, sender)
 
         if color is None:
             color = self._mapped_severity(self._LOG_PRIORITY_TO_COLOR)
@@ -288,50 +2869,36 @@ class Alert(object):
         if notify is None:
             notify = (self.severity == logging.CRITICAL)
 
-        def _nix_bad_emoticons(text):
-            """Remove troublesome emoticons so, e.g., '(128)' renders properly.
-
-            By default (at least in 'text' mode), '8)' is replaced by
-            a sunglasses-head emoticon.  There is no way to send
-            sunglasses-head using alertlib.  This is a feature.
-            """
-            return text.replace(u'8)', u'8\u200b)')   # zero-width space
-
+        summary_post_dict = None
         if self.summary:
             if _TEST_MODE:
                 logging.info("alertlib: would send to hipchat room %s: %s"
                              % (room_name, self.summary))
             else:
-                self._post_to_hipchat({
+                # Note that we send the "summary" first, and then the "body".
+                # We never send the body until hipchat has acknowledged the
+                # summary, so the two can't swap order en route to HipChat.
+                summary_post_dict = {
                     'room_id': room_name,
                     'from': sender,
                     'message': _nix_bad_emoticons(self.summary),
                     'message_format': 'text',
                     'notify': 0,
-                    'color': color})
-
-                # Note that we send the "summary" first, and then the "body".
-                # However, these back-to-back calls sometimes swap order en
-                # route to HipChat. So, let's sleep for 1 second to avoid that.
-                time.sleep(1)
-
-        # hipchat has a 10,000 char limit on messages, we leave some leeway
-        message = self.message[:9000]
+                    'color': color}
 
         if _TEST_MODE:
             logging.info("alertlib: would send to hipchat room %s: %s"
-                         % (room_name, message))
-        else:
-            self._post_to_hipchat({
-                'room_id': room_name,
-                'from': sender,
-                'message': (message if self.html else
-                            _nix_bad_emoticons(message)),
-                'message_format': 'html' if self.html else 'text',
-                'notify': int(notify),
-                'color': color})
-
-        return self      # so we can chain the method calls
+                         % (room_name,
+                            self.message[:_HIPCHAT_MAX_MESSAGE_LEN]))
+            return 'sent'
+
+        return self._queue_hipchat_post({
+            'room_id': room_name,
+            'from': sender,
+            'message': self._get_hipchat_message(),
+            'message_format': 'html' if self.html else 'text',
+            'notify': int(notify),
+            'color': color}, summary_post_dict)
 
     # ----------------- EMAIL --------------------------------------------
 
@@ -362,10 +2929,15 @@ class Alert(object):
             gae_mail_args['body'] = message
         google_mail.send_mail(**gae_mail_args)
 
+    def _make_mime_message(self):
+        return email.mime.text.MIMEText(self._get_utf8_email_message(),
+                                        'html' if self.html else 'plain')
+
     def _send_to_sendmail(self, message, email_addresses, cc=None, bcc=None,
                           sender=None):
-        msg = email.mime.text.MIMEText(message.encode('utf-8'),
-                                       'html' if self.html else 'plain')
+        # message is always our _get_email_message(), which
+        # _make_mime_message() gets (already encoded) for itself.
+        msg = self._make_mime_message()
         msg['Subject'] = self._get_summary().encode('utf-8')
         msg['From'] = self._get_sender(sender)
         msg['To'] = ', '.join(email_addresses)
@@ -387,30 +2959,46 @@ class Alert(object):
         to_emails = [email.utils.parseaddr(a) for a in email_addresses]
         to_emails = [email_addr for (_, email_addr) in to_emails]
 
-        s = smtplib.SMTP('localhost')
-        s.sendmail('no-reply@khanacademy.org', to_emails, msg.as_string())
-        s.quit()
+        _SMTP_POOL.sendmail(_SMTP_RELAY or 'localhost',
+                            'no-reply@khanacademy.org',
+                            to_emails, msg.as_string())
 
     def _send_to_email(self, email_addresses, cc=None, bcc=None, sender=None):
-        """An internal routine; email_addresses must be full addresses."""
-        # Make sure the email text ends in a single newline.
-        message = self.message.rstrip('\n') + '\n'
+        """An internal routine; email_addresses must be full addresses.
 
-        # Try sending to appengine first.
-        try:
-            self._send_to_gae_email(message, email_addresses, cc, bcc, sender)
-            return
-        except (NameError, AssertionError), why:
-            pass
+        If we can't send the email, this raises whatever the last
+        transport we tried raised.
+        """
+        global _EMAIL_TRANSPORT
+
+        message = self._get_email_message()
 
-        # Try using local smtp.
+        # Try sending to appengine first, then using smtp -- unless we
+        # already know which of those works.  The exceptions are the
+        # ones that mean a transport isn't available to us.
         try:
-            self._send_to_sendmail(message, email_addresses, cc, bcc, sender)
-            return
-        except (NameError, smtplib.SMTPException), why:
-            pass
+            smtp_unavailable = (NameError, smtplib.SMTPException)
+        except NameError:      # no smtplib (we're on appengine)
+            smtp_unavailable = (NameError,)
+        transports = [('gae', self._send_to_gae_email,
+                       (NameError, AssertionError)),
+                      ('smtp', self._send_to_sendmail, smtp_unavailable)]
+        transports.sort(key=lambda t: t[0] != _EMAIL_TRANSPORT)
+
+        why = DeliveryError('No way to send email')
+        for (name, send_fn, unavailable_exceptions) in transports:
+            if name == 'gae' and 'google_mail' not in globals():
+                continue
+            try:
+                send_fn(message, email_addresses, cc, bcc, sender)
+                _EMAIL_TRANSPORT = name
+                return
+            except unavailable_exceptions, why:
+                pass
 
-        logging.error('Failed sending email: %s' % why)
+        # Whatever we were using doesn't work anymore.
+        _EMAIL_TRANSPORT = None
+        raise why
 
     def send_to_email(self, email_usernames, cc=None, bcc=None, sender=None):
         """Send the message to a khan academy email account.
@@ -436,8 +3024,25 @@ class Alert(object):
             sender: an optional addition to the sender address, which if
                 provided, becomes 'alertlib <no-reply+sender@khanacademy.org>'.
         """
-        if not self._passed_rate_limit('email'):
-            return self
+        try:
+            self._deliver_to_email(email_usernames, cc, bcc, sender)
+        except DeliveryError, why:
+            logging.error(str(why))
+        return self
+
+    def _deliver_to_email(self, email_usernames, cc=None, bcc=None,
+                          sender=None):
+        """Like send_to_email(), but return a status; see Backend.send()."""
+        if (_BACKGROUND_DELIVERY and
+                _BACKGROUND_DELIVERY.defer(self, '_deliver_to_email',
+                                           email_usernames, cc, bcc, sender)):
+            return 'queued'
+
+        alert = self._rate_limited('email', email_usernames)
+        if alert is None:
+            return 'suppressed'
+        if alert is not self:
+            return alert._deliver_to_email(email_usernames, cc, bcc, sender)
 
         def _normalize(lst):
             if lst is None:
@@ -456,18 +3061,32 @@ class Alert(object):
         cc = _normalize(cc)
         bcc = _normalize(bcc)
 
-        email_contents = ("email to %s (from %s CC %s BCC %s): (subject %s) %s"
-                          % (email_addresses, self._get_sender(sender),
-                             cc, bcc, self._get_summary(), self.message))
+        def email_contents():
+            # This includes the whole message, so we only build it if we
+            # are going to log it.
+            return ("email to %s (from %s CC %s BCC %s): (subject %s) %s"
+                    % (email_addresses, self._get_sender(sender),
+                       cc, bcc, self._get_summary(), self.message))
+
         if _TEST_MODE:
-            logging.info("alertlib: would send %s" % email_contents)
-        else:
-            try:
-                self._send_to_email(email_addresses, cc, bcc, sender)
-            except Exception, why:
-                logging.error('Failed sending %s: %s' % (email_contents, why))
+            logging.info("alertlib: would send %s" % email_contents())
+            return 'sent'
+
+        if (_EMAIL_DIGESTER.window_secs and
+                (_EMAIL_DIGEST_BYPASS_SEVERITY is None or
+                 self.severity < _EMAIL_DIGEST_BYPASS_SEVERITY)):
+            key = (tuple(email_addresses), tuple(cc or ()), tuple(bcc or ()),
+                   sender, self.severity >= logging.WARNING)
+            _EMAIL_DIGESTER.add(key, (self, time.time()),
+                                (key[0], key[1], key[2], sender))
+            return 'queued'
 
-        return self
+        try:
+            self._send_to_email(email_addresses, cc, bcc, sender)
+        except Exception, why:
+            raise DeliveryError('Failed sending %s: %s'
+                                % (email_contents(), why))
+        return 'sent'
 
     # ----------------- PAGERDUTY ----------------------------------------
 
@@ -479,8 +3098,24 @@ class Alert(object):
                  strings, that are the names of PagerDuty services.
                  https://www.pagerduty.com/docs/guides/email-integration-guide/
         """
-        if not self._passed_rate_limit('pagerduty'):
-            return self
+        try:
+            self._deliver_to_pagerduty(pagerduty_servicenames)
+        except DeliveryError, why:
+            logging.error(str(why))
+        return self
+
+    def _deliver_to_pagerduty(self, pagerduty_servicenames):
+        """Like send_to_pagerduty(), but return a status; see Backend."""
+        if (_BACKGROUND_DELIVERY and
+                _BACKGROUND_DELIVERY.defer(self, '_deliver_to_pagerduty',
+                                           pagerduty_servicenames)):
+            return 'queued'
+
+        alert = self._rate_limited('pagerduty', pagerduty_servicenames)
+        if alert is None:
+            return 'suppressed'
+        if alert is not self:
+            return alert._deliver_to_pagerduty(pagerduty_servicenames)
 
         def _service_name_to_email(lst):
             if isinstance(lst, basestring):
@@ -496,18 +3131,33 @@ class Alert(object):
 
         email_addresses = _service_name_to_email(pagerduty_servicenames)
 
-        email_contents = ("pagerduty email to %s (subject %s) %s"
-                          % (email_addresses, self._get_summary(),
-                             self.message))
+        alert = self
+        deduper = _PAGERDUTY_DEDUPER
+        dedup_key = None
+        if deduper.ttl_secs:
+            dedup_key = deduper.fingerprint(email_addresses, self)
+            num_suppressed = deduper.check(dedup_key)
+            if num_suppressed is None:
+                return 'suppressed'
+            if num_suppressed:
+                alert = self._with_suppressed_note(num_suppressed)
+
+        def email_contents():
+            # As in send_to_email(), we only build this if we log it.
+            return ("pagerduty email to %s (subject %s) %s"
+                    % (email_addresses, alert._get_summary(), alert.message))
+
         if _TEST_MODE:
-            logging.info("alertlib: would send %s" % email_contents)
+            logging.info("alertlib: would send %s" % email_contents())
         else:
             try:
-                self._send_to_email(email_addresses)
+                alert._send_to_email(email_addresses)
             except Exception, why:
-                logging.error('Failed sending %s: %s' % (email_contents, why))
-
-        return self
+                if dedup_key:
+                    deduper.failed(dedup_key, num_suppressed)
+                raise DeliveryError('Failed sending %s: %s'
+                                    % (email_contents(), why))
+        return 'sent'
 
     # ----------------- LOGS ---------------------------------------------
 
@@ -524,8 +3174,20 @@ class Alert(object):
 
     def send_to_logs(self):
         """Send to logs: either GAE logs (for appengine) or syslog."""
-        if not self._passed_rate_limit('logs'):
-            return self
+        self._deliver_to_logs()
+        return self
+
+    def _deliver_to_logs(self):
+        """Like send_to_logs(), but return a status; see Backend.send()."""
+        if (_BACKGROUND_DELIVERY and
+                _BACKGROUND_DELIVERY.defer(self, '_deliver_to_logs')):
+            return 'queued'
+
+        alert = self._rate_limited('logs')
+        if alert is None:
+            return 'suppressed'
+        if alert is not self:
+            return alert._deliver_to_logs()
 
         logging.log(self.severity, self.message)
 
@@ -533,42 +3195,775 @@ class Alert(object):
         if not _TEST_MODE:
             try:
                 syslog_priority = self._mapped_severity(self._LOG_TO_SYSLOG)
-                syslog.syslog(syslog_priority, self.message.encode('utf-8'))
+                if _SYSLOG_EMITTER:
+                    _SYSLOG_EMITTER.emit(syslog_priority,
+                                         self._get_utf8_message())
+                else:
+                    syslog.syslog(syslog_priority, self._get_utf8_message())
             except (NameError, KeyError):
                 pass
 
-        return self
+        return 'sent'
 
     # ----------------- GRAPHITE -----------------------------------------
 
     DEFAULT_GRAPHITE_HOST = 'carbon.hostedgraphite.com:2003'
 
     def send_to_graphite(self, statistic, value=1,
-                         graphite_host=DEFAULT_GRAPHITE_HOST):
+                         graphite_host=DEFAULT_GRAPHITE_HOST,
+                         metric_type='counter', sample_rate=1, protocol=None):
         """Increment the given counter on a graphite/statds instance.
 
         statistic should be a dotted name as used by graphite: e.g.
         myapp.stats.num_failures.  When send_to_graphite() is called,
         we send the given value for that statistic to graphite.
+
+        metric_type is 'counter', 'gauge', or 'timer' (for a duration
+        in milliseconds).  It matters when graphite aggregation is
+        enabled (see enable_graphite_aggregation()): values for a
+        'counter' are added together, while a 'gauge' keeps the last
+        value sent.  It also matters for the 'statsd' protocol.
+
+        If sample_rate is less than 1, we only send this update that
+        fraction of the time, and scale it back up on the other end.
+        That is useful for counters that are updated very often.
+
+        protocol says how to talk to graphite: see
+        set_graphite_protocol().  If None, we use whatever protocol
+        was set there.
         """
-        if not self._passed_rate_limit('graphite'):
-            return self
+        try:
+            self._deliver_to_graphite(statistic, value, graphite_host,
+                                      metric_type, sample_rate, protocol)
+        except DeliveryError, why:
+            logging.error(str(why))
+        return self
+
+    def _deliver_to_graphite(self, statistic, value=1,
+                             graphite_host=DEFAULT_GRAPHITE_HOST,
+                             metric_type='counter', sample_rate=1,
+                             protocol=None):
+        """Like send_to_graphite(), but return a status; see Backend.send()."""
+        if metric_type not in ('counter', 'gauge', 'timer'):
+            raise ValueError('Unknown graphite metric type %s' % metric_type)
+        if protocol is not None and protocol not in _GRAPHITE_SENDER_CLASSES:
+            raise ValueError('Unknown graphite protocol %s' % protocol)
+
+        if (_BACKGROUND_DELIVERY and
+                _BACKGROUND_DELIVERY.defer(self, '_deliver_to_graphite',
+                                           statistic, value, graphite_host,
+                                           metric_type, sample_rate,
+                                           protocol)):
+            return 'queued'
 
-        # If the value is 12.0, send it as 12, not 12.0
-        if int(value) == value:
-            value = int(value)
+        if not self._passed_rate_limit('graphite', statistic):
+            return 'suppressed'
+
+        if sample_rate < 1 and random.random() >= sample_rate:
+            return 'suppressed'
+
+        value = _format_graphite_value(value)
 
         if _TEST_MODE:
             logging.info("alertlib: would send to graphite: %s %s"
                          % (statistic, value))
-        elif not hostedgraphite_api_key:
-            logging.warning("Not sending to graphite; no API key found: %s %s"
-                            % (statistic, value))
+            return 'sent'
+        if not hostedgraphite_api_key:
+            logging.warning("Not sending to graphite; no API key found: %s %s",
+                            statistic, value)
+            return 'skipped'
+        if (_GRAPHITE_AGGREGATOR.flush_interval_secs and
+                metric_type != 'timer'):
+            _GRAPHITE_AGGREGATOR.add(
+                graphite_host, protocol, statistic,
+                _unsampled_value(value, metric_type, sample_rate),
+                metric_type)
+            return 'queued'
+        return _send_graphite_metrics(graphite_host,
+                                      [(statistic, value, None)],
+                                      metric_type, sample_rate, protocol)
+
+    def send_many_to_graphite(self, values, timestamp=None,
+                              graphite_host=DEFAULT_GRAPHITE_HOST,
+                              metric_type='counter', protocol=None):
+        """Send values for many statistics to graphite, in a single write.
+
+        values is either a dict from statistic to value, or a list of
+        (statistic, value) pairs.  This is like calling
+        send_to_graphite() for each of them, but it's much cheaper:
+        there's only one rate-limit check, and we send all the updates
+        with one write to the network.
+
+        If timestamp (seconds since the epoch) is given, we tell
+        graphite that's when the values are from, rather than now.
+        Timestamped values are never combined by graphite aggregation,
+        and the 'statsd' protocol doesn't support them at all.
+        """
+        if metric_type not in ('counter', 'gauge', 'timer'):
+            raise ValueError('Unknown graphite metric type %s' % metric_type)
+        if protocol is not None and protocol not in _GRAPHITE_SENDER_CLASSES:
+            raise ValueError('Unknown graphite protocol %s' % protocol)
+
+        try:
+            self._deliver_many_to_graphite(values, timestamp, graphite_host,
+                                           metric_type, protocol)
+        except DeliveryError, why:
+            logging.error(str(why))
+        return self
+
+    def _deliver_many_to_graphite(self, values, timestamp, graphite_host,
+                                  metric_type, protocol):
+        """Like send_many_to_graphite(), but return a status."""
+        if (_BACKGROUND_DELIVERY and
+                _BACKGROUND_DELIVERY.defer(self, '_deliver_many_to_graphite',
+                                           values, timestamp, graphite_host,
+                                           metric_type, protocol)):
+            return 'queued'
+
+        if hasattr(values, 'iteritems'):
+            values = sorted(values.iteritems())
         else:
+            values = list(values)
+
+        if not self._passed_rate_limit(
+                'graphite', tuple(statistic for (statistic, _) in values)):
+            return 'suppressed'
+
+        metrics = [(statistic, _format_graphite_value(value), timestamp)
+                   for (statistic, value) in values]
+
+        if _TEST_MODE:
+            for (statistic, value, _) in metrics:
+                logging.info("alertlib: would send to graphite: %s %s"
+                             % (statistic, value))
+            return 'sent'
+        if not hostedgraphite_api_key:
+            logging.warning("Not sending to graphite; no API key found: %s",
+                            metrics)
+            return 'skipped'
+        if (_GRAPHITE_AGGREGATOR.flush_interval_secs and
+                metric_type != 'timer' and timestamp is None):
+            for (statistic, value, _) in metrics:
+                _GRAPHITE_AGGREGATOR.add(graphite_host, protocol, statistic,
+                                         value, metric_type)
+            return 'queued'
+        if not metrics:
+            return 'sent'
+        return _send_graphite_metrics(graphite_host, metrics, metric_type,
+                                      protocol=protocol)
+
+    def send_to_graphite_histogram(self, statistic, value,
+                                   graphite_host=DEFAULT_GRAPHITE_HOST,
+                                   protocol=None):
+        """Record a sample (e.g. a latency) for the given statistic.
+
+        Rather than sending each sample to graphite, we summarize them
+        in memory, and every so often send statistic.count, .sum,
+        .min, .max, .mean, .p50, .p90 and .p99 for the samples we've
+        seen since the last time.  See configure_graphite_histograms()
+        to change how often, or which percentiles.
+        """
+        self._deliver_to_graphite_histogram(statistic, value, graphite_host,
+                                            protocol)
+        return self
+
+    def _deliver_to_graphite_histogram(self, statistic, value,
+                                       graphite_host=DEFAULT_GRAPHITE_HOST,
+                                       protocol=None):
+        """Like send_to_graphite_histogram(), but return a status."""
+        if protocol is not None and protocol not in _GRAPHITE_SENDER_CLASSES:
+            raise ValueError('Unknown graphite protocol %s' % protocol)
+
+        if (_BACKGROUND_DELIVERY and
+                _BACKGROUND_DELIVERY.defer(self,
+                                           '_deliver_to_graphite_histogram',
+                                           statistic, value, graphite_host,
+                                           protocol)):
+            return 'queued'
+
+        if not self._passed_rate_limit('graphite', statistic):
+            return 'suppressed'
+
+        if _TEST_MODE:
+            logging.info("alertlib: would add to graphite histogram: %s %s"
+                         % (statistic, value))
+            return 'sent'
+        if not hostedgraphite_api_key:
+            logging.warning("Not sending to graphite; no API key found: %s %s",
+                            statistic, value)
+            return 'skipped'
+        _GRAPHITE_HISTOGRAMS.add(graphite_host, protocol, statistic, value)
+        return 'queued'
+
+    # ----------------- ALL AT ONCE --------------------------------------
+
+    def send(self, routes, timeout=None):
+        """Send to several backends at once, in parallel; return a SendResult.
+
+        routes says where to send: it's a list of (backend name,
+        options) pairs, or a dict from backend name to options.  The
+        backend names are 'hipchat', 'email', 'pagerduty', 'logs',
+        'graphite', and 'graphite_histogram', plus any you've added
+        via register_backend().  The options are the arguments for
+        the corresponding send_to_*() method: a dict of keyword
+        arguments, a tuple of positional arguments, None for no
+        arguments, or else the sole argument.  For instance:
+           alert.send([('hipchat', '1s and 0s'),
+                       ('email', {'email_usernames': 'ka-admin',
+                                  'cc': 'sitemaster'}),
+                       ('logs', None),
+                       ('graphite', ('stats.alerted', 1))])
+
+        We send via a shared pool of threads, so this takes about as
+        long as the slowest backend, rather than the sum of them all.
+        If timeout is given, we wait at most that long; routes we
+        haven't heard back from by then are reported as 'pending'
+        (but are still sent).
+        """
+        routes = _normalize_routes(routes)
+
+        futures = [_THREAD_POOL.submit(_deliver, self, backend_name, options)
+                   for (backend_name, options) in routes]
+
+        deadline = None if timeout is None else time.time() + timeout
+        outcomes = []
+        for ((backend_name, options), future) in zip(routes, futures):
+            remaining = (None if deadline is None
+                         else max(0, deadline - time.time()))
+            if future.wait(remaining):
+                outcomes.append(future.result())
+            else:
+                outcomes.append(BackendOutcome(backend_name, options,
+                                               'pending', None, None))
+        return SendResult(outcomes)
+
+    def send_async(self, routes):
+        """Like send(), but return right away, with a future SendResult.
+
+        The future has result(timeout=None), which waits for and
+        returns the SendResult; done(); and add_done_callback(fn),
+        which calls fn(future) (from a pool thread) once everything's
+        been sent.  That last is the way to hook this up to an event
+        loop without blocking it; e.g. with tornado:
+            alert.send_async(routes).add_done_callback(
+                lambda f: io_loop.add_callback(on_sent, f.result()))
+        """
+        routes = _normalize_routes(routes)
+
+        retval = _Future()
+        futures = [_THREAD_POOL.submit(_deliver, self, backend_name, options)
+                   for (backend_name, options) in routes]
+        if not futures:
+            retval._set(result=SendResult([]))
+            return retval
+
+        lock = threading.Lock()
+        num_pending = [len(futures)]
+
+        def one_done(_):
+            with lock:
+                num_pending[0] -= 1
+                if num_pending[0]:
+                    return
+            retval._set(result=SendResult([f.result() for f in futures]))
+
+        for future in futures:
+            future.add_done_callback(one_done)
+        return retval
+
+
+class _EmailDigest(Alert):
+    """A single email listing a bunch of alerts (see enable_email_digests)."""
+
+    __slots__ = ('alerts_and_times',)
+
+    def __init__(self, alerts_and_times):
+        """alerts_and_times is a list of (alert, when it was sent) pairs."""
+        self.alerts_and_times = alerts_and_times
+        alerts = [a for (a, _) in alerts_and_times]
+        severity = max(a.severity for a in alerts)
+        summary = (self._LOG_PRIORITY_TO_SUMMARY_PREFIX.get(severity, "")
+                   + '%s alert%s' % (len(alerts),
+                                     '' if len(alerts) == 1 else 's'))
+        # This is the plain-text version, for when we can't send multipart.
+        message = '\n'.join(self._describe(a, t) + a.message
+                            for (a, t) in alerts_and_times)
+        super(_EmailDigest, self).__init__(message, summary, severity)
+
+    @staticmethod
+    def _describe(alert, when):
+        return u'-- %s (%s)\n' % (alert._get_summary() or u'alert',
+                                   time.strftime('%Y-%m-%d %H:%M:%S',
+                                                 time.localtime(when)))
+
+    def _make_mime_message(self):
+        msg = email.mime.multipart.MIMEMultipart()
+        msg.preamble = 'This is a digest of %s alerts.' % len(
+            self.alerts_and_times)
+        for (alert, when) in self.alerts_and_times:
+            if alert.html:
+                alert_message = alert._get_utf8_email_message()
+            else:
+                alert_message = (self._describe(alert, when)
+                                 + alert._get_email_message()).encode('utf-8')
+            part = email.mime.text.MIMEText(alert_message,
+                                            'html' if alert.html else 'plain')
+            part['Content-Description'] = (
+                alert._get_summary() or u'alert').encode('utf-8')
+            msg.attach(part)
+        return msg
+
+
+class _Future(object):
+    """The result of a function we're running on another thread."""
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def _set(self, result=None, exception=None):
+        (self._result, self._exception) = (result, exception)
+        with self._lock:
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        # A broken callback mustn't keep the others from running, or
+        # make us look like we failed.
+        try:
+            callback(self)
+        except Exception, why:
+            logging.error('Done-callback %r failed: %s' % (callback, why))
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the result; return False if we timed out."""
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        """Return the function's return value, or raise what it raised."""
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for result')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once we're done (right away if we are)."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+
+class _ThreadPool(object):
+    """A fixed-size pool of daemon threads that run functions for us.
+
+    Threads are started as they're needed, up to max_workers of them.
+    stop() has them finish what's queued up and exit.
+    """
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._tasks = collections.deque()
+        self._has_tasks = threading.Condition(self._lock)
+        self._num_workers = 0
+        self._num_idle = 0
+        self._threads = []
+        self._stopping = False
+        self._pid = os.getpid()
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on a pool thread; return a _Future."""
+        future = _Future()
+        with self._lock:
+            if self._pid != os.getpid():
+                # Our parent's workers didn't come with us when we forked.
+                (self._num_workers, self._num_idle) = (0, 0)
+                self._threads = []
+                self._pid = os.getpid()
+            self._tasks.append((future, fn, args, kwargs))
+            if self._num_idle:
+                self._num_idle -= 1       # (so nobody else wakes it too)
+                self._has_tasks.notify()
+            elif self._num_workers < self.max_workers:
+                self._num_workers += 1
+                thread = threading.Thread(target=self._work,
+                                          name='alertlib-pool')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._tasks:
+                    if self._stopping:
+                        self._num_workers -= 1
+                        return
+                    self._num_idle += 1
+                    self._has_tasks.wait()
+                (future, fn, args, kwargs) = self._tasks.popleft()
             try:
-                _graphite_socket(graphite_host).send('%s.%s %s\n' % (
-                    hostedgraphite_api_key, statistic, value))
+                future._set(result=fn(*args, **kwargs))
             except Exception, why:
-                logging.error('Failed sending to graphite: %s' % why)
+                future._set(exception=why)
 
-        return self
+    def stop(self, timeout_per_thread=1):
+        """Have our threads exit once the queue is empty, and wait for them.
+
+        Like _stop_flush_threads(), this is so they're gone before
+        python is, rather than dying noisily during interpreter
+        shutdown.
+        """
+        with self._lock:
+            self._stopping = True
+            self._num_idle = 0
+            self._has_tasks.notify_all()
+            threads = self._threads
+            self._threads = []
+        for thread in threads:
+            thread.join(timeout_per_thread)
+
+
+_THREAD_POOL = _ThreadPool()
+atexit.register(_THREAD_POOL.stop)
+
+
+class Backend(object):
+    """Somewhere we can send alerts: hipchat, email, etc.
+
+    This is an abstract base class.  Subclass it, define send(), and
+    register_backend() an instance, to be able to send to your own
+    backend via Alert.send().
+    """
+    def send(self, alert, *args, **kwargs):
+        """Send alert; return its status, or raise if we couldn't.
+
+        The status is one of:
+           'sent': we delivered it.
+           'queued': it will be delivered later, in the background.
+           'suppressed': we didn't send it on purpose (because it was
+               rate limited, say).
+           'skipped': we can't send to this backend at all (because
+               we have no credentials for it, say).
+        Returning None is the same as 'sent'.  If delivery fails,
+        raise an exception -- preferably a DeliveryError -- saying why.
+        """
+        raise NotImplementedError()
+
+
+class _AlertMethodBackend(Backend):
+    """A built-in backend, which sends using an Alert._deliver_to_*()."""
+    def __init__(self, method_name):
+        self.method_name = method_name
+
+    def send(self, alert, *args, **kwargs):
+        return getattr(alert, self.method_name)(*args, **kwargs)
+
+
+_BACKENDS = {
+    'hipchat': _AlertMethodBackend('_deliver_to_hipchat'),
+    'email': _AlertMethodBackend('_deliver_to_email'),
+    'pagerduty': _AlertMethodBackend('_deliver_to_pagerduty'),
+    'logs': _AlertMethodBackend('_deliver_to_logs'),
+    'graphite': _AlertMethodBackend('_deliver_to_graphite'),
+    'graphite_histogram': _AlertMethodBackend(
+        '_deliver_to_graphite_histogram'),
+}
+
+
+def register_backend(name, backend):
+    """Make backend, a Backend instance, available to Alert.send()."""
+    _BACKENDS[name] = backend
+
+
+def _normalize_routes(routes):
+    """Return routes as a list of (backend name, options) pairs."""
+    if hasattr(routes, 'iteritems'):
+        routes = routes.items()
+    routes = list(routes)      # so we don't use up a generator checking it
+    for (backend_name, _) in routes:
+        if backend_name not in _BACKENDS:
+            raise ValueError('Unknown backend %s' % backend_name)
+    return routes
+
+
+def _route_args(options):
+    """Turn the options for a route into (args, kwargs) for the backend."""
+    if options is None:
+        return ((), {})
+    if isinstance(options, dict):
+        return ((), options)
+    if isinstance(options, tuple):
+        return (options, {})
+    return ((options,), {})
+
+
+BackendOutcome = collections.namedtuple(
+    'BackendOutcome', ('backend', 'options', 'status', 'error',
+                       'latency_secs'))
+
+
+class SendResult(object):
+    """What happened when we sent an alert via Alert.send().
+
+    outcomes is a list of BackendOutcomes, one per route, in order.
+    Each one's status is what the backend returned (see Backend.send()),
+    'failed' (in which case error is the exception saying why), or
+    'pending' (if we stopped waiting for it).
+    """
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+
+    @property
+    def ok(self):
+        """True if every backend sent the alert, or will, or chose not to."""
+        return all(o.status in ('sent', 'queued', 'suppressed')
+                   for o in self.outcomes)
+
+    def __iter__(self):
+        return iter(self.outcomes)
+
+    def __len__(self):
+        return len(self.outcomes)
+
+    def __repr__(self):
+        return 'SendResult(%r)' % self.outcomes
+
+
+def _deliver(alert, backend_name, options):
+    """Send alert via one route; return its BackendOutcome.
+
+    We're already on a pool thread, so we send right away, even if
+    background delivery is on: otherwise we couldn't say how it went.
+    """
+    start = time.time()
+    _IN_BACKGROUND_DELIVERY.active = True
+    try:
+        (args, kwargs) = _route_args(options)
+        status = _BACKENDS[backend_name].send(alert, *args, **kwargs)
+        (status, error) = (status or 'sent', None)
+    except Exception, why:
+        if isinstance(why, DeliveryError):
+            logging.error(str(why))     # as send_to_*() would
+        (status, error) = ('failed', why)
+    finally:
+        _IN_BACKGROUND_DELIVERY.active = False
+    return BackendOutcome(backend_name, options, status, error,
+                          time.time() - start)
+
+
+# Set on background-delivery threads, and while Alert.send() is sending,
+# so their sends happen right away rather than being deferred again.
+_IN_BACKGROUND_DELIVERY = threading.local()
+
+
+class _BackgroundDelivery(_ForkAware):
+    """A bounded queue of sends, and the threads that do them.
+
+    When the queue has max_queue_size sends in it, overflow says what
+    to do with another:
+       'block': wait up to block_timeout_secs for room, then drop it.
+       'drop_oldest': drop the send that's been waiting longest.
+       'drop_lowest_severity': drop the queued send of lowest severity
+           (the oldest, if there's a tie), or this one, if it's lower.
+    Either way, we count the drop in num_dropped.
+
+    A forked child starts out with an empty queue (its parent will do
+    those sends) and its own worker threads.
+    """
+    OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_lowest_severity')
+
+    def __init__(self, max_queue_size=1000, num_workers=2, overflow='block',
+                 block_timeout_secs=1, drain_timeout_secs=10):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %s' % overflow)
+        self.max_queue_size = max_queue_size
+        self.overflow = overflow
+        self.block_timeout_secs = block_timeout_secs
+        self.drain_timeout_secs = drain_timeout_secs
+        self.num_workers = num_workers
+        self.num_dropped = 0
+        self.num_delivered = 0
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._pid = os.getpid()
+        self._start()
+
+    def _start(self):
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+        # Of (alert, name of Alert method to call, args, kwargs)
+        self._queue = collections.deque()
+        self._num_in_progress = 0
+        for i in xrange(self.num_workers):
+            thread = threading.Thread(target=self._work,
+                                      name='alertlib-delivery-%s' % i)
+            thread.daemon = True
+            thread.start()
+
+    def _reset_after_fork(self):
+        self._start()
+
+    def defer(self, alert, method_name, *args, **kwargs):
+        """Queue up alert.method_name(*args, **kwargs); False if we can't.
+
+        We can't if we're a background-delivery thread ourselves: then
+        it's time to actually send.
+        """
+        if getattr(_IN_BACKGROUND_DELIVERY, 'active', False):
+            return False
+        self._check_for_fork()
+        item = (alert, method_name, args, kwargs)
+        with self._lock:
+            if len(self._queue) >= self.max_queue_size:
+                if self.overflow == 'block':
+                    deadline = time.time() + self.block_timeout_secs
+                    while (len(self._queue) >= self.max_queue_size and
+                           time.time() < deadline):
+                        self._not_full.wait(deadline - time.time())
+                    if len(self._queue) >= self.max_queue_size:
+                        self.num_dropped += 1
+                        return True
+                elif self.overflow == 'drop_oldest':
+                    self._queue.popleft()
+                    self.num_dropped += 1
+                else:
+                    (lowest, lowest_item) = min(
+                        enumerate(self._queue),
+                        key=lambda (_, item): item[0].severity)
+                    self.num_dropped += 1
+                    if lowest_item[0].severity > alert.severity:
+                        return True      # we're the lowest; drop us
+                    del self._queue[lowest]
+            self._queue.append(item)
+            self._not_empty.notify()
+        return True
+
+    def _work(self):
+        _IN_BACKGROUND_DELIVERY.active = True
+        while True:
+            with self._lock:
+                while not self._queue and not self._stopping:
+                    self._not_empty.wait()
+                if not self._queue:
+                    return     # we're stopping, and there's nothing to do
+                (alert, method_name, args, kwargs) = self._queue.popleft()
+                self._num_in_progress += 1
+                self._not_full.notify()
+            try:
+                getattr(alert, method_name)(*args, **kwargs)
+            except Exception, why:
+                logging.error('Failed %s in the background: %s'
+                              % (method_name, why))
+            with self._lock:
+                self._num_in_progress -= 1
+                self.num_delivered += 1
+                if not self._queue and not self._num_in_progress:
+                    self._all_done.notify_all()
+
+    def drain(self, timeout=None):
+        """Wait for all queued sends to finish; False if we timed out."""
+        self._check_for_fork()
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._queue or self._num_in_progress:
+                if deadline is None:
+                    self._all_done.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._all_done.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        """Finish up the queued sends (for up to timeout), then stop."""
+        self._check_for_fork()
+        with self._lock:
+            self._stopping = True
+            self._not_empty.notify_all()
+        return self.drain(timeout)
+
+    def stats(self):
+        self._check_for_fork()
+        with self._lock:
+            return {'queue_depth': len(self._queue),
+                    'in_progress': self._num_in_progress,
+                    'delivered': self.num_delivered,
+                    'dropped': self.num_dropped}
+
+
+# If set, send_to_*() just queue up the send here, and return.
+_BACKGROUND_DELIVERY = None
+
+
+def enable_background_delivery(**kwargs):
+    """Do all sending in background threads, off of a bounded queue.
+
+    With this, send_to_hipchat() and friends return right away; the
+    sending happens later.  That way a slow smtp server, say, doesn't
+    slow down the caller.  See _BackgroundDelivery for the options:
+    how big the queue can get, how many threads drain it, and what to
+    do when it's full.  At exit, we wait up to drain_timeout_secs for
+    the queue to drain.
+
+    Note that an alert is sent as it is when its turn comes, so don't
+    change an Alert after sending it.
+    """
+    global _BACKGROUND_DELIVERY
+    (old_delivery, _BACKGROUND_DELIVERY) = (_BACKGROUND_DELIVERY,
+                                            _BackgroundDelivery(**kwargs))
+    if old_delivery:
+        old_delivery.stop(old_delivery.drain_timeout_secs)
+
+
+def disable_background_delivery(timeout=None):
+    """Send everything we've queued up, and go back to sending right away.
+
+    Returns False if we gave up waiting for the queue to drain.
+    """
+    global _BACKGROUND_DELIVERY
+    (old_delivery, _BACKGROUND_DELIVERY) = (_BACKGROUND_DELIVERY, None)
+    if old_delivery:
+        return old_delivery.stop(timeout)
+    return True
+
+
+def flush_background_delivery(timeout=None):
+    """Wait for everything queued so far to be sent; False if we timed out."""
+    delivery = _BACKGROUND_DELIVERY
+    if delivery:
+        return delivery.drain(timeout)
+    return True
+
+
+def background_delivery_stats():
+    """Return the queue depth, and counts of sends delivered and dropped."""
+    delivery = _BACKGROUND_DELIVERY
+    if delivery:
+        return delivery.stats()
+    return {'queue_depth': 0, 'in_progress': 0, 'delivered': 0, 'dropped': 0}
+
+
+def _drain_background_delivery_at_exit():
+    delivery = _BACKGROUND_DELIVERY
+    if delivery and not delivery.stop(delivery.drain_timeout_secs):
+        logging.warning('Gave up sending %s alerts at exit',
+                        delivery.stats()['queue_depth'])
+
+
+# We're registered last, so we run first: sending what's in the queue
+# can give the other atexit functions more to flush.
+atexit.register(_drain_background_delivery_at_exit)
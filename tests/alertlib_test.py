@@ -3,9 +3,16 @@
 """Tests for alertlib/__init__.py."""
 
 import contextlib
+import cPickle
 import logging
+import os
+import shutil
+import socket
 import sys
+import struct
 import syslog
+import tempfile
+import threading
 import time
 import types
 import unittest
@@ -41,6 +48,36 @@ def disable_google_mail():
         alertlib.Alert._send_to_gae_email = orig_send_to_gae_email
 
 
+def _have_numpy():
+    try:
+        import numpy
+        return True
+    except ImportError:
+        return False
+
+
+def _flush_thread_is_running(name):
+    """True if there's a live alertlib flush thread with the given name."""
+    return any(t.name == name and t.is_alive()
+               for (_, t) in alertlib._FLUSH_THREADS)
+
+
+def _run_in_forked_child(fn):
+    """Call fn() in a forked child, and return whether it returned True.
+
+    The child tells us how it went via its exit code.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            ok = fn()
+        except BaseException:
+            ok = False
+        os._exit(0 if ok else 1)
+    (_, status) = os.waitpid(pid, 0)
+    return status == 0
+
+
 class TestBase(unittest.TestCase):
     def setUp(self):
         super(TestBase, self).setUp()
@@ -56,20 +93,27 @@ class TestBase(unittest.TestCase):
         self.sent_to_graphite = []
 
         class FakeSMTP(object):
-            """We need to fake out the sendmail() and quit() methods."""
+            """We need to fake out sendmail(), noop() and quit()."""
             def __init__(*args, **kwargs):
                 pass
 
             def sendmail(_, frm, to, msg):
                 self.sent_to_sendmail.append((frm, to, msg))
 
+            def connect(_, host):
+                return (220, 'OK')
+
+            def noop(_):
+                return (250, 'OK')
+
             def quit(_):
                 pass
 
         class FakeGraphiteSocket(object):
             @staticmethod
-            def send(arg):
+            def send(arg, unit_ends=None):
                 self.sent_to_graphite.append(arg)
+                return True
 
         # We need to mock out a bunch of stuff so we don't actually
         # talk to the real world.
@@ -93,6 +137,25 @@ class TestBase(unittest.TestCase):
         self.mock(alertlib, '_graphite_socket',
                   lambda hostname: FakeGraphiteSocket)
 
+        # Start each test with full hipchat rate-limit buckets.
+        self.mock(alertlib, '_HIPCHAT_THROTTLE', alertlib._HipchatThrottle())
+
+        # And without any smtp connections left over from other tests.
+        self.mock(alertlib, '_SMTP_POOL', alertlib._SMTPConnectionPool())
+
+        # And figuring out which email transport to use from scratch.
+        self.mock(alertlib, '_EMAIL_TRANSPORT', None)
+        self.mock(alertlib, '_SMTP_RELAY', None)
+
+        # And no memory of pages sent by other tests.
+        self.mock(alertlib, '_PAGERDUTY_DEDUPER', alertlib._PagerDutyDeduper())
+
+        # And an empty DNS cache.
+        self.mock(alertlib, '_DNS_CACHE', alertlib._DNSCache())
+
+        # And no memory of rate-limited alerts sent by other tests.
+        self.mock(alertlib, '_RATE_LIMITER', alertlib._RateLimiter())
+
     def tearDown(self):
         # None of the tests should have caused any errors.
         self.assertEqual([], self.sent_to_error_log)
@@ -106,7 +169,73 @@ class TestBase(unittest.TestCase):
         setattr(container, var_str, new_value)
 
 
+class AlertTest(unittest.TestCase):
+    def test_no_instance_dict(self):
+        alert = alertlib.Alert('test message')
+        self.assertFalse(hasattr(alert, '__dict__'))
+        with self.assertRaises(AttributeError):
+            alert.no_such_field = 1
+
+    def test_utf8_is_decoded(self):
+        alert = alertlib.Alert('yo \xc3\xb7', summary='yep \xc3\xb7')
+        self.assertEqual(u'yo \xf7', alert.message)
+        self.assertEqual(u'yep \xf7', alert.summary)
+        alert.message = 'yo \xc3\xb7!'
+        self.assertEqual(u'yo \xf7!', alert.message)
+
+    def test_views_are_cached(self):
+        alert = alertlib.Alert(u'test message. \xf7' * 1000)
+        self.assertIs(alert._get_summary(), alert._get_summary())
+        self.assertIs(alert._get_utf8_message(), alert._get_utf8_message())
+        self.assertIs(alert._get_email_message(), alert._get_email_message())
+        self.assertIs(alert._get_utf8_email_message(),
+                      alert._get_utf8_email_message())
+        self.assertIs(alert._get_hipchat_message(),
+                      alert._get_hipchat_message())
+        self.assertIs(alert._get_utf8_hipchat_message(),
+                      alert._get_utf8_hipchat_message())
+
+    def test_mime_message_uses_cached_utf8_view(self):
+        alert = alertlib.Alert(u'test message. \xf7')
+        self.assertIs(alert._get_utf8_email_message(),
+                      alert._make_mime_message().get_payload())
+
+    def test_views_are_invalidated(self):
+        alert = alertlib.Alert('first message\n\n')
+        self.assertEqual('first message', alert._get_summary())
+        self.assertEqual('first message\n', alert._get_email_message())
+        self.assertEqual('first message\n\n', alert._get_utf8_message())
+
+        alert.message = 'second (8)'
+        self.assertEqual('second (8)', alert._get_summary())
+        self.assertEqual(u'second (8\u200b)', alert._get_hipchat_message())
+        self.assertEqual('second (8\xe2\x80\x8b)',
+                         alert._get_utf8_hipchat_message())
+        self.assertEqual('second (8)\n', alert._get_email_message())
+        self.assertEqual('second (8)\n', alert._get_utf8_email_message())
+        self.assertEqual('second (8)', alert._get_utf8_message())
+
+        alert.severity = logging.ERROR
+        self.assertEqual('ERROR: second (8)', alert._get_summary())
+
+        alert.html = True
+        self.assertEqual('', alert._get_summary())
+        self.assertEqual('second (8)', alert._get_hipchat_message())
+
+        alert.summary = 'explicit'
+        self.assertEqual('explicit', alert._get_summary())
+
+
 class HipchatTest(TestBase):
+    def test_uses_cached_utf8_message(self):
+        alert = alertlib.Alert(u'test message. \xf7')
+        alert.send_to_hipchat('1s and 0s')
+        alert.send_to_hipchat('1s and 0s')
+        self.assertIs(alert._get_utf8_hipchat_message(),
+                      self.sent_to_hipchat[0]['message'])
+        self.assertIs(alert._get_utf8_hipchat_message(),
+                      self.sent_to_hipchat[1]['message'])
+
     def test_options(self):
         alertlib.Alert('test message') \
             .send_to_hipchat('1s and 0s', color='gray', notify=True)
@@ -200,6 +329,20 @@ class HipchatTest(TestBase):
                            'room_id': 'room'}],
                          self.sent_to_hipchat)
 
+    def test_body_is_sent_when_summary_fails(self):
+        def flaky_hipchat_api_call(_, post_dict):
+            self.sent_to_hipchat.append(post_dict['message'])
+            if len(self.sent_to_hipchat) == 1:
+                raise ValueError('transient 500')
+
+        self.mock(alertlib.Alert, '_make_hipchat_api_call',
+                  flaky_hipchat_api_call)
+        alertlib.Alert('body text', summary='sum').send_to_hipchat('room')
+        self.assertEqual(['sum', 'body text'], self.sent_to_hipchat)
+        self.assertEqual(1, len(self.sent_to_error_log))
+        self.assertIn('transient 500', self.sent_to_error_log[0][0])
+        del self.sent_to_error_log[:]
+
     def test_html(self):
         alertlib.Alert('<b>test message</b>', html=True).send_to_hipchat('rm')
         self.assertEqual([{'auth_token': '<hipchat token>',
@@ -242,6 +385,521 @@ class HipchatTest(TestBase):
                            'room_id': 'rm'}],
                          self.sent_to_hipchat)
 
+    def test_async_returns_before_hipchat_acknowledges(self):
+        acknowledge = threading.Event()
+
+        def slow_hipchat_api_call(_, post_dict):
+            acknowledge.wait()
+            self.sent_to_hipchat.append(post_dict)
+
+        self.mock(alertlib.Alert, '_make_hipchat_api_call',
+                  slow_hipchat_api_call)
+        alertlib.enable_async_hipchat()
+        try:
+            alertlib.Alert('test message').send_to_hipchat('1s and 0s')
+            self.assertEqual([], self.sent_to_hipchat)
+            acknowledge.set()
+        finally:
+            alertlib.disable_async_hipchat()
+        self.assertEqual(1, len(self.sent_to_hipchat))
+
+    def test_forked_child_does_not_wait_on_parents_posts(self):
+        acknowledge = threading.Event()
+
+        def slow_hipchat_api_call(_, post_dict):
+            acknowledge.wait()
+            self.sent_to_hipchat.append(post_dict['message'])
+
+        def child():
+            alertlib.Alert._make_hipchat_api_call = (
+                lambda _, post_dict:
+                    self.sent_to_hipchat.append(post_dict['message']))
+            alertlib.disable_async_hipchat(0)
+            alertlib.Alert('child').send_to_hipchat('1s and 0s')
+            return (['child'] == self.sent_to_hipchat and
+                    alertlib.flush_hipchat(timeout=1))
+
+        self.mock(alertlib.Alert, '_make_hipchat_api_call',
+                  slow_hipchat_api_call)
+        alertlib.enable_async_hipchat()
+        try:
+            alertlib.Alert('parent').send_to_hipchat('1s and 0s')
+            self.assertTrue(_run_in_forked_child(child))
+            acknowledge.set()
+        finally:
+            alertlib.disable_async_hipchat()
+        self.assertEqual(['parent'], self.sent_to_hipchat)
+
+    def test_async_keeps_per_room_order(self):
+        alertlib.enable_async_hipchat()
+        try:
+            for room in ('room1', 'room2', 'room3'):
+                alertlib.Alert('test message', summary='test') \
+                    .send_to_hipchat(room)
+            self.assertTrue(alertlib.flush_hipchat(timeout=10))
+        finally:
+            alertlib.disable_async_hipchat()
+
+        for room in ('room1', 'room2', 'room3'):
+            self.assertEqual(['test', 'test message'],
+                             [p['message'] for p in self.sent_to_hipchat
+                              if p['room_id'] == room])
+
+
+class HipchatCoalescingTest(TestBase):
+    def setUp(self):
+        super(HipchatCoalescingTest, self).setUp()
+        # A long window, so only our explicit flushes send anything.
+        alertlib.enable_hipchat_coalescing(window_secs=600)
+        self.addCleanup(alertlib.disable_hipchat_coalescing)
+
+    def test_coalesces_per_room(self):
+        for i in xrange(100):
+            alertlib.Alert('message %s' % i).send_to_hipchat('1s and 0s')
+        alertlib.Alert('other room').send_to_hipchat('other')
+        self.assertEqual([], self.sent_to_hipchat)
+
+        alertlib.flush_hipchat()
+        self.assertEqual(2, len(self.sent_to_hipchat))
+        self.assertEqual('\n'.join('message %s' % i for i in xrange(100)),
+                         self.sent_to_hipchat[0]['message'])
+        self.assertEqual('other room', self.sent_to_hipchat[1]['message'])
+
+    def test_color_and_notify_are_kept_separate(self):
+        alertlib.Alert('info').send_to_hipchat('1s and 0s')
+        alertlib.Alert('error', severity=logging.ERROR) \
+            .send_to_hipchat('1s and 0s')
+        alertlib.Alert('beep').send_to_hipchat('1s and 0s', notify=True)
+        alertlib.flush_hipchat()
+        self.assertEqual([('info', 'purple', 0),
+                          ('error', 'red', 0),
+                          ('beep', 'purple', 1)],
+                         [(p['message'], p['color'], p['notify'])
+                          for p in self.sent_to_hipchat])
+
+    def test_summary_stays_before_its_body(self):
+        alertlib.Alert('earlier page', severity=logging.CRITICAL) \
+            .send_to_hipchat('1s and 0s')
+        alertlib.Alert('the body', summary='the summary',
+                       severity=logging.CRITICAL).send_to_hipchat('1s and 0s')
+        alertlib.Alert('<b>html</b>', summary='html summary', html=True) \
+            .send_to_hipchat('1s and 0s')
+        alertlib.flush_hipchat()
+        self.assertEqual([('the summary', 'text', 0),
+                          ('earlier page\nthe body', 'text', 1),
+                          ('html summary', 'text', 0),
+                          ('<b>html</b>', 'html', 0)],
+                         [(p['message'], p['message_format'], p['notify'])
+                          for p in self.sent_to_hipchat])
+
+    def test_overflow_splits_into_few_posts(self):
+        for _ in xrange(10):
+            alertlib.Alert('a' * 4000).send_to_hipchat('1s and 0s')
+        alertlib.flush_hipchat()
+        self.assertEqual(5, len(self.sent_to_hipchat))
+        for post in self.sent_to_hipchat:
+            self.assertLess(len(post['message']), 10000)
+
+    def test_flushes_after_window(self):
+        alertlib.enable_hipchat_coalescing(window_secs=0.01)
+        alertlib.Alert('test message').send_to_hipchat('1s and 0s')
+        alertlib.Alert('test message 2').send_to_hipchat('1s and 0s')
+        deadline = time.time() + 10
+        while not self.sent_to_hipchat and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(['test message\ntest message 2'],
+                         [p['message'] for p in self.sent_to_hipchat])
+
+
+class DNSCacheTest(TestBase):
+    def setUp(self):
+        super(DNSCacheTest, self).setUp()
+        self.sent_to_warning_log = []
+        self.mock(alertlib.logging, 'warning',
+                  lambda *args: self.sent_to_warning_log.append(args))
+        self.now = 1400000000
+        self.mock(alertlib.time, 'time', lambda: self.now)
+        self.lookups = []
+        self.ips = {'example.com': ['10.0.0.1']}
+        self.mock(alertlib.socket, 'getaddrinfo', self._getaddrinfo)
+        self.cache = alertlib._DNSCache(ttl_secs=300, refresh_secs=60)
+
+    def _getaddrinfo(self, hostname, port, family, socktype):
+        self.lookups.append(hostname)
+        if hostname not in self.ips:
+            raise alertlib.socket.gaierror('no such host')
+        retval = []
+        for ip in self.ips[hostname]:
+            if ':' in ip:
+                retval.append((socket.AF_INET6, socktype, 6, '',
+                               (ip, 0, 0, 0)))
+            else:
+                retval.append((socket.AF_INET, socktype, 6, '', (ip, 0)))
+        return retval
+
+    def _wait_for_refreshes(self):
+        for thread in threading.enumerate():
+            if thread.name == 'alertlib-dns-refresh':
+                thread.join()
+
+    def test_caches(self):
+        self.assertEqual('10.0.0.1', self.cache.resolve('example.com'))
+        self.now += 100
+        self.assertEqual('10.0.0.1', self.cache.resolve('example.com'))
+        self.assertEqual(['example.com'], self.lookups)
+        self.assertEqual((1, 1), (self.cache.num_hits, self.cache.num_misses))
+
+    def test_refreshes_in_background_before_expiry(self):
+        self.cache.resolve('example.com')
+        self.ips['example.com'] = ['10.0.0.2']
+        self.now += 250             # within refresh_secs of expiring
+        # We don't wait for the refresh...
+        self.assertEqual('10.0.0.1', self.cache.resolve('example.com'))
+        self._wait_for_refreshes()
+        # ...but it's done by the next time we're asked.
+        self.now += 100
+        self.assertEqual('10.0.0.2', self.cache.resolve('example.com'))
+        self.assertEqual(2, len(self.lookups))
+        self.assertEqual((2, 1), (self.cache.num_hits, self.cache.num_misses))
+
+    def test_does_not_wait_for_lookup_after_expiry(self):
+        self.cache.resolve('example.com')
+        self.ips['example.com'] = ['10.0.0.2']
+        self.now += 301
+        self.assertEqual('10.0.0.1', self.cache.resolve('example.com'))
+        self.assertEqual(1, self.cache.num_stale)
+        self._wait_for_refreshes()
+        self.assertEqual('10.0.0.2', self.cache.resolve('example.com'))
+
+    def test_falls_back_to_last_known_good(self):
+        self.cache.resolve('example.com')
+        del self.ips['example.com']
+        self.now += 301
+        self.assertEqual('10.0.0.1', self.cache.resolve('example.com'))
+        self._wait_for_refreshes()
+        self.assertEqual(1, len(self.sent_to_warning_log))
+        # We keep trying to look it up, though.
+        self.assertEqual('10.0.0.1', self.cache.resolve('example.com'))
+        self._wait_for_refreshes()
+        self.assertEqual(2, self.cache.num_stale)
+        self.assertEqual(3, len(self.lookups))
+
+    def test_unknown_host(self):
+        with self.assertRaises(alertlib.socket.error):
+            self.cache.resolve('nosuchhost.example.com')
+
+    def test_keeps_every_address(self):
+        self.ips['example.com'] = ['::1', '10.0.0.1', '10.0.0.2']
+        self.assertEqual([(socket.AF_INET6, ('::1', 0, 0, 0)),
+                          (socket.AF_INET, ('10.0.0.1', 0)),
+                          (socket.AF_INET, ('10.0.0.2', 0))],
+                         self.cache.resolve_all('example.com'))
+        self.assertEqual('10.0.0.1', self.cache.resolve('example.com'))
+        self.assertEqual('::1', self.cache.resolve('example.com',
+                                                   socket.AF_INET6))
+
+    def test_no_address_of_the_right_family(self):
+        self.ips['example.com'] = ['::1']
+        with self.assertRaises(alertlib.socket.gaierror):
+            self.cache.resolve('example.com')
+
+    def test_create_connection_tries_each_address(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        # Nothing is listening on the IPv6 address, so we fail over.
+        self.ips['example.com'] = ['::1', '127.0.0.1']
+        self.mock(alertlib, '_DNS_CACHE', self.cache)
+        sock = alertlib._create_connection(
+            ('example.com', server.getsockname()[1]), 5)
+        self.addCleanup(sock.close)
+        self.assertEqual(server.getsockname(), sock.getpeername())
+
+    def test_smtp_connects_via_cache(self):
+        connections = []
+        self.mock(alertlib, '_create_connection',
+                  lambda address, timeout: connections.append(address))
+
+        class FakeSMTP(object):
+            def connect(self, host):
+                (hostname, port) = host.split(':')
+                self._get_socket(hostname, int(port), None)
+                return (220, 'hi')
+
+        self.mock(alertlib.smtplib, 'SMTP', FakeSMTP)
+        alertlib._SMTPConnectionPool._connect('smtp.example.com:2525')
+        self.assertEqual([('smtp.example.com', 2525)], connections)
+
+
+class HTTPSConnectionPoolTest(TestBase):
+    def setUp(self):
+        super(HTTPSConnectionPoolTest, self).setUp()
+        self.connections = []
+        test = self
+
+        class FakeResponse(object):
+            status = 200
+
+            def __init__(self, will_close):
+                self.will_close = will_close
+
+            def read(self):
+                return 'ok'
+
+            def getheaders(self):
+                return []
+
+        class FakeHTTPSConnection(object):
+            def __init__(self, host, port=None, timeout=None):
+                self.host = host
+                self.port = port
+                self.tunnel = None
+                self.requests = []
+                self.closed = False
+                self.server_hung_up = False
+                self.response_error = None
+                test.connections.append(self)
+
+            def set_tunnel(self, host, headers=None):
+                self.tunnel = (host, headers)
+
+            def request(self, method, path, body, headers):
+                if self.server_hung_up:
+                    raise alertlib.httplib.BadStatusLine('')
+                self.requests.append((method, path, body))
+
+            def getresponse(self):
+                if self.response_error:
+                    raise self.response_error
+                return FakeResponse(will_close=False)
+
+            def close(self):
+                self.closed = True
+
+        self.mock(alertlib.httplib, 'HTTPSConnection', FakeHTTPSConnection)
+        self.pool = alertlib._HTTPSConnectionPool(max_size=1,
+                                                  max_idle_secs=60)
+
+    def test_reuses_connection(self):
+        for _ in xrange(3):
+            self.assertEqual((200, {}, 'ok'),
+                             self.pool.request('POST', 'https://h/p', 'b'))
+        self.assertEqual(1, len(self.connections))
+        self.assertEqual([('POST', '/p', 'b')] * 3,
+                         self.connections[0].requests)
+
+    def test_separate_hosts(self):
+        self.pool.request('GET', 'https://h1/p')
+        self.pool.request('GET', 'https://h2/p?q=1')
+        self.assertEqual(['h1', 'h2'], [c.host for c in self.connections])
+        self.assertEqual([('GET', '/p?q=1', None)],
+                         self.connections[1].requests)
+
+    def test_forked_child_gets_its_own_connections(self):
+        def child():
+            self.pool.request('POST', 'https://h/p', 'child')
+            return (2 == len(self.connections) and
+                    [('POST', '/p', 'child')] == self.connections[1].requests)
+
+        self.pool.request('POST', 'https://h/p', 'parent')
+        self.assertTrue(_run_in_forked_child(child))
+        self.assertFalse(self.connections[0].closed)
+        self.pool.request('POST', 'https://h/p', 'parent')
+        self.assertEqual([('POST', '/p', 'parent')] * 2,
+                         self.connections[0].requests)
+
+    def test_reconnects_when_server_hangs_up(self):
+        self.pool.request('POST', 'https://h/p', 'b')
+        self.connections[0].server_hung_up = True
+        self.assertEqual((200, {}, 'ok'),
+                         self.pool.request('POST', 'https://h/p'))
+        self.assertEqual(2, len(self.connections))
+        self.assertTrue(self.connections[0].closed)
+
+    def test_reconnects_when_reset_before_response(self):
+        self.pool.request('POST', 'https://h/p', 'b')
+        self.connections[0].response_error = socket.error(
+            alertlib.errno.ECONNRESET, 'Connection reset by peer')
+        self.assertEqual((200, {}, 'ok'),
+                         self.pool.request('POST', 'https://h/p', 'b'))
+        self.assertEqual(2, len(self.connections))
+
+    def test_does_not_resend_after_timeout(self):
+        self.pool.request('POST', 'https://h/p', 'b')
+        self.connections[0].response_error = socket.timeout('timed out')
+        with self.assertRaises(socket.timeout):
+            self.pool.request('POST', 'https://h/p', 'b')
+        # The server may well have gotten the second post, so we didn't
+        # post it again.
+        self.assertEqual(1, len(self.connections))
+        self.assertEqual(2, len(self.connections[0].requests))
+        self.assertTrue(self.connections[0].closed)
+
+    def test_tunnels_through_proxy(self):
+        self.mock(alertlib.urllib, 'getproxies',
+                  lambda: {'https': 'http://me:pw@proxy.example.com:3128'})
+        self.mock(alertlib.urllib, 'proxy_bypass', lambda host: host == 'h2')
+        self.pool.request('POST', 'https://h/p', 'b')
+        self.pool.request('POST', 'https://h2/p', 'b')
+        self.assertEqual(('proxy.example.com', 3128),
+                         (self.connections[0].host, self.connections[0].port))
+        self.assertEqual(('h', {'Proxy-Authorization': 'Basic bWU6cHc='}),
+                         self.connections[0].tunnel)
+        self.assertEqual('h2', self.connections[1].host)
+        self.assertIsNone(self.connections[1].tunnel)
+
+    def test_idle_eviction(self):
+        now = time.time()
+        self.mock(alertlib.time, 'time', lambda: now)
+        self.pool.request('POST', 'https://h/p')
+        now += 61
+        self.pool.request('POST', 'https://h/p')
+        self.assertEqual(2, len(self.connections))
+        self.assertTrue(self.connections[0].closed)
+
+    def test_max_size(self):
+        (conn1, _) = self.pool._checkout('h')
+        (conn2, _) = self.pool._checkout('h')
+        self.pool._checkin('h', conn1)
+        self.pool._checkin('h', conn2)
+        self.assertFalse(conn1.closed)
+        self.assertTrue(conn2.closed)
+
+
+class HipchatThrottlingTest(TestBase):
+    def _wait_for_hipchat(self, num_posts):
+        deadline = time.time() + 10
+        while len(self.sent_to_hipchat) < num_posts and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_paces_posts_to_a_room(self):
+        alertlib.configure_hipchat_throttling(room_rate=100, room_burst=1)
+        alertlib.Alert('test message 1').send_to_hipchat('1s and 0s')
+        alertlib.Alert('test message 2').send_to_hipchat('1s and 0s')
+        self.assertEqual(2, len(self.sent_to_hipchat))
+        self.assertEqual({'throttled': 1, 'retried': 0, 'dropped': 0},
+                         alertlib.hipchat_stats())
+
+    def test_retries_later_when_over_budget(self):
+        alertlib.configure_hipchat_throttling(room_rate=50, room_burst=1,
+                                              max_wait_secs=0)
+        alertlib.Alert('test message 1').send_to_hipchat('1s and 0s')
+        alertlib.Alert('test message 2').send_to_hipchat('1s and 0s')
+        self.assertEqual(1, len(self.sent_to_hipchat))
+        self._wait_for_hipchat(2)
+        self.assertEqual(2, len(self.sent_to_hipchat))
+        self.assertEqual({'throttled': 1, 'retried': 1, 'dropped': 0},
+                         alertlib.hipchat_stats())
+
+    def test_honors_retry_after(self):
+        responses = [alertlib._HipchatRateLimitedError(0.01)]
+
+        def rate_limited_hipchat_api_call(_, post_dict):
+            if responses:
+                raise responses.pop()
+            self.sent_to_hipchat.append(post_dict)
+
+        self.mock(alertlib.Alert, '_make_hipchat_api_call',
+                  rate_limited_hipchat_api_call)
+        alertlib.Alert('test message').send_to_hipchat('1s and 0s')
+        self._wait_for_hipchat(1)
+        self.assertEqual(1, len(self.sent_to_hipchat))
+        self.assertEqual({'throttled': 1, 'retried': 1, 'dropped': 0},
+                         alertlib.hipchat_stats())
+
+    def test_drops_when_retry_queue_is_full(self):
+        alertlib.configure_hipchat_throttling(max_queued_retries=0)
+
+        def rate_limited_hipchat_api_call(_, post_dict):
+            raise alertlib._HipchatRateLimitedError(10)
+
+        self.mock(alertlib.Alert, '_make_hipchat_api_call',
+                  rate_limited_hipchat_api_call)
+        alertlib.Alert('test message').send_to_hipchat('1s and 0s')
+        self.assertEqual({'throttled': 1, 'retried': 0, 'dropped': 1},
+                         alertlib.hipchat_stats())
+        self.assertEqual(1, len(self.sent_to_error_log))
+        del self.sent_to_error_log[:]
+
+    def test_drops_when_retry_after_is_too_long(self):
+        def rate_limited_hipchat_api_call(_, post_dict):
+            raise alertlib._HipchatRateLimitedError(3600)
+
+        self.mock(alertlib.Alert, '_make_hipchat_api_call',
+                  rate_limited_hipchat_api_call)
+        start = time.time()
+        alertlib.Alert('test message').send_to_hipchat('1s and 0s')
+        self.assertTrue(alertlib.flush_hipchat(timeout=10))
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual({'throttled': 1, 'retried': 0, 'dropped': 1},
+                         alertlib.hipchat_stats())
+        self.assertEqual(1, len(self.sent_to_error_log))
+        del self.sent_to_error_log[:]
+
+    def _rate_limit_first_post(self):
+        responses = [alertlib._HipchatRateLimitedError(0.01)]
+
+        def rate_limited_hipchat_api_call(_, post_dict):
+            if responses:
+                raise responses.pop()
+            self.sent_to_hipchat.append(post_dict)
+
+        self.mock(alertlib.Alert, '_make_hipchat_api_call',
+                  rate_limited_hipchat_api_call)
+
+    def test_retry_keeps_summary_before_body(self):
+        self._rate_limit_first_post()
+        alertlib.Alert('body text', summary='SUMMARY') \
+            .send_to_hipchat('1s and 0s')
+        alertlib.Alert('next message').send_to_hipchat('1s and 0s')
+        self.assertTrue(alertlib.flush_hipchat(timeout=10))
+        self.assertEqual(['SUMMARY', 'body text', 'next message'],
+                         [p['message'] for p in self.sent_to_hipchat])
+
+    def test_async_retry_keeps_summary_before_body(self):
+        self._rate_limit_first_post()
+        alertlib.enable_async_hipchat()
+        try:
+            alertlib.Alert('body text', summary='SUMMARY') \
+                .send_to_hipchat('1s and 0s')
+            self.assertTrue(alertlib.flush_hipchat(timeout=10))
+        finally:
+            alertlib.disable_async_hipchat()
+        self.assertEqual(['SUMMARY', 'body text'],
+                         [p['message'] for p in self.sent_to_hipchat])
+        self.assertEqual({'throttled': 1, 'retried': 1, 'dropped': 0},
+                         alertlib.hipchat_stats())
+
+    def test_unsent_posts_are_dropped_at_exit(self):
+        warnings = []
+        self.mock(alertlib.logging, 'warning',
+                  lambda *args: warnings.append(args))
+        acknowledge = threading.Event()
+
+        def slow_hipchat_api_call(_, post_dict):
+            acknowledge.wait()
+            self.sent_to_hipchat.append(post_dict)
+
+        self.mock(alertlib.Alert, '_make_hipchat_api_call',
+                  slow_hipchat_api_call)
+        alertlib.enable_async_hipchat()
+        try:
+            alertlib.Alert('body text', summary='SUMMARY') \
+                .send_to_hipchat('1s and 0s')
+            alertlib._flush_hipchat_at_exit(timeout=0.01)
+            self.assertEqual(2, alertlib.hipchat_stats()['dropped'])
+            self.assertEqual(1, len(warnings))
+        finally:
+            acknowledge.set()
+            alertlib.disable_async_hipchat()
+
+    def test_parse_retry_after(self):
+        self.assertEqual(120, alertlib._parse_retry_after('120'))
+        self.assertEqual(30, alertlib._parse_retry_after(None))
+        self.assertEqual(0, alertlib._parse_retry_after(
+            'Wed, 21 Oct 2015 07:28:00 GMT'))
+
 
 class EmailTest(TestBase):
     def test_google_mail(self):
@@ -691,6 +1349,224 @@ class EmailTest(TestBase):
         self.assertEqual([], self.sent_to_google_mail)
 
 
+class EmailTransportTest(TestBase):
+    def setUp(self):
+        super(EmailTransportTest, self).setUp()
+        self.gae_attempts = 0
+        orig_send_to_gae_email = alertlib.Alert._send_to_gae_email
+
+        def counting_send_to_gae_email(*args, **kwargs):
+            self.gae_attempts += 1
+            return orig_send_to_gae_email(*args, **kwargs)
+
+        self.mock(alertlib.Alert, '_send_to_gae_email',
+                  counting_send_to_gae_email)
+
+    def test_gae_is_cached(self):
+        self.assertEqual(None, alertlib.email_transport())
+        alertlib.Alert('test message').send_to_email('ka-admin')
+        self.assertEqual('gae', alertlib.email_transport())
+        alertlib.Alert('test message').send_to_email('ka-admin')
+        self.assertEqual(2, len(self.sent_to_google_mail))
+
+    def test_smtp_is_cached(self):
+        with disable_google_mail():
+            alertlib.Alert('test message').send_to_email('ka-admin')
+        self.assertEqual('smtp:localhost', alertlib.email_transport())
+
+        # We don't try appengine again once we know smtp works.
+        alertlib.Alert('test message').send_to_email('ka-admin')
+        alertlib.Alert('test message').send_to_pagerduty('oncall')
+        self.assertEqual(0, self.gae_attempts)
+        self.assertEqual(3, len(self.sent_to_sendmail))
+
+    def test_redetect(self):
+        with disable_google_mail():
+            alertlib.Alert('test message').send_to_email('ka-admin')
+        alertlib.redetect_email_transport()
+        alertlib.Alert('test message').send_to_email('ka-admin')
+        self.assertEqual('gae', alertlib.email_transport())
+        self.assertEqual(1, len(self.sent_to_google_mail))
+
+    def test_redetects_when_transport_fails(self):
+        alertlib.Alert('test message').send_to_email('ka-admin')
+        with disable_google_mail():
+            alertlib.Alert('test message').send_to_email('ka-admin')
+        self.assertEqual('smtp:localhost', alertlib.email_transport())
+        self.assertEqual(1, len(self.sent_to_sendmail))
+
+    def test_smtp_relay(self):
+        smtp_hosts = []
+        sendmail = alertlib._SMTP_POOL.sendmail
+        self.mock(alertlib._SMTP_POOL, 'sendmail',
+                  lambda host, *args: (smtp_hosts.append(host),
+                                       sendmail(host, *args)))
+        alertlib.set_smtp_relay('smtp.example.com:2525')
+        with disable_google_mail():
+            alertlib.Alert('test message').send_to_email('ka-admin')
+        self.assertEqual('smtp:smtp.example.com:2525',
+                         alertlib.email_transport())
+        self.assertEqual(['smtp.example.com:2525'], smtp_hosts)
+
+
+class EmailDigestTest(TestBase):
+    def setUp(self):
+        super(EmailDigestTest, self).setUp()
+        # A long window, so only our explicit flushes send anything.
+        alertlib.enable_email_digests(window_secs=600)
+        self.addCleanup(alertlib.disable_email_digests)
+
+    def test_digest_via_gae(self):
+        alertlib.Alert('disk is full').send_to_email('ka-admin')
+        alertlib.Alert('disk is still full').send_to_email('ka-admin')
+        self.assertEqual([], self.sent_to_google_mail)
+
+        alertlib.flush_email_digests()
+        self.assertEqual(1, len(self.sent_to_google_mail))
+        self.assertEqual('2 alerts', self.sent_to_google_mail[0]['subject'])
+        self.assertEqual(['ka-admin@khanacademy.org'],
+                         self.sent_to_google_mail[0]['to'])
+        body = self.sent_to_google_mail[0]['body']
+        self.assertIn('-- disk is full (', body)
+        self.assertIn('-- disk is still full (', body)
+        self.assertLess(body.index('disk is full'),
+                        body.index('disk is still full'))
+
+    def test_digest_via_sendmail(self):
+        with disable_google_mail():
+            alertlib.Alert('disk is full', severity=logging.WARNING) \
+                .send_to_email('ka-admin')
+            alertlib.Alert('<b>disk is on fire</b>', html=True,
+                           severity=logging.ERROR).send_to_email('ka-admin')
+            alertlib.flush_email_digests()
+
+        self.assertEqual(1, len(self.sent_to_sendmail))
+        (frm, to, msg) = self.sent_to_sendmail[0]
+        self.assertEqual(['ka-admin@khanacademy.org'], to)
+        self.assertIn('Content-Type: multipart/mixed', msg)
+        self.assertIn('Subject: ERROR: 2 alerts\n', msg)
+        self.assertIn('This is a digest of 2 alerts.', msg)
+        self.assertIn('Content-Description: WARNING: disk is full\n', msg)
+        self.assertIn('Content-Type: text/html', msg)
+        self.assertIn('<b>disk is on fire</b>', msg)
+
+    def test_digests_are_per_recipient_sender_and_severity(self):
+        alertlib.Alert('a').send_to_email('ka-admin')
+        alertlib.Alert('b').send_to_email('ka-admin', sender='cron')
+        alertlib.Alert('c').send_to_email(['ka-admin', 'ka-blackhole'])
+        alertlib.Alert('d', severity=logging.ERROR).send_to_email('ka-admin')
+        alertlib.Alert('e', severity=logging.DEBUG).send_to_email('ka-admin')
+        alertlib.flush_email_digests()
+        self.assertEqual(['2 alerts', '1 alert', '1 alert', 'ERROR: 1 alert'],
+                         [e['subject'] for e in self.sent_to_google_mail])
+
+    def test_critical_skips_the_window(self):
+        alertlib.Alert('on fire', severity=logging.CRITICAL) \
+            .send_to_email('ka-admin')
+        self.assertEqual(['**CRITICAL ERROR**: on fire'],
+                         [e['subject'] for e in self.sent_to_google_mail])
+
+    def test_flushes_after_window(self):
+        alertlib.enable_email_digests(window_secs=0.01)
+        alertlib.Alert('a').send_to_email('ka-admin')
+        deadline = time.time() + 10
+        while not self.sent_to_google_mail and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(['1 alert'],
+                         [e['subject'] for e in self.sent_to_google_mail])
+
+
+class SMTPConnectionPoolTest(TestBase):
+    def setUp(self):
+        super(SMTPConnectionPoolTest, self).setUp()
+        self.connections = []
+        test = self
+
+        class FakeSMTP(object):
+            def __init__(self):
+                self.host = None
+                self.sent = []
+                self.alive = True
+                self.closed = False
+                test.connections.append(self)
+
+            def sendmail(self, frm, to, msg):
+                if not self.alive:
+                    raise alertlib.smtplib.SMTPServerDisconnected()
+                self.sent.append(msg)
+
+            def connect(self, host):
+                self.host = host
+                return (220, 'hi')
+
+            def noop(self):
+                return (250, 'OK') if self.alive else (421, 'bye')
+
+            def quit(self):
+                self.closed = True
+
+            def close(self):
+                self.closed = True
+
+        self.mock(alertlib.smtplib, 'SMTP', FakeSMTP)
+        self.pool = alertlib._SMTPConnectionPool(max_size=1, max_idle_secs=60,
+                                                 max_messages=3)
+
+    def _send(self, msg='msg'):
+        self.pool.sendmail('localhost', 'frm', ['to'], msg)
+
+    def test_reuses_connection(self):
+        self._send('a')
+        self._send('b')
+        self.assertEqual(1, len(self.connections))
+        self.assertEqual(['a', 'b'], self.connections[0].sent)
+        self.assertFalse(self.connections[0].closed)
+
+    def test_forked_child_gets_its_own_connections(self):
+        def child():
+            self._send('child')
+            return (2 == len(self.connections) and
+                    ['child'] == self.connections[1].sent)
+
+        self._send('parent')
+        self.assertTrue(_run_in_forked_child(child))
+        self._send('parent')
+        self.assertEqual(['parent'] * 2, self.connections[0].sent)
+        self.assertFalse(self.connections[0].closed)
+
+    def test_recycles_after_max_messages(self):
+        for _ in xrange(4):
+            self._send()
+        self.assertEqual(2, len(self.connections))
+        self.assertEqual(3, len(self.connections[0].sent))
+        self.assertTrue(self.connections[0].closed)
+
+    def test_noop_liveness_check(self):
+        self._send()
+        self.connections[0].alive = False
+        self._send()
+        self.assertEqual(2, len(self.connections))
+        self.assertTrue(self.connections[0].closed)
+
+    def test_idle_eviction(self):
+        now = time.time()
+        self.mock(alertlib.time, 'time', lambda: now)
+        self._send()
+        now += 61
+        self._send()
+        self.assertEqual(2, len(self.connections))
+        self.assertTrue(self.connections[0].closed)
+
+    def test_shared_by_email_and_pagerduty(self):
+        self.mock(alertlib, '_SMTP_POOL', self.pool)
+        with disable_google_mail():
+            alertlib.Alert('test message') \
+                .send_to_email('ka-admin') \
+                .send_to_pagerduty('oncall')
+        self.assertEqual(1, len(self.connections))
+        self.assertEqual(2, len(self.connections[0].sent))
+
+
 class PagerDutyTest(TestBase):
     def test_multiple_recipients(self):
         alertlib.Alert('on fire!').send_to_pagerduty(['oncall', 'backup'])
@@ -718,6 +1594,125 @@ class PagerDutyTest(TestBase):
                          self.sent_to_google_mail)
 
 
+class PagerDutyDedupTest(TestBase):
+    def setUp(self):
+        super(PagerDutyDedupTest, self).setUp()
+        self.now = 1000
+        self.mock(alertlib.time, 'time', lambda: self.now)
+        alertlib.enable_pagerduty_dedup(ttl_secs=300, max_size=2)
+
+    def test_suppresses_across_alert_objects(self):
+        for _ in xrange(5):
+            alertlib.Alert('on fire!').send_to_pagerduty('oncall')
+        self.assertEqual(1, len(self.sent_to_google_mail))
+        self.assertEqual({'suppressed': 4}, alertlib.pagerduty_stats())
+
+    def test_summary_is_normalized(self):
+        alertlib.Alert('On  fire!').send_to_pagerduty('oncall')
+        alertlib.Alert('on fire!').send_to_pagerduty('oncall')
+        self.assertEqual(1, len(self.sent_to_google_mail))
+
+    def test_different_incidents_are_not_suppressed(self):
+        alertlib.Alert('on fire!').send_to_pagerduty('oncall')
+        alertlib.Alert('on fire!').send_to_pagerduty(['oncall', 'backup'])
+        alertlib.Alert('flooded!').send_to_pagerduty('oncall')
+        alertlib.Alert('on fire!', severity=logging.ERROR) \
+            .send_to_pagerduty('oncall')
+        self.assertEqual(4, len(self.sent_to_google_mail))
+
+    def test_suppressed_count_is_attached_after_ttl(self):
+        for _ in xrange(3):
+            alertlib.Alert('on fire!').send_to_pagerduty('oncall')
+        self.now += 301
+        alertlib.Alert('on fire!').send_to_pagerduty('oncall')
+        self.assertEqual(2, len(self.sent_to_google_mail))
+        # The summary is still 'on fire!', so the page is the same
+        # incident as before; only the body says what was suppressed.
+        self.assertEqual('on fire!', self.sent_to_google_mail[1]['subject'])
+        self.assertEqual('on fire!\n\n(+2 similar suppressed)\n',
+                         self.sent_to_google_mail[1]['body'])
+
+    def test_html_alerts_without_summary(self):
+        alertlib.Alert('<b>database down</b>', html=True) \
+            .send_to_pagerduty('oncall')
+        alertlib.Alert('<b>disk full on web-3</b>', html=True) \
+            .send_to_pagerduty('oncall')
+        alertlib.Alert('<b>database down</b>', html=True) \
+            .send_to_pagerduty('oncall')
+        self.assertEqual(['<b>database down</b>\n',
+                          '<b>disk full on web-3</b>\n'],
+                         [e['body'] for e in self.sent_to_google_mail])
+
+    def test_failed_page_is_not_remembered(self):
+        orig_send_to_email = alertlib.Alert._send_to_email
+        failures = [1]
+
+        def flaky_send_to_email(alert, email_addresses):
+            if failures:
+                failures.pop()
+                raise socket.error('mail server is down')
+            return orig_send_to_email(alert, email_addresses)
+
+        self.mock(alertlib.Alert, '_send_to_email', flaky_send_to_email)
+        alertlib.Alert('on fire!').send_to_pagerduty('oncall')
+        self.assertEqual(1, len(self.sent_to_error_log))
+        del self.sent_to_error_log[:]
+        alertlib.Alert('on fire!').send_to_pagerduty('oncall')
+        self.assertEqual(1, len(self.sent_to_google_mail))
+        self.assertEqual({'suppressed': 0}, alertlib.pagerduty_stats())
+
+    def test_suppressed_count_survives_failed_page(self):
+        alertlib.Alert('on fire!').send_to_pagerduty('oncall')
+        alertlib.Alert('on fire!').send_to_pagerduty('oncall')
+        self.now += 301
+        orig_send_to_email = alertlib.Alert._send_to_email
+        failures = [1]
+
+        def flaky_send_to_email(alert, email_addresses):
+            if failures:
+                failures.pop()
+                raise socket.error('mail server is down')
+            return orig_send_to_email(alert, email_addresses)
+
+        self.mock(alertlib.Alert, '_send_to_email', flaky_send_to_email)
+        alertlib.Alert('on fire!').send_to_pagerduty('oncall')
+        del self.sent_to_error_log[:]
+        alertlib.Alert('on fire!').send_to_pagerduty('oncall')
+        self.assertEqual('on fire!\n\n(+1 similar suppressed)\n',
+                         self.sent_to_google_mail[-1]['body'])
+
+    def test_concurrent_duplicates_are_suppressed(self):
+        orig_send_to_email = alertlib.Alert._send_to_email
+        sending = threading.Event()
+        finish_sending = threading.Event()
+
+        def slow_send_to_email(alert, email_addresses):
+            sending.set()
+            finish_sending.wait(10)
+            return orig_send_to_email(alert, email_addresses)
+
+        self.mock(alertlib.Alert, '_send_to_email', slow_send_to_email)
+        first = threading.Thread(
+            target=alertlib.Alert('on fire!').send_to_pagerduty,
+            args=('oncall',))
+        first.start()
+        sending.wait(10)
+        alertlib.Alert('on fire!').send_to_pagerduty('oncall')
+        finish_sending.set()
+        first.join(10)
+        self.assertEqual(1, len(self.sent_to_google_mail))
+        self.assertEqual({'suppressed': 1}, alertlib.pagerduty_stats())
+
+    def test_lru_eviction(self):
+        alertlib.Alert('one').send_to_pagerduty('oncall')
+        alertlib.Alert('two').send_to_pagerduty('oncall')
+        alertlib.Alert('one').send_to_pagerduty('oncall')   # suppressed
+        alertlib.Alert('three').send_to_pagerduty('oncall')  # evicts 'two'
+        alertlib.Alert('two').send_to_pagerduty('oncall')
+        self.assertEqual(['one', 'two', 'three', 'two'],
+                         [e['subject'] for e in self.sent_to_google_mail])
+
+
 class LogsTest(TestBase):
     def test_error_severity(self):
         alertlib.Alert('test message', severity=logging.ERROR).send_to_logs()
@@ -730,6 +1725,78 @@ class LogsTest(TestBase):
                          self.sent_to_syslog)
 
 
+class DirectSyslogTest(TestBase):
+    def setUp(self):
+        super(DirectSyslogTest, self).setUp()
+        self.addCleanup(alertlib.disable_direct_syslog)
+
+    def _recv_frames(self, sock, num_frames):
+        """Read num_frames octet-counted syslog frames from sock."""
+        data = ''
+        frames = []
+        while len(frames) < num_frames:
+            data += sock.recv(65536)
+            while ' ' in data:
+                (length, rest) = data.split(' ', 1)
+                if len(rest) < int(length):
+                    break
+                frames.append(rest[:int(length)])
+                data = rest[int(length):]
+        return frames
+
+    def test_format(self):
+        emitter = alertlib._SyslogEmitter(ident='myapp',
+                                          facility=syslog.LOG_LOCAL0,
+                                          nodelay=False)
+        emitter._hostname = 'myhost'
+        self.assertEqual(
+            '<131>1 2014-05-13T16:53:20.500000Z myhost myapp %s - - '
+            '\xef\xbb\xbfyo \xc3\xb7' % os.getpid(),
+            emitter.format(syslog.LOG_ERR, u'yo \xf7', now=1400000000.5))
+
+    def test_unix_socket(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'log')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        server.bind(path)
+        self.addCleanup(server.close)
+
+        alertlib.enable_direct_syslog(path, ident='myapp',
+                                      facility=syslog.LOG_LOCAL0)
+        alertlib.Alert('test message', severity=logging.ERROR).send_to_logs()
+        alertlib.Alert('test message 2').send_to_logs()
+        self.assertTrue(server.recv(1000).startswith('<131>1 '))
+        self.assertTrue(server.recv(1000).endswith(
+            ' myapp %s - - \xef\xbb\xbftest message 2' % os.getpid()))
+        self.assertEqual([], self.sent_to_syslog)
+
+    def test_buffered_tcp(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        alertlib.enable_direct_syslog(
+            '127.0.0.1:%s' % server.getsockname()[1], protocol='tcp',
+            buffered=True, flush_interval_secs=600)
+        (client, _) = server.accept()
+        client.settimeout(5)
+        self.addCleanup(client.close)
+        for i in xrange(3):
+            alertlib.Alert('test message %s' % i).send_to_logs()
+        alertlib.flush_syslog()
+        frames = self._recv_frames(client, 3)
+        self.assertEqual(['test message 0', 'test message 1',
+                          'test message 2'],
+                         [f.split('\xef\xbb\xbf')[1] for f in frames])
+
+    def test_unknown_protocol(self):
+        with self.assertRaises(ValueError):
+            alertlib.enable_direct_syslog('localhost:514',
+                                          protocol='carrier-pigeon')
+
+
 class GraphiteTest(TestBase):
     def test_value(self):
         alertlib.Alert('test message').send_to_graphite(
@@ -742,6 +1809,606 @@ class GraphiteTest(TestBase):
         self.assertEqual(['<hostedgraphite API key>.stats.test_message 1\n'],
                          self.sent_to_graphite)
 
+    def test_many_values_in_one_write(self):
+        alertlib.Alert('test message').send_many_to_graphite(
+            {'stats.b': 2.0, 'stats.a': 1.5, 'stats.c': 3})
+        self.assertEqual(['<hostedgraphite API key>.stats.a 1.5\n'
+                          '<hostedgraphite API key>.stats.b 2\n'
+                          '<hostedgraphite API key>.stats.c 3\n'],
+                         self.sent_to_graphite)
+
+    def test_many_values_with_timestamp(self):
+        alertlib.Alert('test message').send_many_to_graphite(
+            [('stats.b', 2), ('stats.a', 1)], timestamp=1400000000)
+        self.assertEqual(['<hostedgraphite API key>.stats.b 2 1400000000\n'
+                          '<hostedgraphite API key>.stats.a 1 1400000000\n'],
+                         self.sent_to_graphite)
+
+    def test_many_values_are_rate_limited_once(self):
+        alert = alertlib.Alert('test message', rate_limit=60)
+        alert.send_many_to_graphite({'stats.a': 1, 'stats.b': 2})
+        alert.send_many_to_graphite({'stats.a': 1, 'stats.b': 2})
+        self.assertEqual(1, len(self.sent_to_graphite))
+
+
+class GraphiteAggregationTest(TestBase):
+    def setUp(self):
+        super(GraphiteAggregationTest, self).setUp()
+        # A long interval, so only our explicit flushes send anything.
+        alertlib.enable_graphite_aggregation(flush_interval_secs=600)
+        self.addCleanup(alertlib.disable_graphite_aggregation)
+
+    def test_counters_are_summed(self):
+        alert = alertlib.Alert('test message')
+        for _ in xrange(10000):
+            alert.send_to_graphite('stats.num_failures')
+        alert.send_to_graphite('stats.num_bytes', 2.5)
+        alert.send_to_graphite('stats.num_bytes', 2.5)
+        self.assertEqual([], self.sent_to_graphite)
+
+        alertlib.flush_graphite()
+        self.assertEqual(
+            ['<hostedgraphite API key>.stats.num_bytes 5\n'
+             '<hostedgraphite API key>.stats.num_failures 10000\n'],
+            self.sent_to_graphite)
+
+    def test_gauges_keep_last_value(self):
+        alert = alertlib.Alert('test message')
+        for i in xrange(10):
+            alert.send_to_graphite('stats.queue_size', i, metric_type='gauge')
+        alertlib.flush_graphite()
+        self.assertEqual(['<hostedgraphite API key>.stats.queue_size 9\n'],
+                         self.sent_to_graphite)
+
+    def test_nothing_to_flush(self):
+        alertlib.flush_graphite()
+        self.assertEqual([], self.sent_to_graphite)
+
+    def test_unknown_metric_type(self):
+        with self.assertRaises(ValueError):
+            alertlib.Alert('test message').send_to_graphite(
+                'stats.test_message', metric_type='histogram')
+
+    def test_flushes_periodically(self):
+        alertlib.enable_graphite_aggregation(flush_interval_secs=0.01)
+        alertlib.Alert('test message').send_to_graphite('stats.test_message')
+        deadline = time.time() + 10
+        while not self.sent_to_graphite and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(['<hostedgraphite API key>.stats.test_message 1\n'],
+                         self.sent_to_graphite)
+
+    def test_forked_child_starts_over(self):
+        def child():
+            alertlib.Alert('test message').send_to_graphite('stats.child')
+            alertlib.flush_graphite()
+            return (self.sent_to_graphite ==
+                    ['<hostedgraphite API key>.stats.child 1\n'] and
+                    _flush_thread_is_running('alertlib-graphite-aggregator'))
+
+        alertlib.Alert('test message').send_to_graphite('stats.parent')
+        self.assertTrue(_run_in_forked_child(child))
+        alertlib.flush_graphite()
+        self.assertEqual(['<hostedgraphite API key>.stats.parent 1\n'],
+                         self.sent_to_graphite)
+
+
+class GraphitePickleTest(TestBase):
+    def setUp(self):
+        super(GraphitePickleTest, self).setUp()
+        self.sent_to_graphite_hosts = []
+
+        class FakeGraphiteSocket(object):
+            def __init__(_, hostname):
+                self.sent_to_graphite_hosts.append(hostname)
+
+            def send(_, arg, unit_ends=None):
+                self.sent_to_graphite.append(arg)
+
+        self.mock(alertlib, '_graphite_socket', FakeGraphiteSocket)
+        self.mock(alertlib.time, 'time', lambda: 1400000000.5)
+        # A long interval, so only our explicit flushes send anything.
+        alertlib.set_graphite_protocol('pickle', max_batch_size=3,
+                                       flush_interval_secs=600)
+        self.addCleanup(alertlib.set_graphite_protocol, 'plaintext')
+
+    def _unpickle(self, data):
+        """Return the list of batches in data."""
+        batches = []
+        while data:
+            (length,) = struct.unpack('!L', data[:4])
+            batches.append(cPickle.loads(data[4:4 + length]))
+            data = data[4 + length:]
+        return batches
+
+    def test_batches(self):
+        alert = alertlib.Alert('test message')
+        alert.send_to_graphite('stats.a', 4)
+        alert.send_to_graphite('stats.b', 2.5)
+        self.assertEqual([], self.sent_to_graphite)
+
+        alert.send_to_graphite('stats.c')    # fills up the batch
+        self.assertEqual(['carbon.hostedgraphite.com:2004'],
+                         self.sent_to_graphite_hosts)
+        self.assertEqual(1, len(self.sent_to_graphite))
+        self.assertEqual(
+            [[('<hostedgraphite API key>.stats.a', (1400000000, 4)),
+              ('<hostedgraphite API key>.stats.b', (1400000000, 2.5)),
+              ('<hostedgraphite API key>.stats.c', (1400000000, 1))]],
+            self._unpickle(self.sent_to_graphite[0]))
+
+    def test_flush(self):
+        alertlib.Alert('test message').send_to_graphite(
+            'stats.a', graphite_host='localhost:2004')
+        alertlib.flush_graphite()
+        self.assertEqual(['localhost:2004'], self.sent_to_graphite_hosts)
+        self.assertEqual(
+            [[('<hostedgraphite API key>.stats.a', (1400000000, 1))]],
+            self._unpickle(self.sent_to_graphite[0]))
+
+    def test_large_writes_are_split_into_frames(self):
+        sender = alertlib._graphite_sender('pickle')
+        sender._write('localhost:2004',
+                      [('stat%s' % i, (1, i)) for i in xrange(7)])
+        self.assertEqual([3, 3, 1],
+                         [len(batch) for batch
+                          in self._unpickle(self.sent_to_graphite[0])])
+
+    def test_aggregation_sends_via_pickle(self):
+        alertlib.enable_graphite_aggregation(flush_interval_secs=600)
+        try:
+            for _ in xrange(10):
+                alertlib.Alert('test message').send_to_graphite('stats.a')
+        finally:
+            alertlib.disable_graphite_aggregation()
+        alertlib.flush_graphite()
+        self.assertEqual(
+            [[('<hostedgraphite API key>.stats.a', (1400000000, 10))]],
+            self._unpickle(self.sent_to_graphite[0]))
+
+    def test_forked_child_starts_over(self):
+        def child():
+            alertlib.Alert('test message').send_to_graphite('stats.child')
+            alertlib.flush_graphite()
+            return ([[('<hostedgraphite API key>.stats.child',
+                       (1400000000, 1))]] ==
+                    self._unpickle(''.join(self.sent_to_graphite)) and
+                    _flush_thread_is_running('alertlib-graphite-pickle'))
+
+        alertlib.Alert('test message').send_to_graphite('stats.parent')
+        self.assertTrue(_run_in_forked_child(child))
+        alertlib.flush_graphite()
+        self.assertEqual(
+            [[('<hostedgraphite API key>.stats.parent', (1400000000, 1))]],
+            self._unpickle(''.join(self.sent_to_graphite)))
+
+    def test_unknown_protocol(self):
+        with self.assertRaises(ValueError):
+            alertlib.set_graphite_protocol('carrier-pigeon')
+
+
+class GraphiteConnectionTest(TestBase):
+    def setUp(self):
+        super(GraphiteConnectionTest, self).setUp()
+        self.sent_to_warning_log = []
+        self.mock(alertlib.logging, 'warning',
+                  lambda *args: self.sent_to_warning_log.append(args))
+        self.now = 1400000000
+        self.mock(alertlib.time, 'time', lambda: self.now)
+        # Find a free port, but don't listen on it yet.
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        self.port = s.getsockname()[1]
+        s.close()
+        self.server = None
+        self.conn = alertlib._GraphiteConnection('127.0.0.1:%s' % self.port,
+                                                 max_backlog_bytes=20)
+        self.addCleanup(self.conn.close)
+
+    def _listen(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', self.port))
+        self.server.listen(1)
+        self.addCleanup(self.server.close)
+
+    def _received(self, num_bytes):
+        (client, _) = self.server.accept()
+        client.settimeout(5)
+        data = ''
+        while len(data) < num_bytes:
+            data += client.recv(num_bytes - len(data))
+        client.close()
+        return data
+
+    def test_send(self):
+        self._listen()
+        self.assertTrue(self.conn.send('a.b 1\n'))
+        self.assertTrue(self.conn.send('a.c 2\n'))
+        self.assertEqual('a.b 1\na.c 2\n', self._received(12))
+        self.assertEqual(1, self.conn.num_connects)
+
+    def test_backlog_is_replayed_after_reconnecting(self):
+        self.assertFalse(self.conn.send('a.b 1\n'))   # connection refused
+        self.assertEqual(1, len(self.sent_to_warning_log))
+
+        self._listen()
+        self.assertFalse(self.conn.send('a.c 2\n'))   # still backing off
+        self.assertEqual(0, self.conn.num_connects)
+
+        self.now += 1
+        self.assertTrue(self.conn.send('a.d 3\n'))
+        self.assertEqual('a.b 1\na.c 2\na.d 3\n', self._received(18))
+        self.assertEqual(0, self.conn.num_dropped_bytes)
+
+    def test_backoff_grows(self):
+        self.conn.send('a.b 1\n')
+        self.now += 1
+        self.conn.send('a.b 1\n')
+        self.now += 1                     # we now wait 2 seconds
+        self.conn.send('a.b 1\n')
+        self.assertEqual(2, len(self.sent_to_warning_log))
+
+    def test_backlog_is_bounded(self):
+        for i in xrange(5):
+            self.conn.send('a.b %s\n' % i)
+        self.assertEqual(12, self.conn.num_dropped_bytes)
+
+        self._listen()
+        self.now += 1
+        self.conn.send('')
+        # Only whole lines are dropped.
+        self.assertEqual('a.b 2\na.b 3\na.b 4\n', self._received(18))
+
+    def test_plaintext_flush_retries_backlog(self):
+        self.mock(alertlib, '_GRAPHITE_CONNECTIONS',
+                  {self.conn.graphite_hostport: self.conn})
+        sender = alertlib._GraphitePlaintextSender()
+        self.assertFalse(self.conn.send('a.b 1\n'))   # connection refused
+
+        self._listen()
+        sender.flush()                                # still backing off
+        self.assertEqual(0, self.conn.num_connects)
+
+        self.now += 1
+        sender.flush()
+        self.assertEqual('a.b 1\n', self._received(6))
+        self.assertEqual(0, self.conn._backlog_bytes)
+
+    def test_backlog_left_at_exit_is_dropped(self):
+        self.mock(alertlib, '_GRAPHITE_CONNECTIONS',
+                  {self.conn.graphite_hostport: self.conn})
+        self.conn.send('a.b 1\n')                     # connection refused
+        self.now += 1
+        alertlib._drop_graphite_backlogs_at_exit()    # refused again
+        self.assertEqual(6, self.conn.num_dropped_bytes)
+        self.assertEqual(0, self.conn._backlog_bytes)
+        self.assertEqual(3, len(self.sent_to_warning_log))
+
+    def test_lines_written_before_a_failure_are_not_resent(self):
+        sockets = []
+
+        class FlakySocket(object):
+            """Takes max_bytes bytes (or all, if None), then fails."""
+            def __init__(self, max_bytes):
+                self.max_bytes = max_bytes
+                self.data = ''
+
+            def send(self, data):
+                if self.max_bytes is None:
+                    num_bytes = len(data)
+                elif len(self.data) < self.max_bytes:
+                    num_bytes = min(len(data),
+                                    self.max_bytes - len(self.data))
+                else:
+                    raise socket.error('Connection reset by peer')
+                self.data += data[:num_bytes]
+                return num_bytes
+
+            def close(self):
+                pass
+
+        max_bytes = [8, None]
+
+        def connect():
+            sockets.append(FlakySocket(max_bytes.pop(0)))
+            (self.conn._socket, self.conn._connect_time) = (sockets[-1],
+                                                            self.now)
+
+        self.mock(self.conn, '_connect', connect)
+        self.conn.send('a.b 1\na.c 2\na.d 3\n', [6, 12, 18])
+        self.assertEqual(12, self.conn._backlog_bytes)
+        self.now += 1
+        self.conn.send('a.e 4\n')
+        self.assertEqual('a.b 1\na.', sockets[0].data)
+        self.assertEqual('a.c 2\na.d 3\na.e 4\n', sockets[1].data)
+        self.assertEqual(0, self.conn.num_dropped_bytes)
+
+    def test_reconnects_periodically(self):
+        self._listen()
+        self.conn.send('a.b 1\n')
+        self.assertEqual('a.b 1\n', self._received(6))
+        self.now += 601
+        self.conn.send('a.b 2\n')
+        self.assertEqual('a.b 2\n', self._received(6))
+        self.assertEqual(2, self.conn.num_connects)
+
+
+class GraphiteConcurrencyTest(TestBase):
+    # TestBase mocks this out, so we hold on to the real one.
+    _graphite_socket = staticmethod(alertlib._graphite_socket)
+
+    def setUp(self):
+        super(GraphiteConcurrencyTest, self).setUp()
+        self.mock(alertlib, '_GRAPHITE_CONNECTIONS', {})
+
+    def test_lines_are_not_interleaved(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        conn = self._graphite_socket('127.0.0.1:%s'
+                                     % server.getsockname()[1])
+        self.addCleanup(conn.close)
+
+        received = []
+
+        def read_all():
+            (client, _) = server.accept()
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+
+        reader = threading.Thread(target=read_all)
+        reader.start()
+
+        num_threads = 8
+        num_lines = 200
+        # Long lines, so an unlocked send() would split them.
+        padding = 'x' * 5000
+
+        def write(thread_num):
+            for i in xrange(num_lines):
+                conn.send('stats.%s.%s%s %s\n'
+                          % (thread_num, padding, i, i))
+
+        writers = [threading.Thread(target=write, args=(n,))
+                   for n in xrange(num_threads)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        conn.close()
+        reader.join(10)
+
+        lines = ''.join(received).splitlines()
+        self.assertEqual(num_threads * num_lines, len(lines))
+        for n in xrange(num_threads):
+            expected = ['stats.%s.%s%s %s' % (n, padding, i, i)
+                        for i in xrange(num_lines)]
+            self.assertEqual(expected,
+                             [l for l in lines
+                              if l.startswith('stats.%s.' % n)])
+
+    def test_connections_are_shared_between_threads(self):
+        conns = []
+        threads = [threading.Thread(
+            target=lambda: conns.append(self._graphite_socket('a:2003')))
+            for _ in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(set(conns)))
+
+    def test_forked_child_gets_new_connections(self):
+        conn = self._graphite_socket('localhost:2003')
+        self.assertTrue(_run_in_forked_child(
+            lambda: self._graphite_socket('localhost:2003') is not conn))
+        self.assertIs(conn, self._graphite_socket('localhost:2003'))
+
+
+class GraphiteHistogramTest(TestBase):
+    def setUp(self):
+        super(GraphiteHistogramTest, self).setUp()
+        # A long interval, so only our explicit flushes send anything.
+        alertlib.configure_graphite_histograms(flush_interval_secs=600)
+        self.addCleanup(alertlib.configure_graphite_histograms)
+
+    def _sent(self):
+        """Return a dict from statistic to the value we sent for it."""
+        retval = {}
+        for write in self.sent_to_graphite:
+            for line in write.splitlines():
+                (path, value) = line.rsplit(' ', 1)
+                retval[path.split('.', 1)[1]] = float(value)
+        return retval
+
+    def test_summary(self):
+        alert = alertlib.Alert('test message')
+        for i in xrange(1, 101):
+            alert.send_to_graphite_histogram('stats.latency', i)
+        self.assertEqual([], self.sent_to_graphite)
+
+        alertlib.flush_graphite()
+        self.assertEqual(1, len(self.sent_to_graphite))
+        self.assertEqual({'stats.latency.count': 100,
+                          'stats.latency.sum': 5050,
+                          'stats.latency.min': 1,
+                          'stats.latency.max': 100,
+                          'stats.latency.mean': 50.5,
+                          'stats.latency.p50': 50.5,
+                          'stats.latency.p90': 90.1,
+                          'stats.latency.p99': 99.01},
+                         self._sent())
+
+    def test_percentiles_are_configurable(self):
+        alertlib.configure_graphite_histograms(flush_interval_secs=600,
+                                               percentiles=(99.9,))
+        alertlib.Alert('test message').send_to_graphite_histogram(
+            'stats.latency', 3)
+        alertlib.flush_graphite()
+        self.assertEqual(3, self._sent()['stats.latency.p99_9'])
+        self.assertNotIn('stats.latency.p50', self._sent())
+
+    def test_samples_are_bounded(self):
+        alertlib.configure_graphite_histograms(flush_interval_secs=600,
+                                               max_samples=10)
+        alert = alertlib.Alert('test message')
+        for i in xrange(1000):
+            alert.send_to_graphite_histogram('stats.latency', i)
+        histogram = alertlib._GRAPHITE_HISTOGRAMS._histograms.values()[0]
+        self.assertEqual(10, len(histogram.samples))
+        alertlib.flush_graphite()
+        sent = self._sent()
+        # These are exact, even though we only kept some of the samples.
+        self.assertEqual(1000, sent['stats.latency.count'])
+        self.assertEqual(0, sent['stats.latency.min'])
+        self.assertEqual(999, sent['stats.latency.max'])
+        self.assertEqual(499.5, sent['stats.latency.mean'])
+
+    def test_nothing_sent_without_samples(self):
+        alertlib.Alert('test message').send_to_graphite_histogram(
+            'stats.latency', 3)
+        alertlib.flush_graphite()
+        self.sent_to_graphite[:] = []
+        alertlib.flush_graphite()
+        self.assertEqual([], self.sent_to_graphite)
+
+    def test_forked_child_starts_over(self):
+        def child():
+            alertlib.Alert('test message').send_to_graphite_histogram(
+                'stats.child', 4)
+            alertlib.flush_graphite()
+            return (set(['stats.child']) ==
+                    set(k.rsplit('.', 1)[0] for k in self._sent()) and
+                    _flush_thread_is_running('alertlib-graphite-histograms'))
+
+        alertlib.Alert('test message').send_to_graphite_histogram(
+            'stats.parent', 3)
+        self.assertTrue(_run_in_forked_child(child))
+        alertlib.flush_graphite()
+        self.assertEqual(3, self._sent()['stats.parent.max'])
+        self.assertNotIn('stats.child.max', self._sent())
+
+    def test_pure_python_percentiles(self):
+        self.mock(alertlib, '_NUMPY', False)
+        samples = alertlib.array.array('d', [5, 1, 4, 2, 3])
+        self.assertEqual([1, 3, 4.6, 5],
+                         alertlib._percentiles(samples, [0, 50, 90, 100]))
+
+    def test_numpy_is_imported_when_needed(self):
+        fake_numpy = types.ModuleType('numpy')
+        fake_numpy.frombuffer = lambda samples: list(samples)
+        fake_numpy.percentile = lambda samples, percentiles: [
+            len(samples) * p for p in percentiles]
+        self.mock(alertlib, '_NUMPY', None)
+        real_numpy = sys.modules.pop('numpy', None)
+        self.addCleanup(lambda: sys.modules.update(numpy=real_numpy)
+                        if real_numpy else sys.modules.pop('numpy', None))
+        sys.modules['numpy'] = fake_numpy
+        samples = alertlib.array.array('d', [5, 1, 4, 2, 3])
+        self.assertEqual([0, 250], alertlib._percentiles(samples, [0, 50]))
+        self.assertIs(fake_numpy, alertlib._NUMPY)
+
+    @unittest.skipUnless(_have_numpy(), 'needs numpy')
+    def test_numpy_percentiles_match_pure_python(self):
+        samples = alertlib.array.array('d', [7, 1, 4, 2, 3, 10, 0.5])
+        percentiles = [0, 25, 50, 90, 99.9, 100]
+        self.mock(alertlib, '_NUMPY', None)
+        with_numpy = alertlib._percentiles(samples, percentiles)
+        self.assertTrue(alertlib._NUMPY)
+        self.mock(alertlib, '_NUMPY', False)
+        without_numpy = alertlib._percentiles(samples, percentiles)
+        for (a, b) in zip(with_numpy, without_numpy):
+            self.assertAlmostEqual(a, b)
+
+
+class GraphiteStatsdTest(TestBase):
+    def setUp(self):
+        super(GraphiteStatsdTest, self).setUp()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+        self.addCleanup(self.server.close)
+        self.host = '127.0.0.1:%s' % self.server.getsockname()[1]
+        # A long interval, so only our explicit flushes send anything.
+        alertlib.set_graphite_protocol('statsd', max_packet_size=100,
+                                       flush_interval_secs=600)
+        self.addCleanup(alertlib.set_graphite_protocol, 'plaintext')
+
+    def _send(self, *args, **kwargs):
+        kwargs.setdefault('graphite_host', self.host)
+        alertlib.Alert('test message').send_to_graphite(*args, **kwargs)
+
+    def test_metric_types(self):
+        self._send('stats.a', 4)
+        self._send('stats.b', 2.5, metric_type='gauge')
+        self._send('stats.c', 120, metric_type='timer')
+        alertlib.flush_graphite()
+        self.assertEqual('<hostedgraphite API key>.stats.a:4|c\n'
+                         '<hostedgraphite API key>.stats.b:2.5|g',
+                         self.server.recv(1000))
+        self.assertEqual('<hostedgraphite API key>.stats.c:120|ms',
+                         self.server.recv(1000))
+        self.assertEqual([], self.sent_to_graphite)
+
+    def test_packets_are_packed_up_to_max_size(self):
+        for i in xrange(5):
+            self._send('stats.%s' % i)
+        alertlib.flush_graphite()
+        packets = [self.server.recv(1000), self.server.recv(1000)]
+        # Each line is 36 bytes, so only 2 fit (with a newline) in 100.
+        self.assertEqual([2, 2], [len(p.splitlines()) for p in packets])
+        self.assertTrue(all(len(p) <= 100 for p in packets))
+        self.assertEqual('<hostedgraphite API key>.stats.4:1|c',
+                         self.server.recv(1000))
+
+    def test_sample_rate(self):
+        random_values = [0.05, 0.5]
+        self.mock(alertlib.random, 'random', random_values.pop)
+        self._send('stats.a', sample_rate=0.1)     # 0.5: not sampled
+        self._send('stats.b', sample_rate=0.1)     # 0.05: sampled
+        alertlib.flush_graphite()
+        self.assertEqual('<hostedgraphite API key>.stats.b:1|c|@0.1',
+                         self.server.recv(1000))
+
+    def test_per_call_protocol(self):
+        alertlib.set_graphite_protocol('plaintext')
+        self._send('stats.a', protocol='statsd')
+        self._send('stats.b', graphite_host='localhost:2003')
+        alertlib.flush_graphite()
+        self.assertEqual('<hostedgraphite API key>.stats.a:1|c',
+                         self.server.recv(1000))
+        self.assertEqual(['<hostedgraphite API key>.stats.b 1\n'],
+                         self.sent_to_graphite)
+
+    def test_forked_child_starts_over(self):
+        self._send('stats.a')
+        alertlib.flush_graphite()
+        self.server.recv(1000)
+        sender = alertlib._graphite_sender('statsd')
+        parent_socket = sender._socket
+        def child():
+            self._send('stats.child')
+            alertlib.flush_graphite()
+            return (sender._socket not in (None, parent_socket) and
+                    _flush_thread_is_running('alertlib-graphite-statsd'))
+
+        self._send('stats.parent')
+        self.assertTrue(_run_in_forked_child(child))
+        self.assertEqual('<hostedgraphite API key>.stats.child:1|c',
+                         self.server.recv(1000))
+        alertlib.flush_graphite()
+        self.assertEqual('<hostedgraphite API key>.stats.parent:1|c',
+                         self.server.recv(1000))
+
+    def test_unknown_protocol(self):
+        with self.assertRaises(ValueError):
+            self._send('stats.a', protocol='carrier-pigeon')
+
 
 class RateLimitingTest(TestBase):
     @staticmethod
@@ -772,12 +2439,78 @@ class RateLimitingTest(TestBase):
         self.assertEqual(1, len(self.sent_to_graphite))
 
     def test_different_alert_objects(self):
-        # Objects don't share state, so we won't rate limit here.
+        # Without a rate_limit, we never rate limit.
         for _ in xrange(100):
             alertlib.Alert('test message').send_to_graphite(
                 'stats.test_message', 4)
         self.assertEqual(100, len(self.sent_to_graphite))
 
+    def test_different_alert_objects_share_rate_limit(self):
+        for _ in xrange(100):
+            alertlib.Alert('test message', rate_limit=60).send_to_graphite(
+                'stats.test_message', 4)
+        self.assertEqual(1, len(self.sent_to_graphite))
+
+    def test_different_messages_and_severities(self):
+        for _ in xrange(100):
+            alertlib.Alert('test message', rate_limit=60).send_to_hipchat(
+                '1s and 0s')
+            alertlib.Alert('test message 2', rate_limit=60).send_to_hipchat(
+                '1s and 0s')
+            alertlib.Alert('test message', severity=logging.ERROR,
+                           rate_limit=60).send_to_hipchat('1s and 0s')
+        self.assertEqual(3, len(self.sent_to_hipchat))
+
+    def test_different_destinations(self):
+        alert = alertlib.Alert('test message', rate_limit=60)
+        for _ in xrange(100):
+            alert.send_to_hipchat('1s and 0s').send_to_hipchat('eng')
+        self.assertEqual(['1s and 0s', 'eng'],
+                         [p['room_id'] for p in self.sent_to_hipchat])
+
+    def test_custom_fingerprint(self):
+        alertlib.configure_rate_limiting(
+            fingerprint=lambda alert, service, destination: (
+                alert._get_summary(), service))
+        for i in xrange(100):
+            alertlib.Alert('test message %s' % i, summary='test',
+                           rate_limit=60).send_to_logs()
+        self.assertEqual(1, len(self.sent_to_syslog))
+
+    def test_does_not_keep_messages(self):
+        message = u'test message \u2603 ' * 1000
+        alertlib.Alert(message, rate_limit=60).send_to_logs()
+        alertlib.Alert(message, rate_limit=60).send_to_logs()
+        self.assertEqual(1, len(self.sent_to_syslog))
+        key = alertlib._RATE_LIMITER._states.keys()[0]
+        self.assertNotIn(message, key)
+        self.assertLess(len(repr(key)), 100)
+
+    def test_memory_is_bounded(self):
+        alertlib.configure_rate_limiting(max_size=10)
+        for i in xrange(100):
+            alertlib.Alert('test message %s' % i, rate_limit=60).send_to_logs()
+        self.assertEqual(10, len(alertlib._RATE_LIMITER._states))
+        # The most recently used ones are still rate limited...
+        alertlib.Alert('test message 99', rate_limit=60).send_to_logs()
+        self.assertEqual(100, len(self.sent_to_syslog))
+        # ...but we've forgotten the old ones.
+        alertlib.Alert('test message 0', rate_limit=60).send_to_logs()
+        self.assertEqual(101, len(self.sent_to_syslog))
+
+    def test_threads(self):
+        def send():
+            for _ in xrange(100):
+                alertlib.Alert('test message', rate_limit=60) \
+                    .send_to_graphite('stats.test_message')
+
+        threads = [threading.Thread(target=send) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(self.sent_to_graphite))
+
     def test_limiting_with_longer_delay(self):
         alert = alertlib.Alert('test message', rate_limit=60)
         with self._mock_time(10):
@@ -805,6 +2538,595 @@ class RateLimitingTest(TestBase):
         self.assertEqual(1, len(self.sent_to_syslog))
 
 
+class RateLimitPolicyTest(TestBase):
+    def setUp(self):
+        super(RateLimitPolicyTest, self).setUp()
+        self.now = 1400000000
+        self.mock(alertlib.time, 'time', lambda: self.now)
+
+    def _send_every(self, secs, num_times, rate_limit):
+        """Send an alert num_times, secs apart; return what got logged."""
+        for _ in xrange(num_times):
+            alertlib.Alert('test message', rate_limit=rate_limit) \
+                .send_to_logs()
+            self.now += secs
+        return [msg for (_, msg) in self.sent_to_syslog]
+
+    def test_interval_reports_suppressed(self):
+        self.assertEqual(
+            ['test message', 'test message\n\n(+5 similar suppressed)'],
+            self._send_every(10, 7, alertlib.IntervalLimit(59)))
+
+    def test_token_bucket_allows_bursts(self):
+        sent = self._send_every(1, 10, alertlib.TokenBucketLimit(60, 3))
+        self.assertEqual(3, len(sent))
+        # Then we get one token a minute.
+        self.now += 60
+        sent = self._send_every(1, 10, alertlib.TokenBucketLimit(60, 3))
+        self.assertEqual(4, len(sent))
+        self.assertEqual('test message\n\n(+7 similar suppressed)', sent[-1])
+
+    def test_sliding_window(self):
+        # 3 in any 60 seconds: at 0, 10, 20, then not until 60, 70, 80.
+        sent = self._send_every(10, 9, alertlib.SlidingWindowLimit(3, 60))
+        self.assertEqual(6, len(sent))
+        self.assertEqual('test message\n\n(+3 similar suppressed)', sent[3])
+
+    def test_sliding_window_state_is_bounded(self):
+        self._send_every(1, 100, alertlib.SlidingWindowLimit(3, 10))
+        state = alertlib._RATE_LIMITER._states.values()[0][1]
+        self.assertEqual(3, len(state))
+
+    def test_fixed_window(self):
+        self.now = 1400000020      # 20 seconds before a minute starts
+        # 2 per clock-minute: at :20 and :25, then :40 and :45.
+        sent = self._send_every(5, 8, alertlib.FixedWindowLimit(2, 60))
+        self.assertEqual(4, len(sent))
+
+    def test_per_backend(self):
+        alert = alertlib.Alert('test message',
+                               rate_limit={'logs': 60,
+                                           'hipchat': alertlib.IntervalLimit(
+                                               1)})
+        for _ in xrange(5):
+            alert.send_to_logs().send_to_hipchat('1s and 0s') \
+                .send_to_graphite('stats.test_message')
+            self.now += 2
+        self.assertEqual(1, len(self.sent_to_syslog))
+        self.assertEqual(5, len(self.sent_to_hipchat))
+        self.assertEqual(5, len(self.sent_to_graphite))
+
+    def test_suppressed_note_in_hipchat(self):
+        for _ in xrange(3):
+            alertlib.Alert('test message', rate_limit=60).send_to_hipchat(
+                '1s and 0s')
+            self.now += 31
+        self.assertEqual(['test message',
+                          'test message\n\n(+1 similar suppressed)'],
+                         [p['message'] for p in self.sent_to_hipchat])
+
+    def test_suppressed_note_in_given_summary(self):
+        for _ in xrange(3):
+            alertlib.Alert('test message', summary='test summary',
+                           rate_limit=60).send_to_hipchat('1s and 0s')
+            self.now += 31
+        # We send the summary first, since it differs from the message.
+        self.assertEqual(['test summary', 'test message',
+                          'test summary (+1 similar suppressed)',
+                          'test message\n\n(+1 similar suppressed)'],
+                         [p['message'] for p in self.sent_to_hipchat])
+
+    def test_suppressed_note_keeps_pagerduty_fingerprint(self):
+        alert = alertlib.Alert('test message', rate_limit=60)
+        self.assertEqual(
+            alertlib._PagerDutyDeduper.fingerprint(['a@b'], alert),
+            alertlib._PagerDutyDeduper.fingerprint(
+                ['a@b'], alert._with_suppressed_note(1)))
+
+
+class SharedRateLimitingTest(TestBase):
+    def setUp(self):
+        super(SharedRateLimitingTest, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'rate_limits.sqlite')
+        alertlib.configure_rate_limiting(path=self.path)
+
+    def _send(self):
+        alertlib.Alert('test message', rate_limit=60).send_to_logs()
+
+    def test_rate_limits(self):
+        for _ in xrange(10):
+            self._send()
+        self.assertEqual(1, len(self.sent_to_syslog))
+
+    def test_shared_between_limiters(self):
+        self._send()
+        # As though this were a different process.
+        alertlib.configure_rate_limiting(path=self.path)
+        self._send()
+        self.assertEqual(1, len(self.sent_to_syslog))
+
+    def test_rate_limit_expires(self):
+        now = [1400000000]
+        self.mock(alertlib.time, 'time', lambda: now[0])
+        self._send()
+        now[0] += 61
+        self._send()
+        self.assertEqual(2, len(self.sent_to_syslog))
+
+    def test_concurrent_processes(self):
+        pids = []
+        for _ in xrange(8):
+            pid = os.fork()
+            if pid == 0:
+                # We're the child: exit 0 if we got to send, 1 if not.
+                passed = alertlib._RATE_LIMITER.check(
+                    alertlib.Alert('test message'), 'logs', None,
+                    alertlib.IntervalLimit(60))
+                os._exit(0 if passed is not None else 1)
+            pids.append(pid)
+        statuses = [os.waitpid(pid, 0)[1] for pid in pids]
+        self.assertEqual(1, statuses.count(0))
+
+    def test_old_entries_are_pruned(self):
+        alertlib.configure_rate_limiting(path=self.path, max_age_secs=60,
+                                         prune_every=10)
+        now = [1400000000]
+        self.mock(alertlib.time, 'time', lambda: now[0])
+        for i in xrange(19):
+            alertlib.Alert('test message %s' % i, rate_limit=60).send_to_logs()
+            now[0] += 10
+        db = alertlib._RATE_LIMITER._connect()
+        # When sending the 10th message, we pruned the 3 that were
+        # more than 60 seconds old by then.
+        (num_rows,) = db.execute(
+            'SELECT COUNT(*) FROM rate_limit_states').fetchone()
+        self.assertEqual(16, num_rows)
+
+    def test_old_entries_are_pruned_by_short_lived_processes(self):
+        # Like a cron job: each process sends one alert, then exits.
+        def child(i):
+            alertlib.configure_rate_limiting(path=self.path, max_age_secs=0,
+                                             prune_every=5)
+            return alertlib._RATE_LIMITER.check(
+                alertlib.Alert('test message %s' % i), 'logs', None,
+                alertlib.IntervalLimit(60)) is not None
+
+        for i in xrange(20):
+            self.assertTrue(_run_in_forked_child(lambda: child(i)))
+        db = alertlib._RATE_LIMITER._connect()
+        # The 20th process pruned everything but its own entry.
+        (num_rows,) = db.execute(
+            'SELECT COUNT(*) FROM rate_limit_states').fetchone()
+        self.assertEqual(1, num_rows)
+
+    def test_failed_check_is_rolled_back(self):
+        limiter = alertlib._RATE_LIMITER
+        count_send = limiter._count_send
+
+        def count_send_then_fail(db):
+            count_send(db)
+            raise alertlib.sqlite3.OperationalError('disk I/O error')
+
+        self.mock(limiter, '_count_send', count_send_then_fail)
+        self.mock(alertlib.logging, 'warning', lambda *args: None)
+        self._send()
+        self.assertEqual(1, len(self.sent_to_syslog))   # sent anyway
+        db = limiter._connect()
+        for table in ('rate_limit_states', 'rate_limit_counters'):
+            (num_rows,) = db.execute(
+                'SELECT COUNT(*) FROM %s' % table).fetchone()
+            self.assertEqual(0, num_rows)
+
+    def test_lists_of_destinations(self):
+        for _ in xrange(2):
+            alertlib.Alert('test message', rate_limit=60).send_to_email(
+                ['ka-admin', 'ka-blackhole'])
+        self.assertEqual(1, len(self.sent_to_google_mail))
+
+    def test_str_and_unicode_fingerprints_are_the_same(self):
+        alertlib.configure_rate_limiting(
+            path=self.path, fingerprint=lambda alert, service, dest: 'key')
+        self._send()
+        alertlib.configure_rate_limiting(
+            path=self.path, fingerprint=lambda alert, service, dest: u'key')
+        self._send()
+        self.assertEqual(1, len(self.sent_to_syslog))
+
+    def test_fingerprint_must_be_strings(self):
+        alertlib.configure_rate_limiting(
+            path=self.path, fingerprint=lambda alert, service, dest: (
+                alert.message, alert.severity))
+        with self.assertRaises(TypeError):
+            self._send()
+
+    def test_needs_sqlite3(self):
+        sqlite3 = alertlib.sqlite3
+        del alertlib.sqlite3
+        self.addCleanup(setattr, alertlib, 'sqlite3', sqlite3)
+        with self.assertRaises(ImportError):
+            alertlib.configure_rate_limiting(path=self.path)
+
+
+class SendTest(TestBase):
+    def setUp(self):
+        super(SendTest, self).setUp()
+        # So our test backends don't outlive the test.
+        self.mock(alertlib, '_BACKENDS', dict(alertlib._BACKENDS))
+
+    def _register(self, name, send_fn):
+        class TestBackend(alertlib.Backend):
+            def send(self, alert, *args, **kwargs):
+                send_fn(alert, *args, **kwargs)
+
+        alertlib.register_backend(name, TestBackend())
+
+    def test_builtin_backends(self):
+        result = alertlib.Alert('test message').send(
+            [('hipchat', '1s and 0s'),
+             ('email', {'email_usernames': 'ka-admin'}),
+             ('logs', None),
+             ('graphite', ('stats.test_message', 4))])
+        self.assertTrue(result.ok)
+        self.assertEqual(['hipchat', 'email', 'logs', 'graphite'],
+                         [o.backend for o in result])
+        self.assertEqual(['sent'] * 4, [o.status for o in result])
+        self.assertTrue(all(o.latency_secs >= 0 for o in result))
+        self.assertEqual(1, len(self.sent_to_hipchat))
+        self.assertEqual(1, len(self.sent_to_google_mail))
+        self.assertEqual(1, len(self.sent_to_syslog))
+        self.assertEqual(['<hostedgraphite API key>.stats.test_message 4\n'],
+                         self.sent_to_graphite)
+
+    def test_dict_routes(self):
+        result = alertlib.Alert('test message').send({'logs': None})
+        self.assertEqual([('logs', None, 'sent', None)],
+                         [o[:4] for o in result])
+
+    def test_generator_routes(self):
+        result = alertlib.Alert('test message').send(
+            (name, None) for name in ('logs', 'logs'))
+        self.assertEqual(['sent', 'sent'], [o.status for o in result])
+        self.assertEqual(2, len(self.sent_to_syslog))
+
+    def test_backends_run_in_parallel(self):
+        self._register('slow', lambda alert: time.sleep(0.2))
+        start = time.time()
+        result = alertlib.Alert('test message').send([('slow', None)] * 4)
+        self.assertLess(time.time() - start, 0.6)
+        self.assertTrue(result.ok)
+        self.assertTrue(all(o.latency_secs >= 0.2 for o in result))
+
+    def test_failures(self):
+        def fail(alert):
+            raise ValueError('oops')
+
+        def fail_hipchat(post_dict):
+            raise IOError('hipchat is down')
+
+        self._register('broken', fail)
+        self.mock(alertlib.Alert, '_make_hipchat_api_call',
+                  lambda s, post_dict: fail_hipchat(post_dict))
+        result = alertlib.Alert('test message').send(
+            [('broken', None), ('hipchat', '1s and 0s'), ('logs', None)])
+        self.assertFalse(result.ok)
+        self.assertEqual(['failed', 'failed', 'sent'],
+                         [o.status for o in result])
+        self.assertEqual('oops', str(result.outcomes[0].error))
+        self.assertIsInstance(result.outcomes[1].error,
+                              alertlib.DeliveryError)
+        self.assertIn('hipchat is down', str(result.outcomes[1].error))
+        self.sent_to_error_log[:] = []      # we expected the hipchat error
+
+    def test_timeout(self):
+        go = threading.Event()
+        self._register('stuck', lambda alert: go.wait())
+        result = alertlib.Alert('test message').send(
+            [('stuck', None), ('logs', None)], timeout=0.1)
+        go.set()
+        self.assertEqual(['pending', 'sent'], [o.status for o in result])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            alertlib.Alert('test message').send([('carrier-pigeon', None)])
+
+    def test_async(self):
+        go = threading.Event()
+        self._register('stuck', lambda alert: go.wait())
+        future = alertlib.Alert('test message').send_async(
+            [('stuck', None), ('logs', None)])
+        self.assertFalse(future.done())
+
+        callback_results = []
+        called_back = threading.Event()
+        future.add_done_callback(
+            lambda f: (callback_results.append(f.result()), called_back.set()))
+        go.set()
+        result = future.result(timeout=10)
+        self.assertEqual(['sent', 'sent'], [o.status for o in result])
+        called_back.wait(10)
+        self.assertEqual([result], callback_results)
+        self.assertEqual(1, len(self.sent_to_syslog))
+
+    def test_async_test_mode(self):
+        alertlib.enter_test_mode()
+        self.addCleanup(alertlib.exit_test_mode)
+        result = alertlib.Alert('test message').send_async(
+            {'hipchat': '1s and 0s'}).result(timeout=10)
+        self.assertTrue(result.ok)
+        self.assertEqual([], self.sent_to_hipchat)
+        self.assertEqual(1, len(self.sent_to_info_log))
+
+    def test_async_no_routes(self):
+        self.assertEqual(
+            0, len(alertlib.Alert('test message').send_async([]).result()))
+
+    def test_broken_callback(self):
+        def broken_callback(future):
+            raise ValueError('oops')
+
+        called_back = threading.Event()
+        go = threading.Event()
+        self._register('stuck', lambda alert: go.wait())
+        future = alertlib.Alert('test message').send_async(
+            {'stuck': None})
+        future.add_done_callback(broken_callback)
+        future.add_done_callback(lambda f: called_back.set())
+        go.set()
+        self.assertTrue(called_back.wait(10))
+        self.assertEqual(['sent'], [o.status for o in future.result()])
+        self.assertEqual(1, len(self.sent_to_error_log))
+        del self.sent_to_error_log[:]
+
+    def test_queued_and_suppressed(self):
+        alertlib.enable_async_hipchat()
+        self.addCleanup(alertlib.disable_async_hipchat)
+        alertlib.enable_email_digests(window_secs=600)
+        self.addCleanup(alertlib.disable_email_digests)
+        alert = alertlib.Alert('test message', rate_limit={'logs': 60})
+        result = alert.send([('hipchat', '1s and 0s'),
+                             ('email', 'ka-admin'),
+                             ('logs', None),
+                             ('logs', None)])
+        self.assertTrue(result.ok)
+        self.assertEqual(['queued', 'queued', 'sent', 'suppressed'],
+                         [o.status for o in result])
+
+    def test_failures_in_other_threads_are_not_misattributed(self):
+        # A hipchat failure on a dispatcher thread, while we send to
+        # the logs, has nothing to do with the logs.
+        def fail_hipchat(post_dict):
+            raise IOError('hipchat is down')
+
+        self.mock(alertlib.Alert, '_make_hipchat_api_call',
+                  lambda s, post_dict: fail_hipchat(post_dict))
+        alertlib.enable_async_hipchat()
+        try:
+            result = alertlib.Alert('test message').send(
+                [('hipchat', '1s and 0s'), ('logs', None)])
+        finally:
+            alertlib.disable_async_hipchat()
+        self.assertEqual(['queued', 'sent'], [o.status for o in result])
+        self.assertEqual(1, len(self.sent_to_error_log))
+        del self.sent_to_error_log[:]
+
+    def test_graphite_unreachable(self):
+        # Find a port nobody is listening on.
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        graphite_host = '127.0.0.1:%s' % s.getsockname()[1]
+        s.close()
+
+        self.mock(alertlib, '_graphite_socket',
+                  GraphiteConcurrencyTest._graphite_socket)
+        self.mock(alertlib, '_GRAPHITE_CONNECTIONS', {})
+        self.mock(alertlib.logging, 'warning', lambda *args: None)
+        result = alertlib.Alert('test message').send(
+            [('graphite', {'statistic': 'a.b',
+                           'graphite_host': graphite_host})])
+        alertlib._GRAPHITE_CONNECTIONS[graphite_host].close()
+        # The line waits in the backlog until graphite comes back.
+        self.assertEqual(['queued'], [o.status for o in result])
+        self.assertTrue(result.ok)
+        self.assertLess(0, alertlib.graphite_stats()['backlog_bytes'])
+
+    def test_pool_threads_exit_when_stopped(self):
+        pool = alertlib._ThreadPool(max_workers=2)
+        go = threading.Event()
+        futures = [pool.submit(go.wait) for _ in xrange(3)]
+        threads = list(pool._threads)
+        self.assertEqual(2, len(threads))
+        go.set()
+        pool.stop()
+        # Queued work still gets done, then the threads exit.
+        self.assertEqual([True] * 3, [f.result(timeout=10) for f in futures])
+        self.assertFalse(any(t.is_alive() for t in threads))
+
+    def test_skipped(self):
+        self.mock(alertlib, 'hipchat_token', None)
+        self.mock(alertlib.logging, 'warning', lambda *args: None)
+        result = alertlib.Alert('test message').send({'hipchat': 'test'})
+        self.assertFalse(result.ok)
+        self.assertEqual(['skipped'], [o.status for o in result])
+
+
+class BackgroundDeliveryTest(TestBase):
+    def setUp(self):
+        super(BackgroundDeliveryTest, self).setUp()
+        self.addCleanup(alertlib.disable_background_delivery, 10)
+        # Sends to syslog wait until we say go.
+        self.go = threading.Event()
+        self.mock(alertlib.syslog, 'syslog',
+                  lambda prio, msg: (self.go.wait(),
+                                     self.sent_to_syslog.append(msg)))
+
+    def _send(self, message, severity=logging.INFO):
+        alertlib.Alert(message, severity=severity).send_to_logs()
+
+    def _wait_for_worker(self):
+        """Wait until the (only) worker is stuck on its first send."""
+        deadline = time.time() + 10
+        while (not alertlib.background_delivery_stats()['in_progress'] and
+               time.time() < deadline):
+            time.sleep(0.01)
+
+    def test_send_is_not_deferred(self):
+        alertlib.enable_background_delivery()
+        self.go.set()
+
+        def fail_hipchat(post_dict):
+            raise IOError('hipchat is down')
+
+        self.mock(alertlib.Alert, '_make_hipchat_api_call',
+                  lambda s, post_dict: fail_hipchat(post_dict))
+        alert = alertlib.Alert('test message')
+        for result in (alert.send([('logs', None), ('hipchat', 'test')]),
+                       alert.send_async([('logs', None), ('hipchat', 'test')])
+                       .result(timeout=10)):
+            self.assertEqual(['sent', 'failed'], [o.status for o in result])
+        self.assertEqual(['test message'] * 2, self.sent_to_syslog)
+        self.assertEqual(0, alertlib.background_delivery_stats()['delivered'])
+        del self.sent_to_error_log[:]
+
+    def test_sends_in_background(self):
+        alertlib.enable_background_delivery()
+        self._send('test message')
+        alertlib.Alert('test message').send_to_hipchat('1s and 0s') \
+            .send_to_graphite('stats.test_message')
+        # We returned without waiting for syslog.
+        self.assertEqual([], self.sent_to_syslog)
+        self.go.set()
+        self.assertTrue(alertlib.flush_background_delivery(10))
+        self.assertEqual(['test message'], self.sent_to_syslog)
+        self.assertEqual(1, len(self.sent_to_hipchat))
+        self.assertEqual(1, len(self.sent_to_graphite))
+        self.assertEqual({'queue_depth': 0, 'in_progress': 0,
+                          'delivered': 3, 'dropped': 0},
+                         alertlib.background_delivery_stats())
+
+    def test_drop_oldest(self):
+        alertlib.enable_background_delivery(max_queue_size=2, num_workers=1,
+                                            overflow='drop_oldest')
+        self._send('a')
+        self._wait_for_worker()
+        for message in ('b', 'c', 'd'):
+            self._send(message)
+        self.assertEqual(2, alertlib.background_delivery_stats()[
+            'queue_depth'])
+        self.go.set()
+        alertlib.flush_background_delivery(10)
+        self.assertEqual(['a', 'c', 'd'], self.sent_to_syslog)
+        self.assertEqual(1, alertlib.background_delivery_stats()['dropped'])
+
+    def test_drop_lowest_severity(self):
+        alertlib.enable_background_delivery(max_queue_size=2, num_workers=1,
+                                            overflow='drop_lowest_severity')
+        self._send('a')
+        self._wait_for_worker()
+        self._send('b', logging.ERROR)
+        self._send('c', logging.INFO)
+        self._send('d', logging.CRITICAL)     # drops c
+        self._send('e', logging.DEBUG)        # drops itself
+        self.go.set()
+        alertlib.flush_background_delivery(10)
+        self.assertEqual(['a', 'b', 'd'], self.sent_to_syslog)
+        self.assertEqual(2, alertlib.background_delivery_stats()['dropped'])
+
+    def test_block_with_timeout(self):
+        alertlib.enable_background_delivery(max_queue_size=1, num_workers=1,
+                                            block_timeout_secs=0.1)
+        self._send('a')
+        self._wait_for_worker()
+        self._send('b')
+        start = time.time()
+        self._send('c')
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.go.set()
+        alertlib.flush_background_delivery(10)
+        self.assertEqual(['a', 'b'], self.sent_to_syslog)
+        self.assertEqual(1, alertlib.background_delivery_stats()['dropped'])
+
+    def test_drain_deadline(self):
+        alertlib.enable_background_delivery(num_workers=1)
+        self._send('a')
+        self.assertFalse(alertlib.flush_background_delivery(0.1))
+        self.go.set()
+        self.assertTrue(alertlib.disable_background_delivery(10))
+        self.assertEqual(['a'], self.sent_to_syslog)
+
+    def test_forked_child_starts_over(self):
+        def child():
+            alertlib.syslog.syslog = (
+                lambda prio, msg: self.sent_to_syslog.append(msg))
+            self._send('child')
+            return (alertlib.flush_background_delivery(10) and
+                    ['child'] == self.sent_to_syslog)
+
+        alertlib.enable_background_delivery(num_workers=1)
+        self._send('a')
+        self._wait_for_worker()
+        self._send('b')
+        self.assertTrue(_run_in_forked_child(child))
+        self.go.set()
+        alertlib.flush_background_delivery(10)
+        self.assertEqual(['a', 'b'], self.sent_to_syslog)
+
+    def test_unknown_overflow_policy(self):
+        with self.assertRaises(ValueError):
+            alertlib.enable_background_delivery(overflow='drop_newest')
+
+
+class _CountingUnicode(unicode):
+    """A unicode string that counts how often it's formatted into another."""
+    def __init__(self, *args):
+        super(_CountingUnicode, self).__init__(*args)
+        self.num_conversions = 0
+
+    def __unicode__(self):
+        self.num_conversions += 1
+        return self[:]
+
+
+class LazyFormattingTest(TestBase):
+    def _send_everywhere(self, message, summary):
+        alertlib.Alert(message, summary=summary) \
+            .send_to_hipchat('1s and 0s') \
+            .send_to_email('ka-admin') \
+            .send_to_pagerduty('oncall') \
+            .send_to_logs() \
+            .send_to_graphite('stats.alerted')
+
+    def test_no_formatting_when_sending(self):
+        message = _CountingUnicode(u'a' * 1000000)
+        summary = _CountingUnicode(u'test summary')
+        self._send_everywhere(message, summary)
+        with disable_google_mail():
+            self._send_everywhere(message, summary)
+        self.assertEqual(0, message.num_conversions)
+        self.assertEqual(0, summary.num_conversions)
+
+    def test_formatting_in_test_mode(self):
+        message = _CountingUnicode(u'test message')
+        alertlib.enter_test_mode()
+        try:
+            self._send_everywhere(message, None)
+        finally:
+            alertlib.exit_test_mode()
+        self.assertEqual(2, message.num_conversions)
+
+    def test_formatting_on_error(self):
+        def broken_send_to_email(*args):
+            raise RuntimeError('no mail for you')
+
+        self.mock(alertlib.Alert, '_send_to_email', broken_send_to_email)
+        message = _CountingUnicode(u'test message')
+        alertlib.Alert(message).send_to_email('ka-admin')
+        self.assertEqual(1, message.num_conversions)
+        self.assertEqual(1, len(self.sent_to_error_log))
+        del self.sent_to_error_log[:]
+
+
 class IntegrationTest(TestBase):
     def test_chaining(self):
         # We send to hipchat a second time to make sure that
@@ -9,8 +9,11 @@ alert.py as well.
 
 import logging
 import os
+import shutil
+import StringIO
 import subprocess
 import sys
+import tempfile
 import unittest
 
 # This makes it so we can find timeout when running from repo-root.
@@ -214,6 +217,71 @@ class TestAlerts(unittest.TestCase):
              ],
             self.sent_to_info_log)
 
+    def test_graphite_statistic_values(self):
+        timeout.main('-n --graphite=stats.alert=3,,stats.bad,stats.worse=-2.5 '
+                     '0 true'.split())
+        self.assertEqual(
+            [('alertlib: would send to graphite: stats.alert 3',),
+             ('alertlib: would send to graphite: stats.bad 1',),
+             ('alertlib: would send to graphite: stats.worse -2.5',)
+             ],
+            self.sent_to_info_log)
+
+    def test_bad_graphite_statistic_value(self):
+        stderr = StringIO.StringIO()
+        self.mock(sys, 'stderr', stderr)
+        with self.assertRaises(SystemExit):
+            timeout.main('-n --graphite=stats.alert=lots 0 true'.split())
+        self.assertIn('Bad value for graphite statistic stats.alert: lots',
+                      stderr.getvalue())
+        self.assertEqual([], self.sent_to_info_log)
+
+    def test_failed_alert_turns_off_async_hipchat(self):
+        with self.assertRaises(ValueError):
+            timeout.main('-n --hipchat=testroom --mail=foo@bar.com '
+                         '0 true'.split())
+        self.assertFalse(alertlib._HIPCHAT_ASYNC)
+
+    def _rate_limit_db(self):
+        # So the rate limiter we configure doesn't outlive the test.
+        self.mock(alertlib, '_RATE_LIMITER', alertlib._RATE_LIMITER)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        return os.path.join(tmpdir, 'rate_limits.sqlite')
+
+    def test_rate_limit(self):
+        argv = ('-n --severity=info --rate-limit=60 --rate-limit-db=%s '
+                '--logs 0 true'
+                % self._rate_limit_db()).split()
+        timeout.main(argv)
+        timeout.main(argv)
+        self.assertEqual([('TIMEOUT running true',)], self.sent_to_info_log)
+
+    def test_dry_run_does_not_use_up_rate_limit(self):
+        db_path = self._rate_limit_db()
+        self.mock(alertlib, '_RATE_LIMITER', alertlib._RateLimiter())
+        argv = ('--severity=info --rate-limit=60 --rate-limit-db=%s '
+                '--logs 0 true' % db_path).split()
+        self.mock(alertlib, '_TEST_MODE', False)
+        self.mock(alertlib.syslog, 'syslog', lambda prio, msg: None)
+        timeout.main(['-n'] + argv)
+        alertlib.exit_test_mode()
+        timeout.main(argv)
+        self.assertEqual([('TIMEOUT running true',)] * 2,
+                         self.sent_to_info_log)
+
+    def test_rate_limit_db_needs_sqlite3(self):
+        sqlite3 = alertlib.sqlite3
+        del alertlib.sqlite3
+        self.addCleanup(setattr, alertlib, 'sqlite3', sqlite3)
+        stderr = StringIO.StringIO()
+        self.mock(sys, 'stderr', stderr)
+        with self.assertRaises(SystemExit):
+            timeout.main(('--rate-limit=60 --rate-limit-db=%s --logs '
+                          '0 true' % self._rate_limit_db()).split())
+        self.assertIn('cannot use --rate-limit-db', stderr.getvalue())
+        self.assertEqual([], self.sent_to_info_log)
+
 
 if __name__ == '__main__':
     unittest.main()
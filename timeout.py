@@ -112,6 +112,7 @@ def run_with_timeout(timeout, args, kill_signal, kill_after=None,
 def main(argv):
     parser = setup_parser()
     args = parser.parse_args(argv)
+    alert.setup_rate_limiting(parser, args)
     if args.dry_run:
         logging.getLogger().setLevel(logging.INFO)
         alertlib.enter_test_mode()